@@ -1,44 +1,274 @@
+import hmac
+import ipaddress
 import os
-from flask import Flask, render_template, request, flash, redirect, session, g, abort
+import random
+from datetime import datetime
+from flask import (Blueprint, Flask, current_app, render_template, request, flash, redirect,
+                   session, g, abort, jsonify, send_from_directory, make_response,
+                   Response, stream_with_context)
 # from flask_debugtoolbar import DebugToolbarExtension
+from jinja2 import FileSystemBytecodeCache
 from sqlalchemy.exc import IntegrityError
-
-from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm
-from models import db, connect_db, User, Message
+from sqlalchemy.orm import configure_mappers, joinedload
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import bulk_follows
+import compression
+import exports
+import follow_graph
+import metrics
+import notifications
+import partitions
+import profiler
+import threads
+from archive import archive
+from availability import availability
+from firehose import firehose
+from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm, FollowImportForm
+from message_cache import message_cache
+from models import db, connect_db, User, Message, Follows, Likes, Suggestion, Notification
+from profiles import (load_profile, profile_messages, following_page, followers_page,
+                      likes_page, followed_among)
+from purge_users import purge_in_background
+from ratelimit import RateLimiter
+from slow_queries import slow_query_log
+from records import MessageRecord, record_query
+from tags import index_messages, tag_feed, mention_feed
+from timeline import home_timeline, recent_messages_cache
+from uploads import AVATAR, HEADER, ImageError, store_images, thumbnail
+from write_behind import LIKE, FOLLOW, write_queue
 
 CURR_USER_KEY = "curr_user"
+TIMELINE_PAGE_SIZE = 100
+USERS_PAGE_SIZE = 60
+
+views = Blueprint('warbler', __name__)
+
+
+def create_app(config=None):
+    """Create and configure a Warbler app.
+
+    Cheap enough to call per test: nothing here touches the database (the
+    engine connects on first use) or compiles templates. Pass `config` to
+    override settings. For a preloading server, follow with `warm_up(app)`
+    in the master process; see gunicorn.conf.py.
+    """
+
+    app = Flask(__name__)
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+    # Memory-mapped follow graph shared by all workers (see follow_graph.py).
+    app.config['FOLLOW_GRAPH_PATH'] = os.environ.get(
+        'FOLLOW_GRAPH_PATH', os.path.join(app.instance_path, 'follow_graph.bin'))
+    # Users following at least this many accounts get the k-way merge timeline.
+    app.config['TIMELINE_MERGE_THRESHOLD'] = int(
+        os.environ.get('TIMELINE_MERGE_THRESHOLD', 500))
+    # Compiled templates are cached here so new processes skip Jinja's compiler.
+    app.config['JINJA_BYTECODE_CACHE_DIR'] = os.environ.get(
+        'JINJA_BYTECODE_CACHE_DIR', os.path.join(app.instance_path, 'jinja_cache'))
+    # Requests allowed per endpoint, per client IP and per logged-in user
+    # (see ratelimit.py); only POSTs are counted.
+    app.config['RATELIMIT_ENABLED'] = True
+    app.config['RATE_LIMITS'] = {
+        'warbler.signup': {'per_ip': '10/hour'},
+        'warbler.login': {'per_ip': '20/minute'},
+        'warbler.messages_add': {'per_user': '30/minute', 'per_ip': '120/minute'},
+        'warbler.messages_reply': {'per_user': '30/minute', 'per_ip': '120/minute'},
+        'warbler.add_like': {'per_user': '120/minute', 'per_ip': '480/minute'},
+        'warbler.add_follow': {'per_user': '60/minute', 'per_ip': '240/minute'},
+        'warbler.stop_following': {'per_user': '60/minute', 'per_ip': '240/minute'},
+        'warbler.follow_many': {'per_user': '10/minute', 'per_ip': '40/minute'},
+        'warbler.import_follows': {'per_user': '5/hour', 'per_ip': '20/hour'},
+    }
+    # Set to share buckets between worker processes through a mapped file;
+    # otherwise each process keeps its own.
+    app.config['RATELIMIT_STORAGE_PATH'] = os.environ.get('RATELIMIT_STORAGE_PATH')
+    # Reverse proxies in front of the app. Client IPs (for the per-IP rate
+    # limits) are read from the X-Forwarded-For entry this many hops back;
+    # 0 trusts no forwarded headers at all.
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+    # Uploaded profile images and their resized variants (see uploads.py).
+    app.config['UPLOAD_DIR'] = os.environ.get(
+        'UPLOAD_DIR', os.path.join(app.instance_path, 'uploads'))
+    app.config['UPLOAD_WORKERS'] = int(os.environ.get('UPLOAD_WORKERS', 2))
+    app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024
+    # Usernames allowed into the /admin pages.
+    app.config['ADMIN_USERNAMES'] = {
+        name.strip() for name in os.environ.get('ADMIN_USERNAMES', '').split(',') if name.strip()}
+    # /metrics answers scrapers on loopback, and elsewhere only those sending
+    # Authorization: Bearer <METRICS_TOKEN>.
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    # Requests are profiled if they send X-Profile-Token: <PROFILER_TOKEN>,
+    # and at random with probability PROFILER_SAMPLE_RATE (see profiler.py).
+    app.config['PROFILER_TOKEN'] = os.environ.get('PROFILER_TOKEN')
+    app.config['PROFILER_SAMPLE_RATE'] = float(os.environ.get('PROFILER_SAMPLE_RATE', 0))
+    app.config['PROFILER_INTERVAL'] = profiler.DEFAULT_INTERVAL
+    app.config['PROFILER_DIR'] = os.environ.get(
+        'PROFILER_DIR', os.path.join(app.instance_path, 'profiles'))
+    # Statements slower than this are logged, and a sample of the slow
+    # SELECTs EXPLAINed on Postgres (see slow_queries.py). Empty turns it off.
+    app.config['SLOW_QUERY_THRESHOLD_MS'] = os.environ.get('SLOW_QUERY_THRESHOLD_MS', '100')
+    app.config['SLOW_QUERY_EXPLAIN_RATE'] = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+    app.config['SLOW_QUERY_LOG'] = os.environ.get(
+        'SLOW_QUERY_LOG', os.path.join(app.instance_path, 'slow_queries.log'))
+    # Likes and follows are journaled here and applied in batches by a
+    # background flusher (see write_behind.py); unset applies them in-request.
+    app.config['WRITE_BEHIND_JOURNAL'] = os.environ.get('WRITE_BEHIND_JOURNAL')
+    # Months of messages moved out of the database by archive.py.
+    app.config['ARCHIVE_DIR'] = os.environ.get(
+        'ARCHIVE_DIR', os.path.join(app.instance_path, 'archive'))
+    # Text responses at least this big are compressed for clients that
+    # accept it (see compression.py). Empty turns compression off.
+    app.config['COMPRESSION_MIN_SIZE'] = os.environ.get(
+        'COMPRESSION_MIN_SIZE', str(compression.MIN_SIZE))
+    # toolbar = DebugToolbarExtension(app)
+
+    if config:
+        app.config.update(config)
+
+    cache_dir = app.config['JINJA_BYTECODE_CACHE_DIR']
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_options = dict(app.jinja_options,
+                                 bytecode_cache=FileSystemBytecodeCache(cache_dir))
+
+    proxies = app.config['TRUSTED_PROXIES']
+    if proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)
+
+    connect_db(app)
+
+    # This app's own state; the views reach it through current_app.
+    limiter = RateLimiter()
+    limiter.configure(app.config['RATE_LIMITS'], app.config['RATELIMIT_STORAGE_PATH'])
+    min_size = app.config['COMPRESSION_MIN_SIZE']
+    compressor = compression.ResponseCompressor(int(min_size) if min_size else None)
+    app.extensions['ratelimit'] = limiter
+    app.extensions['compression'] = compressor
+    metrics.register('ratelimit', limiter.stats)
+    metrics.register('compression', compressor.stats)
+
+    # Services shared with code that runs outside any app (background
+    # flushers, scripts) stay process-wide, configured by the app the
+    # process serves.
+    follow_graph.graph.configure(app.config['FOLLOW_GRAPH_PATH'])
+
+    threshold_ms = app.config['SLOW_QUERY_THRESHOLD_MS']
+    log_path = app.config['SLOW_QUERY_LOG']
+    if log_path:
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    slow_query_log.configure(threshold=float(threshold_ms) / 1000 if threshold_ms else None,
+                             explain_rate=app.config['SLOW_QUERY_EXPLAIN_RATE'],
+                             log_path=log_path)
+
+    journal_path = app.config['WRITE_BEHIND_JOURNAL']
+    if journal_path:
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+    write_queue.configure(journal_path)
+    archive.configure(app.config['ARCHIVE_DIR'])
+    app.register_blueprint(views)
+
+    return app
+
+
+def warm_up(app):
+    """Do one-off start-up work up front, before workers fork.
+
+    Compiles every template (filling the bytecode cache), configures the ORM
+    mappers, runs the hot queries once (so their compiled SQL is in the
+    engine's statement cache, which workers inherit), creates the coming
+    months' message partitions, applies any likes and follows left in the
+    write-behind journal, loads the availability filters and seeds the
+    anonymous firehose. Finally it drops any pooled connections so forked
+    workers never share a socket.
+    """
 
-app = Flask(__name__)
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
+    with app.app_context():
+        configure_mappers()
+        engine = db.get_engine(app)
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-# app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-# toolbar = DebugToolbarExtension(app)
+        hot_queries = [
+            User.query.filter(User.id == 0),
+            record_query().filter(Message.user_id.in_([0])).order_by(Message.id.desc()),
+            Message.query.filter(Message.user_id == 0).order_by(Message.id.desc()),
+            db.session.query(Follows.user_being_followed_id).filter(Follows.user_following_id == 0),
+        ]
+        for query in hot_queries:
+            query.all()
 
-connect_db(app)
+        with engine.begin() as connection:
+            if partitions.is_partitioned(connection):
+                partitions.ensure_partitions(connection)
+
+        # Catch up on events acknowledged before a crash or restart.
+        while write_queue.flush(app):
+            pass
+
+        # Workers inherit loaded filters rather than each scanning `users`.
+        availability.refresh()
+
+        # Workers inherit a full firehose for anonymous visitors.
+        firehose.seed(app)
+
+        db.session.remove()
+        engine.dispose()
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@views.before_app_request
+def start_profiling():
+    """Sample this request's stack if it asked to be (or was picked to be) profiled."""
+
+    config = current_app.config
+    token = request.headers.get('X-Profile-Token')
+
+    if ((token and config['PROFILER_TOKEN']
+         and hmac.compare_digest(token, config['PROFILER_TOKEN']))
+            or random.random() < config['PROFILER_SAMPLE_RATE']):
+        g.profiler = profiler.StackSampler(interval=config['PROFILER_INTERVAL']).start()
+
+
+@views.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = User.active().filter_by(id=session[CURR_USER_KEY]).first()
 
     else:
         g.user = None
 
 
+@views.before_app_request
+def check_rate_limit():
+    """Turn away clients that are POSTing faster than their endpoint allows."""
+
+    if request.method != 'POST' or not current_app.config['RATELIMIT_ENABLED']:
+        return None
+
+    retry_after = current_app.extensions['ratelimit'].check(request.endpoint, g.user.id if g.user else None,
+                                request.remote_addr)
+    if retry_after is None:
+        return None
+
+    return (f"Too many requests; try again in {retry_after} seconds.", 429,
+            {'Retry-After': str(retry_after), 'Content-Type': 'text/plain'})
+
+
 def do_login(user):
     """Log in user."""
 
@@ -52,7 +282,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@views.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -67,6 +297,16 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # Cheap pre-check so duplicate names don't cost a bcrypt hash and a
+        # failed INSERT; the unique constraints still have the final say.
+        if not availability.username_available(form.username.data):
+            flash("Username already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
+        if not availability.email_available(form.email.data):
+            flash("Email already registered", 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -80,6 +320,7 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        availability.add(user.username, user.email)
         do_login(user)
         session['user_id'] = user.id
 
@@ -89,7 +330,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@views.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -110,7 +351,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -121,10 +362,67 @@ def logout():
     return redirect('/login')
 
 
+def page_cursor(items, page_size=TIMELINE_PAGE_SIZE):
+    """Cursor for the page after `items`, or None if this is the last page."""
+
+    if len(items) < page_size:
+        return None
+
+    return items[-1].id
+
+
+def profile_or_404(user_id):
+    """`user_id`'s `ProfileSummary` as seen by the logged-in user, or a 404."""
+
+    profile = load_profile(user_id, g.user.id if g.user else None)
+    if profile is None:
+        abort(404)
+
+    return profile
+
+
+@views.route('/api/username-available')
+def username_available():
+    """Is a username free to sign up with?
+
+    Answered from an in-memory Bloom filter where possible; used by the
+    signup form as you type. Emails aren't offered here: anyone could ask,
+    unthrottled, whether an address has an account.
+    """
+
+    username = request.args.get('username', '').strip()
+    if not username:
+        return jsonify(error="username is required"), 400
+
+    return jsonify(username=username, available=availability.username_available(username))
+
+
+def may_scrape_metrics():
+    """Is the request from loopback, or carrying the metrics token?"""
+
+    # Behind a proxy this is the client's address (see TRUSTED_PROXIES).
+    if request.remote_addr and ipaddress.ip_address(request.remote_addr).is_loopback:
+        return True
+
+    token = current_app.config['METRICS_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(authorization, f"Bearer {token}")
+
+
+@views.route('/metrics')
+def show_metrics():
+    """Process-local counters (cache hit rates etc.) for the monitoring scraper."""
+
+    if not may_scrape_metrics():
+        abort(403)
+
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@views.route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -134,31 +432,28 @@ def list_users():
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users = User.active().all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = User.active().filter(User.username.like(f"%{search}%")).all()
 
-    return render_template('users/index.html', users=users)
+    viewer_follows = followed_among(g.user.id, [u.id for u in users]) if g.user else set()
+    return render_template('users/index.html', users=users, viewer_follows=viewer_follows)
 
 
-@app.route('/users/<int:user_id>')
+@views.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = profile_or_404(user_id)
+    before = request.args.get('before', type=int)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    # Message ids are time-ordered, so they double as the page cursor.
+    messages = profile_messages(user, TIMELINE_PAGE_SIZE, before)
+    return render_template('users/show.html', user=user, messages=messages,
+                           next_page=page_cursor(messages))
 
 
-@app.route('/users/<int:user_id>/following')
+@views.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -166,11 +461,14 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = profile_or_404(user_id)
+    following = following_page(user_id, USERS_PAGE_SIZE, request.args.get('before', type=int))
+    return render_template('users/following.html', user=user, following=following,
+                           viewer_follows=followed_among(g.user.id, [u.id for u in following]),
+                           next_page=page_cursor(following, USERS_PAGE_SIZE))
 
 
-@app.route('/users/<int:user_id>/followers')
+@views.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -178,11 +476,65 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = profile_or_404(user_id)
+    followers = followers_page(user_id, USERS_PAGE_SIZE, request.args.get('before', type=int))
+    return render_template('users/followers.html', user=user, followers=followers,
+                           viewer_follows=followed_among(g.user.id, [u.id for u in followers]),
+                           next_page=page_cursor(followers, USERS_PAGE_SIZE))
+
+
+def following_ids_for(user_id):
+    """Ids of users `user_id` follows, from the shared follow graph if there is one.
+
+    Follows and unfollows still in the write-behind queue are included.
+    """
+
+    if follow_graph.graph.available:
+        # A copy: callers add to it and hand it to queries.
+        following_ids = list(follow_graph.graph.following_ids(user_id))
+    else:
+        following_ids = [followed_id for (followed_id,) in
+                         (db.session
+                          .query(Follows.user_being_followed_id)
+                          .filter(Follows.user_following_id == user_id))]
 
+    pending = write_queue.pending(user_id, FOLLOW)
+    if pending:
+        following_ids = [id for id in following_ids if pending.get(id, True)]
+        following_ids.extend(id for id, active in pending.items()
+                             if active and id not in following_ids)
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+    return following_ids
+
+
+def liked_among(user_id, message_ids):
+    """The subset of `message_ids` that `user_id` likes, including queued likes."""
+
+    liked = set()
+    if message_ids:
+        liked = {message_id for (message_id,) in
+                 (db.session
+                  .query(Likes.message_id)
+                  .filter(Likes.user_id == user_id, Likes.message_id.in_(message_ids)))}
+
+    for message_id, active in write_queue.pending(user_id, LIKE).items():
+        if active:
+            liked.add(message_id)
+        else:
+            liked.discard(message_id)
+
+    return liked
+
+
+def submit_write(kind, target_id, active):
+    """Queue a like or follow change by the current user (see write_behind.py)."""
+
+    app = current_app._get_current_object()
+    write_queue.ensure_running(app)
+    write_queue.submit(kind, g.user.id, target_id, active, app)
+
+
+@views.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -190,14 +542,64 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    followed_user = User.active().filter_by(id=follow_id).first_or_404()
+    submit_write(FOLLOW, followed_user.id, True)
+
+    notifications.queue.enqueue(followed_user.id, notifications.FOLLOW, g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@views.route('/api/follows', methods=['POST'])
+def follow_many():
+    """Follow many users at once: JSON {"users": [user ids or usernames]}.
+
+    Returns {"results": [{"user": ..., "user_id": ..., "status": ...}]}, one
+    per requested user, in order (see bulk_follows.py for the statuses).
+    """
+
+    if not g.user:
+        return jsonify(error="login required"), 401
+
+    targets = (request.get_json(silent=True) or {}).get('users')
+    if not isinstance(targets, list) or not all(isinstance(t, (int, str)) for t in targets):
+        return jsonify(error="users must be a list of user ids or usernames"), 400
+
+    try:
+        results = bulk_follows.follow_many(g.user.id, targets, current_app._get_current_object())
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+
+    return jsonify(results=[dict(user=r.target, user_id=r.user_id, status=r.status)
+                            for r in results])
+
+
+@views.route('/users/follow/import', methods=['GET', 'POST'])
+def import_follows():
+    """Follow everyone in an uploaded CSV, and show what happened to each row."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    form = FollowImportForm()
+    results = None
+
+    if form.validate_on_submit():
+        text = form.follows_csv.data.read().decode('utf-8-sig', errors='replace')
+        try:
+            results = bulk_follows.follow_many(g.user.id, bulk_follows.targets_from_csv(text),
+                                               current_app._get_current_object())
+        except ValueError as error:
+            form.follows_csv.errors.append(str(error))
+        else:
+            followed = sum(r.status == bulk_follows.FOLLOWED for r in results)
+            flash(f"Followed {followed} new users.", "success")
+
+    return render_template('users/import.html', form=form, results=results)
+
+
+@views.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -205,15 +607,14 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    followed_user = User.query.get_or_404(follow_id)
+    submit_write(FOLLOW, followed_user.id, False)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 
-@app.route('/messages/<int:message_id>/add_like', methods=['POST'])
+@views.route('/messages/<int:message_id>/add_like', methods=['POST'])
 def add_like(message_id):
     """Toggle a like for the currently-logged-in user."""
 
@@ -221,27 +622,24 @@ def add_like(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    liked_message = Message.query.get_or_404(message_id)
+    liked_message = visible_message_or_404(message_id)
 
     # Prevent user from liking own messages
     if liked_message.user_id == g.user.id:
         return abort(403)
 
-    user_likes = g.user.likes
-
-    # if already liked, return all likes that do not equal liked message (un-like)
-    if liked_message in user_likes:
-        g.user.likes = [like for like in user_likes if like != liked_message]
+    # Liked already (counting likes not yet written)? Then this un-likes it.
+    newly_liked = not liked_among(g.user.id, [liked_message.id])
+    submit_write(LIKE, liked_message.id, newly_liked)
 
-    # If not liked already, append to user_likes
-    else:
-        g.user.likes.append(liked_message)
+    if newly_liked:
+        notifications.queue.enqueue(liked_message.user_id, notifications.LIKE, g.user.id,
+                                    target_id=liked_message.id)
 
-    db.session.commit()
     return redirect("/")
 
 
-@app.route('/users/<int:user_id>/likes')
+@views.route('/users/<int:user_id>/likes')
 def show_likes(user_id):
     """Show liked messages of current logged in user"""
 
@@ -249,44 +647,104 @@ def show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user, likes=user.likes)
+    user = profile_or_404(user_id)
+    likes = likes_page(user_id, TIMELINE_PAGE_SIZE, request.args.get('before', type=int))
+    return render_template('users/likes.html', user=user, likes=likes,
+                           next_page=page_cursor(likes))
+
+
 
 
+@views.route('/users/<int:user_id>/export')
+def export_user(user_id):
+    """Stream the current user's messages, likes and follows as NDJSON or CSV.
 
+    Takes `format` (ndjson or csv), `gzip=1` to compress, and `cursor` to
+    resume after the last record received.
+    """
+
+    if not g.user or g.user.id != user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify(error="format must be ndjson or csv"), 400
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            exports.parse_cursor(cursor)
+        except ValueError as error:
+            return jsonify(error=str(error)), 400
 
-@app.route('/users/<int:user_id>/update', methods=["GET", "POST"])
+    records = exports.export_records(user_id, cursor)
+    lines = exports.csv_lines(records) if export_format == 'csv' else exports.ndjson_lines(records)
+    body = exports.chunked(lines)
+
+    filename = f"warbler-{g.user.username}.{export_format}"
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    if request.args.get('gzip') == '1':
+        body = exports.gzipped(body)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@views.route('/users/<int:user_id>/update', methods=["GET", "POST"])
 def profile(user_id):
     """Update profile for current user."""
 
     user = User.query.get_or_404(user_id)
     form = UserUpdateForm(obj=user)
-    
-    print("*************************************")
-    print(user.id)
-    print(session[CURR_USER_KEY])
-    print("*************************************")
-    
-    if user.id != session[CURR_USER_KEY] or CURR_USER_KEY not in session:
+
+    if CURR_USER_KEY not in session or user.id != session[CURR_USER_KEY]:
         flash("Access unauthorized.", "danger")
         return redirect('/')
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
-
-        if not user:
+        # Confirm with the current username; the form may be changing it.
+        if not User.authenticate(user.username, form.password.data):
             flash("Invalid credentials.", 'danger')
 
+        elif (form.username.data != user.username
+              and not availability.username_available(form.username.data)):
+            flash("Username already taken", 'danger')
+
+        elif (form.email.data != user.email
+              and not availability.email_available(form.email.data)):
+            flash("Email already registered", 'danger')
+
         else:
+            try:
+                uploaded = store_images(
+                    {kind: field.data.read()
+                     for kind, field in ((AVATAR, form.image_upload),
+                                         (HEADER, form.header_image_upload))
+                     if field.data},
+                    current_app.config['UPLOAD_DIR'],
+                    current_app.config['UPLOAD_WORKERS'])
+            except ImageError as error:
+                flash(str(error), 'danger')
+                return render_template('users/edit.html', form=form, user=user)
+
+            if (form.username.data, form.email.data) != (user.username, user.email):
+                user.renamed_at = datetime.utcnow()
             user.email = form.email.data
             user.username = form.username.data
-            user.image_url = form.image_url.data
-            user.header_image_url = form.header_image_url.data
+            user.image_url = uploaded.get(AVATAR, form.image_url.data)
+            user.header_image_url = uploaded.get(HEADER, form.header_image_url.data)
             user.bio = form.bio.data
             user.location = form.location.data
             
             db.session.commit()
+            availability.add(user.username, user.email)
+            # Cached messages carry the old author card.
+            recent_messages_cache.remove_author(user.id)
+            message_cache.invalidate_author(user.id)
+            firehose.remove(author_id=user.id)
             
             flash("Successfully Updated!", 'success')
             return redirect(f"/users/{user.id}")
@@ -296,7 +754,7 @@ def profile(user_id):
 
 
 
-@app.route('/users/delete', methods=["POST"])
+@views.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -306,16 +764,44 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # Write out anything this user just triggered before their rows go.
+    notifications.flush(force=True)
+
+    # Hide the account now; the rows behind it are purged in the background.
+    g.user.deleted_at = datetime.utcnow()
     db.session.commit()
+    recent_messages_cache.remove_author(g.user.id)
+    message_cache.invalidate_author(g.user.id)
+    firehose.remove(author_id=g.user.id)
+    purge_in_background(current_app._get_current_object(), g.user.id)
 
     return redirect("/signup")
 
 
+@views.route('/uploads/<path:filename>')
+def uploaded_image(filename):
+    """Serve an uploaded image. Names are content hashes, so cache them forever."""
+
+    response = send_from_directory(current_app.config['UPLOAD_DIR'], filename)
+    return shared_cache(response, 31536000, immutable=True)
+
+
+views.add_app_template_filter(thumbnail)
+
+
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+def visible_message_or_404(message_id):
+    """The message with `message_id`, or a 404 if it (or its author) is gone."""
+
+    return (Message.query
+            .join(User, Message.user_id == User.id)
+            .filter(Message.id == message_id, User.deleted_at.is_(None))
+            .first_or_404())
+
+
+@views.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -331,22 +817,75 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        index_messages([msg])
         db.session.commit()
+        record = MessageRecord.from_message(msg)
+        recent_messages_cache.add_message(record)
+        firehose.add(record)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@views.route('/messages/<int:message_id>/reply', methods=["GET", "POST"])
+def messages_reply(message_id):
+    """Reply to a message:
+
+    Show form if GET. If valid, add the reply and redirect to its place in the thread.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    parent = message_cache.get(message_id)
+    if parent is None:
+        abort(404)
+
+    form = MessageForm()
+
+    if form.validate_on_submit():
+        msg = threads.add_reply(parent, g.user.id, form.text.data)
+        db.session.flush()
+        index_messages([msg])
+        db.session.commit()
+        message_cache.invalidate(msg.parent_id)
+        record = MessageRecord.from_message(msg)
+        recent_messages_cache.add_message(record)
+        firehose.add(record)
+
+        return redirect(f"/messages/{message_id}#message-{msg.id}")
+
+    return render_template('messages/new.html', form=form, parent=parent)
+
+
+@views.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message, the messages it replies to and a page of its replies.
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    Replies are paged in thread order; `after` is the previous page's cursor.
+    """
+
+    msg = message_cache.get(message_id)
+    if msg is None:
+        abort(404)
+
+    after = request.args.get('after')
+    if after is not None and not threads.is_path(after):
+        abort(400)
+
+    replies = threads.thread_page(msg.id, after=after)
+    ancestors = threads.ancestors(msg) if after is None else []
 
+    viewer_follows = bool(g.user and followed_among(g.user.id, [msg.user_id]))
+    next_page = replies[-1].path if len(replies) == threads.THREAD_PAGE_SIZE else None
+    return render_template('messages/show.html', message=msg, viewer_follows=viewer_follows,
+                           ancestors=ancestors, replies=replies, next_page=next_page)
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+
+@views.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -355,17 +894,168 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    if msg is None:
+        abort(404)
+
+    if msg.user_id != g.user.id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    threads.detach_replies([msg.id])
     db.session.delete(msg)
     db.session.commit()
+    recent_messages_cache.remove_author(msg.user_id)
+    message_cache.invalidate(msg.id)
+    if msg.parent_id is not None:
+        message_cache.invalidate(msg.parent_id)
+    firehose.remove([msg.id])
 
     return redirect(f"/users/{g.user.id}")
 
 
+@views.route('/tags/<tag>')
+def tag_messages(tag):
+    """Show messages with a #hashtag, newest first."""
+
+    before = request.args.get('before', type=int)
+    messages = tag_feed(tag, TIMELINE_PAGE_SIZE, before=before)
+
+    return render_template('messages/feed.html', title=f"#{tag.lower()}",
+                           messages=messages, next_page=page_cursor(messages))
+
+
+@views.route('/mentions')
+def show_mentions():
+    """Show messages mentioning the currently-logged-in user, newest first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    before = request.args.get('before', type=int)
+    messages = mention_feed(g.user.id, TIMELINE_PAGE_SIZE, before=before)
+
+    return render_template('messages/feed.html', title=f"Mentions of @{g.user.username}",
+                           messages=messages, next_page=page_cursor(messages))
+
+
+##############################################################################
+# Notifications
+
+
+@views.route('/notifications')
+def show_notifications():
+    """Show the current user's notifications and mark them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    # Make sure anything still queued in this process shows up.
+    notifications.flush(force=True)
+
+    items = (Notification
+             .query
+             .options(joinedload(Notification.last_actor))
+             .join(Notification.last_actor)
+             .filter(Notification.recipient_id == g.user.id, User.deleted_at.is_(None))
+             .order_by(Notification.updated_at.desc())
+             .limit(50)
+             .all())
+    unread = {n.id for n in items if not n.is_read}
+
+    notifications.mark_all_read(g.user.id)
+
+    return render_template('users/notifications.html', notifications=items, unread=unread)
+
+
+@views.app_context_processor
+def inject_unread_notifications():
+    """Make the current user's unread notification count available to templates."""
+
+    if g.get('user'):
+        return dict(unread_notifications=notifications.unread_counts.get(g.user.id))
+
+    return dict(unread_notifications=0)
+
+
+@views.after_app_request
+def finish_profiling(resp):
+    """Write out this request's profile, if it's being profiled."""
+
+    sampler = g.pop('profiler', None)
+    if sampler is not None:
+        store = profiler.ProfileStore(current_app.config['PROFILER_DIR'])
+        name = store.save(sampler.stop(), endpoint=request.endpoint, method=request.method,
+                          path=request.full_path, status=resp.status_code)
+        resp.headers['X-Profile'] = name
+
+    return resp
+
+
+@views.after_app_request
+def flush_notifications(resp):
+    """Write queued notifications once a batch is due."""
+
+    notifications.flush()
+    return resp
+
+
+##############################################################################
+# Admin
+
+def is_admin(user):
+    """May `user` use the /admin pages?"""
+
+    return bool(user) and user.username in current_app.config['ADMIN_USERNAMES']
+
+
+@views.route('/admin/profiles')
+def list_profiles():
+    """List recent request profiles."""
+
+    if not is_admin(g.user):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    store = profiler.ProfileStore(current_app.config['PROFILER_DIR'])
+    return render_template('admin/profiles.html', profiles=store.recent())
+
+
+@views.route('/admin/profiles/<name>')
+def download_profile(name):
+    """Download a profile's collapsed stacks (for flamegraph.pl, speedscope etc.)."""
+
+    if not is_admin(g.user):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    store = profiler.ProfileStore(current_app.config['PROFILER_DIR'])
+    filename = store.filename(name)
+    if filename is None:
+        abort(404)
+
+    return send_from_directory(store.directory, filename, as_attachment=True,
+                               mimetype='text/plain')
+
+
+@views.route('/admin/slow-queries')
+def list_slow_queries():
+    """Show the slowest statements this process has run."""
+
+    if not is_admin(g.user):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return render_template('admin/slow_queries.html', queries=slow_query_log.top(),
+                           threshold=slow_query_log.threshold)
+
+
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+@views.route('/')
 def homepage():
     """Show homepage:
 
@@ -374,24 +1064,34 @@ def homepage():
     """
 
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
-        print("**************************************")
-        print(following_ids)
-        print("**************************************")
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        
-        user = User.query.get_or_404(g.user.id)
-        liked_messages = [message.id for message in g.user.likes]
-
-        return render_template('home.html', messages=messages, user=user, likes=liked_messages)
+        following_ids = following_ids_for(g.user.id)
+        following_ids.append(g.user.id)
+        before = request.args.get('before', type=int)
+
+        messages = home_timeline(following_ids,
+                                 TIMELINE_PAGE_SIZE,
+                                 before=before,
+                                 merge_threshold=current_app.config['TIMELINE_MERGE_THRESHOLD'])
+
+        user = profile_or_404(g.user.id)
+        liked_messages = liked_among(g.user.id, [message.id for message in messages])
+        suggestions = Suggestion.users_for(g.user.id)
+
+        return render_template('home.html', messages=messages, user=user, likes=liked_messages,
+                               suggestions=suggestions, next_page=page_cursor(messages))
 
     else:
-        return render_template('home-anon.html')
+        # Served from memory: the firehose is refreshed in the background.
+        firehose.ensure_running(current_app._get_current_object())
+        version, firehose_html = firehose.page
+        response = make_response(render_template('home-anon.html',
+                                                 firehose_html=firehose_html))
+
+        # Only share the page if nothing in it (e.g. a flash) is per-visitor.
+        if not session:
+            shared_cache(response, firehose.refresh_interval)
+            compression.shared_body(('home-anon', version))
+        return response
 
 
 ##############################################################################
@@ -401,10 +1101,32 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+def shared_cache(response, max_age, immutable=False):
+    """Let browsers and shared caches keep `response` for `max_age` seconds.
+
+    add_header leaves responses marked this way alone.
+    """
+
+    response.headers['Cache-Control'] = (f"public, max-age={max_age}"
+                                         + (", immutable" if immutable else ""))
+    g.shared_cache = True
+    return response
+
+
+@views.after_app_request
+def compress_response(resp):
+    """Compress the response for clients that accept it (runs after add_header)."""
+
+    return current_app.extensions['compression'].compress_response(resp)
+
+
+@views.after_app_request
 def add_header(req):
     """Add non-caching headers on every request."""
 
+    if g.get('shared_cache'):
+        return req
+
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
@@ -0,0 +1,460 @@
+"""Cold storage for old messages.
+
+Months of messages older than the retention window are moved out of the
+database into ARCHIVE_DIR, one month at a time:
+
+    <YYYY-MM>.ndjson.zst    the month's messages as NDJSON, compressed as
+                            one zstd frame per author, newest first
+    <YYYY-MM>.likes.ndjson.zst
+    <YYYY-MM>.tags.ndjson.zst
+    <YYYY-MM>.mentions.ndjson.zst
+                            the likes, tags and mentions of the month's
+                            messages (RELATED), as one zstd frame each
+    <YYYY-MM>.index.json    the month's id range, where each author's
+                            frame is: {user_id: [offset, length, count]},
+                            and how many of each RELATED row there are
+
+so reading one author's archived month is a seek and one small
+decompression. The index is written last; a month without one isn't
+archived (and its rows are still in the database).
+
+Once a month is archived, its likes, tags, mentions and like notifications
+are deleted in batches, then its messages: on Postgres by dropping the
+month's partition (then deleting any of its rows in the default partition),
+elsewhere by batched DELETEs. Like notifications aren't archived: they're
+only worth anything while they're recent.
+
+Purging a user (purge_users.py) takes them out of every archived month
+too; see `MessageArchive.purge_user`.
+
+Profile pages and exports read a user's archived messages through
+`archive` (configured by `create_app`) once they run out of rows in the
+database. It keeps the list of months, their indexes and each user's
+archived message count in memory, and only re-reads them when the
+directory changes (one stat per lookup), so users with nothing archived
+cost no file reads at all.
+
+    python archive.py [--retention-months 12] [--batch-size 1000]
+"""
+
+import argparse
+import io
+import itertools
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import zstandard
+from sqlalchemy.orm import aliased
+
+import notifications
+import partitions
+from models import db, Likes, Mention, Message, MessageTag, Notification
+from purge_users import DEFAULT_BATCH_SIZE, _delete_in_batches
+
+RETENTION_MONTHS = 12
+COMPRESSION_LEVEL = 10
+FETCH_SIZE = 1000
+
+FIELDS = ('id', 'text', 'timestamp', 'user_id', 'parent_id', 'path', 'depth', 'reply_count')
+# Rows pointing at messages that are archived with them: name -> (model, fields).
+RELATED = {
+    'likes': (Likes, ('id', 'user_id', 'message_id')),
+    'tags': (MessageTag, ('tag', 'message_id')),
+    'mentions': (Mention, ('user_id', 'message_id')),
+}
+
+
+def _month_name(month):
+    return f"{month:%Y-%m}"
+
+
+class MessageArchive:
+    """Reads archived months from a directory; indexes are cached in memory."""
+
+    def __init__(self):
+        self.directory = None
+        self._indexes = {}
+        # What the cached catalog was read from: the directory's (inode, mtime).
+        self._directory_id = None
+        self._months = []
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def configure(self, directory):
+        with self._lock:
+            self.directory = directory
+            self._indexes.clear()
+            self._directory_id = None
+            self._months = []
+            self._counts = {}
+
+    def _path(self, month, suffix):
+        return os.path.join(self.directory, f"{_month_name(month)}{suffix}")
+
+    def _catalog(self):
+        """(archived months newest first, {user_id: archived message count})."""
+
+        directory = self.directory
+        try:
+            st = os.stat(directory) if directory else None
+        except FileNotFoundError:
+            st = None
+        directory_id = (st.st_ino, st.st_mtime_ns) if st else None
+
+        with self._lock:
+            if directory_id == self._directory_id:
+                return self._months, self._counts
+
+        # A month appears (or changes, see purge_user) when its index is
+        # renamed into place, which changes the directory's mtime.
+        with self._lock:
+            self._indexes.clear()
+        files = os.listdir(directory) if st else []
+        months = sorted((datetime.strptime(f[:-len('.index.json')], '%Y-%m')
+                         for f in files if f.endswith('.index.json')), reverse=True)
+        counts = {}
+        for month in months:
+            for user_id, (_, _, count) in self.index(month)['users'].items():
+                counts[int(user_id)] = counts.get(int(user_id), 0) + count
+
+        with self._lock:
+            # mtimes are coarse: a month added in the same tick as a fresh
+            # change wouldn't move it, so look again next time.
+            recent = st is not None and time.time() - st.st_mtime < 1
+            self._directory_id = False if recent else directory_id
+            self._months = months
+            self._counts = counts
+
+        return months, counts
+
+    def months(self):
+        """Archived months, newest first."""
+
+        return self._catalog()[0]
+
+    def index(self, month):
+        """`month`'s index (loaded once per process)."""
+
+        with self._lock:
+            index = self._indexes.get(month)
+
+        if index is None:
+            with open(self._path(month, '.index.json')) as f:
+                index = json.load(f)
+            with self._lock:
+                self._indexes[month] = index
+
+        return index
+
+    def _read_frame(self, month, user_id):
+        """`user_id`'s messages in `month`, newest first."""
+
+        entry = self.index(month)['users'].get(str(user_id))
+        if entry is None:
+            return []
+
+        offset, length, _ = entry
+        with open(self._path(month, '.ndjson.zst'), 'rb') as f:
+            f.seek(offset)
+            data = zstandard.ZstdDecompressor().decompress(f.read(length))
+
+        return [json.loads(line) for line in data.splitlines()]
+
+    def related(self, month, name):
+        """`month`'s archived rows of RELATED[name] (e.g. 'likes'), as dicts."""
+
+        with open(self._path(month, f".{name}.ndjson.zst"), 'rb') as f:
+            with zstandard.ZstdDecompressor().stream_reader(f) as reader:
+                for line in io.TextIOWrapper(reader, encoding='utf-8'):
+                    yield json.loads(line)
+
+    def purge_user(self, user_id):
+        """Remove a purged user from every archived month. Returns how many messages went.
+
+        Their likes and mentions, and the likes, tags and mentions of their
+        messages, are filtered out of the RELATED files; their frame is
+        zeroed in place (so nobody else's offsets move), then dropped from
+        the index. Safe to run again after an interruption.
+        """
+
+        removed = 0
+
+        for month in self.months():
+            index = self.index(month)
+            entry = index['users'].get(str(user_id))
+            try:
+                message_ids = {message['id'] for message in self._read_frame(month, user_id)}
+            except zstandard.ZstdError:
+                # Zeroed by an interrupted purge; its rows are already filtered out.
+                message_ids = set()
+
+            related = dict(index.get('related', {}))
+            for name in related:
+                rows = list(self.related(month, name))
+                kept = [row for row in rows if row['message_id'] not in message_ids
+                        and row.get('user_id') != user_id]
+                if len(kept) != len(rows):
+                    related[name] = _write_ndjson(self._path(month, f".{name}.ndjson.zst"), kept)
+
+            if entry is None and related == index.get('related', {}):
+                continue
+
+            users = dict(index['users'])
+            count = index.get('count', 0)
+            if entry is not None:
+                offset, length, count_removed = entry
+                with open(self._path(month, '.ndjson.zst'), 'r+b') as f:
+                    f.seek(offset)
+                    f.write(bytes(length))
+                    f.flush()
+                    os.fsync(f.fileno())
+                del users[str(user_id)]
+                count -= count_removed
+                removed += count_removed
+
+            _write_index(self._path(month, '.index.json'),
+                         dict(index, count=count, users=users, related=related))
+            with self._lock:
+                self._indexes.pop(month, None)
+                self._directory_id = None
+
+        return removed
+
+    def message_count(self, user_id):
+        """How many of `user_id`'s messages are archived."""
+
+        return self._catalog()[1].get(user_id, 0)
+
+    def message_counts(self):
+        """{user_id: archived message count} for everyone with messages archived."""
+
+        return dict(self._catalog()[1])
+
+    def user_messages(self, user_id, limit, before=None):
+        """Up to `limit` of `user_id`'s archived messages with ids below `before`, newest first."""
+
+        found = []
+        months, counts = self._catalog()
+        if user_id not in counts:
+            return found
+
+        for month in months:
+            if before is not None and self.index(month)['min_id'] >= before:
+                continue
+
+            for message in self._read_frame(month, user_id):
+                if before is None or message['id'] < before:
+                    found.append(message)
+                    if len(found) == limit:
+                        return found
+
+        return found
+
+    def iter_user_messages(self, user_id, after=None):
+        """All of `user_id`'s archived messages with ids above `after`, oldest first."""
+
+        months, counts = self._catalog()
+        if user_id not in counts:
+            return
+
+        for month in reversed(months):
+            if after is not None and self.index(month)['max_id'] <= after:
+                continue
+
+            for message in reversed(self._read_frame(month, user_id)):
+                if after is None or message['id'] > after:
+                    yield message
+
+
+archive = MessageArchive()
+
+
+def _stream(query):
+    """Yield rows of `query` from a server-side cursor, FETCH_SIZE at a time."""
+
+    result = db.session.execute(query.execution_options(stream_results=True))
+
+    try:
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        result.close()
+
+
+def write_month(month, directory):
+    """Copy `month`'s messages into the archive. Returns how many there were."""
+
+    os.makedirs(directory, exist_ok=True)
+    low, high = partitions.month_bounds(month)
+    name = _month_name(month)
+    data_path = os.path.join(directory, f"{name}.ndjson.zst")
+    index_path = os.path.join(directory, f"{name}.index.json")
+
+    query = (db.select([getattr(Message, field) for field in FIELDS])
+             .where(db.and_(Message.id >= low, Message.id < high))
+             .order_by(Message.user_id, Message.id.desc()))
+
+    compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+    users = {}
+    offset = 0
+    total = 0
+
+    with open(f"{data_path}.tmp", 'wb') as out:
+        for user_id, rows in itertools.groupby(_stream(query), key=lambda row: row.user_id):
+            lines = [json.dumps(dict(zip(FIELDS, row)), default=datetime.isoformat)
+                     for row in rows]
+            frame = compressor.compress(("\n".join(lines) + "\n").encode('utf-8'))
+            out.write(frame)
+            users[str(user_id)] = [offset, len(frame), len(lines)]
+            offset += len(frame)
+            total += len(lines)
+        out.flush()
+        os.fsync(out.fileno())
+
+    related = {}
+    for related_name, (model, fields) in RELATED.items():
+        column = model.message_id
+        query = (db.select([getattr(model, field) for field in fields])
+                 .where(db.and_(column >= low, column < high))
+                 .order_by(column))
+        related[related_name] = _write_ndjson(
+            os.path.join(directory, f"{name}.{related_name}.ndjson.zst"),
+            (dict(zip(fields, row)) for row in _stream(query)))
+
+    os.replace(f"{data_path}.tmp", data_path)
+    _write_index(index_path, dict(month=name, min_id=low, max_id=high - 1, count=total,
+                                  users=users, related=related))
+    return total
+
+
+def _write_ndjson(path, rows):
+    """Write dicts to `path` as one zstd frame of NDJSON, atomically. Returns how many."""
+
+    compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+    count = 0
+
+    with open(f"{path}.tmp", 'wb') as out:
+        with compressor.stream_writer(out, closefd=False) as writer:
+            for row in rows:
+                writer.write((json.dumps(row) + "\n").encode('utf-8'))
+                count += 1
+        out.flush()
+        os.fsync(out.fileno())
+
+    os.replace(f"{path}.tmp", path)
+    return count
+
+
+def _write_index(path, index):
+    """Write a month's index atomically; once it's in place the month is archived as it says."""
+
+    with open(f"{path}.tmp", 'w') as out:
+        json.dump(index, out)
+        out.flush()
+        os.fsync(out.fileno())
+
+    os.replace(f"{path}.tmp", path)
+
+
+def _recount_older_parents(low, high, batch_size):
+    """Stop counting replies in [low, high) towards parents older than it, which stay.
+
+    The replies themselves keep their place in the thread, as when a message
+    is deleted (see threads.py). Counts are recomputed rather than
+    decremented, so an interrupted drop can be re-run.
+    """
+
+    reply = aliased(Message)
+    after = None
+
+    while True:
+        query = (db.session
+                 .query(Message.parent_id)
+                 .filter(Message.id >= low, Message.id < high, Message.parent_id < low))
+        if after is not None:
+            query = query.filter(Message.parent_id > after)
+        parent_ids = [parent_id for (parent_id,) in
+                      query.distinct().order_by(Message.parent_id).limit(batch_size)]
+        if not parent_ids:
+            return
+
+        remaining = (db.select([db.func.count()])
+                     .where(db.and_(reply.parent_id == Message.id,
+                                    db.or_(reply.id < low, reply.id >= high)))
+                     .as_scalar())
+        (Message.query
+         .filter(Message.id.in_(parent_ids))
+         .update({Message.reply_count: remaining}, synchronize_session=False))
+        db.session.commit()
+        after = parent_ids[-1]
+
+
+def drop_month(month, batch_size=DEFAULT_BATCH_SIZE):
+    """Delete an archived month's messages, and the rows pointing at them, from the database."""
+
+    low, high = partitions.month_bounds(month)
+
+    _recount_older_parents(low, high, batch_size)
+
+    for model, key, column in ((Likes, Likes.id, Likes.message_id),
+                               (MessageTag, MessageTag.tag, MessageTag.message_id),
+                               (Mention, Mention.user_id, Mention.message_id)):
+        for _ in _delete_in_batches(model, key, db.and_(column >= low, column < high),
+                                    batch_size):
+            pass
+
+    for _ in _delete_in_batches(Notification, Notification.id,
+                                db.and_(Notification.kind == notifications.LIKE,
+                                        Notification.target_id >= low,
+                                        Notification.target_id < high), batch_size):
+        pass
+
+    with db.engine.begin() as connection:
+        if partitions.is_partitioned(connection):
+            # Rows in the default partition (see partitions.py) are left for the DELETEs.
+            partitions.drop_partition(connection, month)
+
+    for _ in _delete_in_batches(Message, Message.id,
+                                db.and_(Message.id >= low, Message.id < high), batch_size):
+        pass
+
+
+def archive_old_months(directory, retention_months=RETENTION_MONTHS,
+                       batch_size=DEFAULT_BATCH_SIZE, now=None, report=print):
+    """Archive, then drop, every month of messages older than `retention_months`."""
+
+    cutoff = partitions.add_months(partitions.month_start(now or datetime.utcnow()),
+                                   -retention_months)
+
+    while True:
+        oldest = db.session.query(db.func.min(Message.id)).scalar()
+        if oldest is None or partitions.month_for_id(oldest) >= cutoff:
+            return
+
+        month = partitions.month_for_id(oldest)
+        # Already archived if a drop was interrupted last time; just finish it.
+        if not os.path.exists(os.path.join(directory, f"{_month_name(month)}.index.json")):
+            count = write_month(month, directory)
+            report(f"Archived {count} messages from {_month_name(month)}")
+        drop_month(month, batch_size)
+        report(f"Dropped {_month_name(month)} from the database")
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    app = create_app()
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--retention-months', type=int, default=RETENTION_MONTHS)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    with app.app_context():
+        archive_old_months(app.config['ARCHIVE_DIR'], args.retention_months, args.batch_size)
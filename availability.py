@@ -0,0 +1,178 @@
+"""Username / email availability checks backed by Bloom filters.
+
+Most names people try at signup are free, so checking them against an
+in-memory Bloom filter answers "available" without touching the database
+(or hashing a password). Only when the filter says "maybe taken" do we run
+an exact indexed lookup.
+
+Filters are loaded from `users` by `warm_up` (or on first use), then kept current by `add`
+(called on signup and profile edits in this process) and by a periodic
+incremental `refresh` that picks up users created by other workers, and users
+renamed by them (`users.renamed_at`). When a filter outgrows its capacity it
+is rebuilt, twice as large, in batches; one rebuild runs at a time, and names
+added while it runs are carried over.
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bloom import BloomFilter
+from models import db, User
+
+INITIAL_CAPACITY = 100000
+ERROR_RATE = 0.01
+LOAD_BATCH_SIZE = 10000
+REFRESH_INTERVAL = 30
+# Renames are re-read this far back, to allow for clock skew between hosts.
+RENAME_OVERLAP = timedelta(minutes=5)
+
+
+class AvailabilityService:
+    """Answers whether usernames and emails are free to register."""
+
+    def __init__(self, capacity=INITIAL_CAPACITY, error_rate=ERROR_RATE,
+                 refresh_interval=REFRESH_INTERVAL):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self._usernames = None
+        self._emails = None
+        self._loaded_through = 0
+        self._renames_since = None
+        self._refreshed_at = 0
+        # Names added while a rebuild runs, to copy into the new filters.
+        self._added_during_rebuild = None
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.RLock()
+
+    def _load_users(self, usernames, emails, after_id):
+        """Add users with id > `after_id` to the filters; returns the last id seen."""
+
+        while True:
+            batch = (db.session
+                     .query(User.id, User.username, User.email)
+                     .filter(User.id > after_id)
+                     .order_by(User.id)
+                     .limit(LOAD_BATCH_SIZE)
+                     .all())
+
+            if not batch:
+                return after_id
+
+            for user_id, username, email in batch:
+                usernames.add(username)
+                emails.add(email)
+
+            after_id = batch[-1][0]
+
+    def _load_renames(self, usernames, emails, since):
+        """Add users renamed at or after `since` to the filters; returns when this load began."""
+
+        started = datetime.utcnow()
+
+        for username, email in (db.session
+                                .query(User.username, User.email)
+                                .filter(User.renamed_at >= since - RENAME_OVERLAP)):
+            usernames.add(username)
+            emails.add(email)
+
+        return started
+
+    def rebuild(self):
+        """Build fresh filters from every user, sized for the current user count."""
+
+        with self._rebuild_lock:
+            with self._lock:
+                self._added_during_rebuild = []
+
+            try:
+                capacity = self.capacity
+                total = db.session.query(db.func.count(User.id)).scalar()
+                while capacity < total * 2:
+                    capacity *= 2
+
+                usernames = BloomFilter(capacity, self.error_rate)
+                emails = BloomFilter(capacity, self.error_rate)
+                renames_since = datetime.utcnow()
+                loaded_through = self._load_users(usernames, emails, 0)
+
+                with self._lock:
+                    for username, email in self._added_during_rebuild:
+                        usernames.add(username)
+                        emails.add(email)
+                    self.capacity = capacity
+                    self._usernames = usernames
+                    self._emails = emails
+                    self._loaded_through = loaded_through
+                    self._renames_since = renames_since
+                    self._refreshed_at = time.monotonic()
+            finally:
+                with self._lock:
+                    self._added_during_rebuild = None
+
+    def refresh(self, force=False):
+        """Pick up users created or renamed since the last load (e.g. by other workers)."""
+
+        if self._usernames is None or self._usernames.saturated:
+            with self._rebuild_lock:
+                # Unless another thread rebuilt them while we waited.
+                if self._usernames is None or self._usernames.saturated:
+                    self.rebuild()
+            return
+
+        if not force and time.monotonic() - self._refreshed_at < self.refresh_interval:
+            return
+
+        with self._lock:
+            loaded_through = self._loaded_through
+            renames_since = self._renames_since
+            # Other threads skip their own refresh while this one runs.
+            self._refreshed_at = time.monotonic()
+
+        # Query outside the lock, so lookups and `add`s don't wait on the
+        # database; only the new names go into the filters under it.
+        usernames, emails = set(), set()
+        loaded_through = self._load_users(usernames, emails, loaded_through)
+        renames_since = self._load_renames(usernames, emails, renames_since)
+
+        with self._lock:
+            for username in usernames:
+                self._usernames.add(username)
+            for email in emails:
+                self._emails.add(email)
+            self._loaded_through = max(self._loaded_through, loaded_through)
+            self._renames_since = max(self._renames_since, renames_since)
+
+    def add(self, username, email):
+        """Record a username and email as taken."""
+
+        with self._lock:
+            if self._added_during_rebuild is not None:
+                self._added_during_rebuild.append((username, email))
+            if self._usernames is not None:
+                self._usernames.add(username)
+                self._emails.add(email)
+
+    def username_available(self, username):
+        """Is nobody registered as `username`?"""
+
+        self.refresh()
+
+        if username not in self._usernames:
+            return True
+
+        return not db.session.query(User.query.filter_by(username=username).exists()).scalar()
+
+    def email_available(self, email):
+        """Is nobody registered with `email`?"""
+
+        self.refresh()
+
+        if email not in self._emails:
+            return True
+
+        return not db.session.query(User.query.filter_by(email=email).exists()).scalar()
+
+
+availability = AvailabilityService()
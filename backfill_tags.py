@@ -0,0 +1,55 @@
+"""Index hashtags and mentions for messages posted before tag indexing existed.
+
+    python backfill_tags.py [--batch-size 1000]
+
+Walks `messages` in id order, one batch per transaction, replacing the tag
+and mention rows for each batch, so it's safe to stop and re-run.
+"""
+
+import argparse
+
+from app import create_app
+from models import db, Message, MessageTag, Mention
+from tags import index_messages
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def backfill(batch_size=DEFAULT_BATCH_SIZE):
+    """Re-index all messages; returns how many were processed."""
+
+    last_id = None
+    processed = 0
+
+    while True:
+        query = Message.query.order_by(Message.id)
+        if last_id is not None:
+            query = query.filter(Message.id > last_id)
+        batch = query.limit(batch_size).all()
+
+        if not batch:
+            break
+
+        ids = [message.id for message in batch]
+        MessageTag.query.filter(MessageTag.message_id.in_(ids)).delete(synchronize_session=False)
+        Mention.query.filter(Mention.message_id.in_(ids)).delete(synchronize_session=False)
+        index_messages(batch)
+        db.session.commit()
+        db.session.expunge_all()
+
+        last_id = ids[-1]
+        processed += len(batch)
+        print(f"Indexed {processed} messages (through id {last_id})")
+
+    return processed
+
+
+if __name__ == '__main__':
+    app = create_app()
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    with app.app_context():
+        backfill(args.batch_size)
@@ -0,0 +1,105 @@
+"""Benchmark cold start, warm-up and fork times.
+
+Each measurement runs in a fresh interpreter so imports and template
+compilation are genuinely cold:
+
+    python benchmarks/startup_benchmark.py
+
+Reports, in milliseconds:
+
+- import: importing the `app` module, which defines the factory but
+  builds no app
+- create_app: building the app from the factory, as gunicorn does with
+  `app:create_app()`
+- warm_up: compiling templates, mappers and hot queries
+- first template: loading the signup template in a brand new app, with
+  an empty vs. a filled Jinja bytecode cache
+- fork: forking a worker from the warmed process until it has loaded its
+  first template
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPEAT = 5
+
+PROBE = r'''
+import json, os, sys, time
+sys.path.insert(0, ROOT)
+
+start = time.perf_counter()
+import app as app_module
+timings = {'import': time.perf_counter() - start}
+
+start = time.perf_counter()
+app = app_module.create_app()
+timings['create_app'] = time.perf_counter() - start
+
+start = time.perf_counter()
+app.jinja_env.get_template('users/signup.html')
+timings['first template'] = time.perf_counter() - start
+
+start = time.perf_counter()
+app_module.warm_up(app)
+timings['warm_up'] = time.perf_counter() - start
+
+read_end, write_end = os.pipe()
+start = time.perf_counter()
+pid = os.fork()
+if pid == 0:
+    app.jinja_env.get_template('users/login.html')
+    os.write(write_end, b'x')
+    os._exit(0)
+os.read(read_end, 1)
+timings['fork'] = time.perf_counter() - start
+os.waitpid(pid, 0)
+
+print(json.dumps({k: v * 1000 for k, v in timings.items()}))
+'''
+
+
+def probe(cache_dir):
+    """Run PROBE in a fresh interpreter; returns its timings."""
+
+    env = dict(os.environ,
+               JINJA_BYTECODE_CACHE_DIR=cache_dir,
+               DATABASE_URL=os.environ.get('DATABASE_URL', 'sqlite://'))
+    out = subprocess.run([sys.executable, '-c', f"ROOT = {ROOT!r}\n" + PROBE],
+                         env=env, check=True, capture_output=True, text=True).stdout
+
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def best(runs, key):
+    """Fastest of `runs` for step `key`."""
+
+    return min(run[key] for run in runs)
+
+
+def main():
+    cache_dir = tempfile.mkdtemp(prefix='warbler-jinja-')
+
+    try:
+        cold = []
+        for i in range(REPEAT):
+            shutil.rmtree(cache_dir)
+            os.makedirs(cache_dir)
+            cold.append(probe(cache_dir))
+
+        # The last cold run left a full cache behind.
+        warm = [probe(cache_dir) for i in range(REPEAT)]
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print(f"{'step':<14} {'empty cache':>12} {'full cache':>12}")
+    for key in ['import', 'create_app', 'first template', 'warm_up', 'fork']:
+        print(f"{key:<14} {best(cold, key):>10.1f}ms {best(warm, key):>10.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
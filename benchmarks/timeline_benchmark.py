@@ -0,0 +1,125 @@
+"""Benchmark the IN-query and k-way merge home timeline engines.
+
+Builds a throwaway database of authors and messages, then times both engines
+(cold and warm merge cache) for readers following more and more authors, and
+reports the smallest follow count at which merging wins. Use the result to set
+TIMELINE_MERGE_THRESHOLD.
+
+    BENCH_DATABASE_URL=postgresql:///warbler_bench python benchmarks/timeline_benchmark.py
+
+The database at BENCH_DATABASE_URL is DROPPED and recreated.
+"""
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from random import randint, seed
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL',
+                                            'sqlite:////tmp/warbler_bench.db')
+
+from app import create_app, TIMELINE_PAGE_SIZE
+from models import db, User, Message
+from partitions import ensure_partitions, is_partitioned
+from snowflake import EPOCH, TIMESTAMP_SHIFT, SEQUENCE_BITS, MAX_WORKER_ID
+from timeline import in_query_timeline, merged_timeline, AuthorTimelineCache
+
+NUM_AUTHORS = 5000
+MESSAGES_PER_AUTHOR = 40
+FOLLOW_COUNTS = [10, 50, 100, 250, 500, 1000, 2000, 5000]
+REPEAT = 5
+
+
+def build_database():
+    """Create NUM_AUTHORS authors with MESSAGES_PER_AUTHOR messages each."""
+
+    db.drop_all()
+    db.create_all()
+
+    with db.engine.begin() as connection:
+        if is_partitioned(connection):
+            ensure_partitions(connection, since=datetime.utcnow() - timedelta(days=91))
+
+    db.session.bulk_insert_mappings(User, [
+        dict(id=i, username=f"author{i}", email=f"author{i}@bench.test", password="x")
+        for i in range(1, NUM_AUTHORS + 1)
+    ])
+
+    seed(0)
+    now_ms = int(time.time() * 1000) - EPOCH
+    rows = []
+    for author in range(1, NUM_AUTHORS + 1):
+        for n in range(MESSAGES_PER_AUTHOR):
+            ms = now_ms - randint(0, 90 * 24 * 3600 * 1000)
+            message_id = ((ms << TIMESTAMP_SHIFT)
+                          | ((author & MAX_WORKER_ID) << SEQUENCE_BITS)
+                          | n)
+            rows.append(dict(id=message_id,
+                             text=f"message {n} from {author}",
+                             user_id=author))
+
+        if len(rows) >= 50000:
+            db.session.bulk_insert_mappings(Message, rows)
+            rows = []
+
+    db.session.bulk_insert_mappings(Message, rows)
+    db.session.commit()
+
+
+def best_time(fn):
+    """Best wall-clock time of REPEAT calls to `fn`, in milliseconds."""
+
+    times = []
+    for i in range(REPEAT):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return min(times) * 1000
+
+
+def main():
+    build_database()
+
+    print(f"{'following':>10} {'IN query':>10} {'merge cold':>11} {'merge warm':>11}")
+
+    crossover = {'cold': None, 'warm': None}
+
+    for count in FOLLOW_COUNTS:
+        author_ids = list(range(1, count + 1))
+
+        in_query = best_time(lambda: in_query_timeline(author_ids, TIMELINE_PAGE_SIZE))
+        cold = best_time(lambda: merged_timeline(author_ids, TIMELINE_PAGE_SIZE,
+                                                 cache=AuthorTimelineCache()))
+
+        warm_cache = AuthorTimelineCache()
+        merged_timeline(author_ids, TIMELINE_PAGE_SIZE, cache=warm_cache)
+        warm = best_time(lambda: merged_timeline(author_ids, TIMELINE_PAGE_SIZE,
+                                                 cache=warm_cache))
+
+        assert ([m.id for m in in_query_timeline(author_ids, TIMELINE_PAGE_SIZE)]
+                == [m.id for m in merged_timeline(author_ids, TIMELINE_PAGE_SIZE,
+                                                  cache=warm_cache)])
+
+        for name, merge_time in [('cold', cold), ('warm', warm)]:
+            if crossover[name] is None and merge_time < in_query:
+                crossover[name] = count
+
+        print(f"{count:>10} {in_query:>9.1f}ms {cold:>9.1f}ms {warm:>9.1f}ms")
+
+    print()
+    for name, count in crossover.items():
+        if count:
+            print(f"Merge engine ({name} cache) is faster from {count} follows up")
+        else:
+            print(f"Merge engine ({name} cache) never beat the IN query")
+
+
+if __name__ == '__main__':
+    app = create_app()
+
+    with app.app_context():
+        main()
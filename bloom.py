@@ -0,0 +1,59 @@
+"""A simple Bloom filter.
+
+Answers "have I seen this string?" with no false negatives and a tunable
+false-positive rate, in a fixed amount of memory (about 1.2 bytes per item
+at a 1% error rate).
+"""
+
+import math
+from hashlib import blake2b
+
+
+class BloomFilter:
+    """Bloom filter over strings, sized for `capacity` items at `error_rate`."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def __repr__(self):
+        return (f"<BloomFilter {self.count}/{self.capacity} items, "
+                f"{self.num_bits} bits, {self.num_hashes} hashes>")
+
+    def _positions(self, item):
+        """Bit positions for `item`, by double hashing one 128-bit digest."""
+
+        digest = blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        """Add `item` to the filter."""
+
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+        self.count += 1
+
+    def __contains__(self, item):
+        """False if `item` was definitely never added; True if it probably was."""
+
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    @property
+    def saturated(self):
+        """Has the filter taken more items than it was sized for?"""
+
+        return self.count > self.capacity
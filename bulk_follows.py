@@ -0,0 +1,174 @@
+"""Following many accounts at once.
+
+Onboarding follows dozens or hundreds of suggested accounts, and people
+import follow lists from CSV. `follow_many` does a whole batch in a handful
+of statements, however big it is:
+
+- the targets (user ids and/or usernames) are resolved in one query;
+  duplicates, unknown or deleted users and the follower themselves are
+  skipped. All-digit targets (say, from a CSV) could be either: they're
+  looked up both ways, and an id match wins.
+- the new edges go in with one multi-row INSERT that ignores edges which
+  already exist (ON CONFLICT DO NOTHING on Postgres, INSERT OR IGNORE on
+  SQLite). Targets the follower has follows or unfollows of queued in the
+  write-behind journal (see write_behind.py) are queued after them
+  instead, so the order of the changes is kept.
+- the shared follow graph gets every new edge in one append, and the
+  followed users are notified through the usual batched queue
+
+Home timelines need nothing more: they read following ids from the graph
+and fetch any authors missing from the timeline cache in one query.
+
+Every requested target gets a `FollowResult`, in request order.
+"""
+
+import csv
+import io
+from collections import namedtuple
+
+from sqlalchemy.dialects import postgresql
+
+import follow_graph
+import notifications
+from models import db, Follows, User
+from write_behind import FOLLOW, write_queue
+
+FOLLOWED = 'followed'
+ALREADY_FOLLOWING = 'already_following'
+DUPLICATE = 'duplicate'
+NOT_FOUND = 'not_found'
+SELF = 'self'
+
+MAX_TARGETS = 1000
+
+FollowResult = namedtuple('FollowResult', ['target', 'user_id', 'status'])
+
+
+def parse_target(value):
+    """A target as ('id', int), ('username', str) or, for digits, ('id_or_username', str).
+
+    '@name' is always a username.
+    """
+
+    if isinstance(value, int):
+        return 'id', value
+
+    value = str(value).strip()
+    if value.isdigit():
+        return 'id_or_username', value
+
+    return 'username', value.lstrip('@')
+
+
+def targets_from_csv(text):
+    """Targets from the first column of a CSV, skipping a header row and blank cells."""
+
+    targets = []
+
+    for row in csv.reader(io.StringIO(text)):
+        cell = row[0].strip() if row else ''
+        if not cell or (not targets and cell.lower() in ('id', 'user_id', 'username')):
+            continue
+        targets.append(cell)
+
+    return targets
+
+
+def _insert_ignoring_existing(rows):
+    """Insert follow rows in one statement, skipping any that already exist."""
+
+    table = Follows.__table__
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        statement = postgresql.insert(table).values(rows).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        statement = table.insert().values(rows).prefix_with('OR IGNORE')
+    else:
+        statement = table.insert().values(rows)
+
+    db.session.execute(statement)
+
+
+def follow_many(follower_id, targets, app=None):
+    """Have `follower_id` follow every user in `targets` (ids or usernames).
+
+    Returns a `FollowResult` per target. Raises ValueError for more than
+    MAX_TARGETS targets.
+    """
+
+    if len(targets) > MAX_TARGETS:
+        raise ValueError(f"At most {MAX_TARGETS} users can be followed at once")
+
+    parsed = [parse_target(target) for target in targets]
+    ids = {int(key) for kind, key in parsed if kind != 'username'}
+    usernames = {key for kind, key in parsed if kind != 'id'}
+
+    found = (db.session
+             .query(User.id, User.username)
+             .filter(User.deleted_at.is_(None),
+                     db.or_(User.id.in_(ids), User.username.in_(usernames)))
+             .all()) if parsed else []
+    by_id = {user_id: user_id for user_id, _ in found}
+    by_username = {username: user_id for user_id, username in found}
+
+    found_ids = list(by_id)
+    following = {followed_id for (followed_id,) in
+                 (db.session
+                  .query(Follows.user_being_followed_id)
+                  .filter(Follows.user_following_id == follower_id,
+                          Follows.user_being_followed_id.in_(found_ids)))} if found_ids else set()
+    pending = write_queue.pending(follower_id, FOLLOW)
+
+    results = []
+    seen = set()
+    new_edges = []
+    # Follows or unfollows already queued: queue this follow after them.
+    queued = []
+
+    for target, (kind, key) in zip(targets, parsed):
+        if kind == 'id':
+            user_id = by_id.get(key)
+        elif kind == 'username':
+            user_id = by_username.get(key)
+        else:
+            user_id = by_id.get(int(key), by_username.get(key))
+
+        if user_id is None:
+            status = NOT_FOUND
+        elif user_id == follower_id:
+            status = SELF
+        elif user_id in seen:
+            status = DUPLICATE
+        elif pending.get(user_id, user_id in following):
+            status = ALREADY_FOLLOWING
+        else:
+            status = FOLLOWED
+            if user_id in pending:
+                queued.append(user_id)
+            else:
+                new_edges.append((follower_id, user_id))
+
+        if user_id is not None:
+            seen.add(user_id)
+        results.append(FollowResult(target, user_id, status))
+
+    if new_edges:
+        _insert_ignoring_existing([dict(user_following_id=follower_id, user_being_followed_id=followed_id)
+                                   for _, followed_id in new_edges])
+    db.session.commit()
+
+    if queued and app is not None:
+        write_queue.ensure_running(app)
+    for followed_id in queued:
+        write_queue.submit(FOLLOW, follower_id, followed_id, True, app)
+
+    if follow_graph.graph.available:
+        if follow_graph.graph.record_many(follow_graph.ADD, new_edges) and app is not None:
+            follow_graph.compact_in_background(app)
+
+    for result in results:
+        if result.status == FOLLOWED:
+            notifications.queue.enqueue(result.user_id, notifications.FOLLOW, follower_id)
+
+    return results
@@ -0,0 +1,271 @@
+"""Compressing responses.
+
+Each app's `ResponseCompressor` (at `app.extensions['compression']`)
+compresses, in an after-request hook, text-like responses of at least
+`min_size` bytes with the best encoding the client accepts: zstd, then
+brotli, then gzip, at a level picked for the content type (LEVELS). Streamed responses, like exports, are compressed a
+chunk at a time as they're sent, flushing after each chunk so the stream
+stays live.
+
+Bodies that don't change between requests are only compressed once:
+
+- static files, per file and modification time, at the highest levels
+- responses a view has marked with `shared_body(key)`, whose body is the
+  same for every request with that key (e.g. the anonymous homepage, keyed
+  on the firehose's version)
+
+The compressed bytes are kept in a small LRU. Responses per encoding, bytes
+in and out, CPU time spent compressing and reuse hits are reported at
+/metrics.
+
+Responses carrying a CSRF token (any page that rendered a form) are sent
+uncompressed: with the token next to text the requester controls (a
+reflected search term, say), compressed sizes would leak the token a
+guess at a time (BREACH).
+"""
+
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import brotli
+import zstandard
+from flask import current_app, g, request
+from werkzeug.security import safe_join
+
+# Server preference, best first, among the encodings a client accepts equally.
+ENCODINGS = ('zstd', 'br', 'gzip')
+MIN_SIZE = 1024
+CACHE_SIZE = 64
+
+COMPRESSIBLE = ('text/', 'application/json', 'application/javascript',
+                'application/x-ndjson', 'application/xml', 'image/svg+xml')
+
+# Pages are compressed once per request, so a moderate level; JSON and
+# streamed exports are cheaper to send than to squeeze hard.
+LEVELS = {
+    'text/html': {'zstd': 6, 'br': 5, 'gzip': 6},
+    'application/json': {'zstd': 3, 'br': 4, 'gzip': 5},
+    'application/x-ndjson': {'zstd': 3, 'br': 4, 'gzip': 5},
+    'text/csv': {'zstd': 3, 'br': 4, 'gzip': 5},
+}
+DEFAULT_LEVELS = {'zstd': 3, 'br': 4, 'gzip': 6}
+# Compressed once and reused: worth the slowest levels.
+REUSED_LEVELS = {'zstd': 19, 'br': 11, 'gzip': 9}
+
+
+def negotiate(accept_encoding):
+    """The encoding to use for an Accept-Encoding header, or None for identity."""
+
+    weights = {}
+
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name] = weight
+
+    default = weights.get('*', 0.0)
+    best = max(ENCODINGS, key=lambda name: weights.get(name, default))
+    return best if weights.get(best, default) > 0 else None
+
+
+def compress(data, encoding, level):
+    """`data` compressed as one `encoding` body."""
+
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _stream_compressor(encoding, level):
+    """(compress, flush, finish) functions for compressing a stream."""
+
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        return (compressor.compress,
+                lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+                compressor.flush)
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        return compressor.process, compressor.flush, compressor.finish
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return (compressor.compress,
+            lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush)
+
+
+def has_csrf_token():
+    """Was a CSRF token generated (so, likely rendered) for this request?"""
+
+    return g.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')) is not None
+
+
+def shared_body(key):
+    """Mark this request's response body as the same for every request with `key`."""
+
+    g.compression_key = key
+
+
+class ResponseCompressor:
+    """Negotiates, compresses and counts; compressed bodies are reused from an LRU."""
+
+    def __init__(self, min_size=MIN_SIZE, cache_size=CACHE_SIZE):
+        self.min_size = min_size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.responses = dict.fromkeys(ENCODINGS, 0)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+        self.reused = 0
+
+    def configure(self, min_size):
+        """Compress bodies of at least `min_size` bytes; None turns compression off."""
+
+        self.min_size = min_size
+        with self._lock:
+            self._cache.clear()
+
+    def _count(self, size_in, size_out, cpu_seconds):
+        with self._lock:
+            self.bytes_in += size_in
+            self.bytes_out += size_out
+            self.cpu_seconds += cpu_seconds
+
+    def _compress(self, data, encoding, level):
+        started = time.thread_time()
+        compressed = compress(data, encoding, level)
+        self._count(len(data), len(compressed), time.thread_time() - started)
+        return compressed
+
+    def _reuse(self, key, encoding, load, level):
+        """The compressed body cached under `key`, compressing `load()` on a miss."""
+
+        with self._lock:
+            compressed = self._cache.get((key, encoding))
+            if compressed is not None:
+                self._cache.move_to_end((key, encoding))
+                self.reused += 1
+                return compressed
+
+        data = load()
+        compressed = self._compress(data, encoding, level)
+
+        with self._lock:
+            self._cache[(key, encoding)] = compressed
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return compressed
+
+    def _stream(self, chunks, encoding, level):
+        """Compress an iterable of chunks as it's consumed."""
+
+        compress_chunk, flush, finish = _stream_compressor(encoding, level)
+
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                started = time.thread_time()
+                data = compress_chunk(chunk) + flush()
+                self._count(len(chunk), len(data), time.thread_time() - started)
+                if data:
+                    yield data
+
+            data = finish()
+            self._count(0, len(data), 0.0)
+            yield data
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+    def compress_response(self, response):
+        """Compress `response` for this request's client, if it's worth it."""
+
+        if (self.min_size is None or response.status_code != 200
+                or 'Content-Encoding' in response.headers
+                or not response.mimetype.startswith(COMPRESSIBLE)
+                or 'no-transform' in response.headers.get('Cache-Control', '')
+                or has_csrf_token()):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return response
+
+        levels = LEVELS.get(response.mimetype, DEFAULT_LEVELS)
+
+        if response.direct_passthrough:
+            # Only static files are known not to change under the same name.
+            if request.endpoint != 'static':
+                return response
+            path = safe_join(current_app.static_folder, request.view_args['filename'])
+            stat = os.stat(path)
+            if stat.st_size < self.min_size:
+                return response
+
+            def load():
+                with open(path, 'rb') as f:
+                    return f.read()
+
+            body = self._reuse(('static', path, stat.st_mtime_ns), encoding, load,
+                               REUSED_LEVELS[encoding])
+            response.response.close()
+            response.direct_passthrough = False
+            response.set_data(body)
+            # Same content, different bytes: a weak ETag still matches for 304s.
+            etag, _ = response.get_etag()
+            if etag:
+                response.set_etag(etag, weak=True)
+
+        elif response.is_streamed:
+            response.response = self._stream(response.response, encoding, levels[encoding])
+            response.headers.pop('Content-Length', None)
+
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            key = g.get('compression_key')
+            if key is not None:
+                body = self._reuse(key, encoding, lambda: data, REUSED_LEVELS[encoding])
+            else:
+                body = self._compress(data, encoding, levels[encoding])
+            response.set_data(body)
+
+        response.headers['Content-Encoding'] = encoding
+        with self._lock:
+            self.responses[encoding] += 1
+
+        return response
+
+    def stats(self):
+        """Counters for monitoring."""
+
+        with self._lock:
+            stats = {f"responses_{encoding}": count for encoding, count in self.responses.items()}
+            stats.update(bytes_in=self.bytes_in, bytes_out=self.bytes_out,
+                         bytes_saved=self.bytes_in - self.bytes_out,
+                         cpu_seconds=round(self.cpu_seconds, 6), reused=self.reused,
+                         cached=len(self._cache))
+            return stats
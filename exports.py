@@ -0,0 +1,190 @@
+"""Streaming export of a user's messages, likes and follows.
+
+Rows are read through server-side cursors in batches and written out as
+they arrive, so memory use stays flat however big the account is. The
+export is one stream with four sections, in order:
+
+    messages    the user's own messages, by id
+    likes       messages the user liked, by message id
+    following   users they follow, by user id
+    followers   users following them, by user id
+
+Every record carries a `cursor` ("<section>:<key>"); pass the last one
+received as `?cursor=` to resume an interrupted export just after it.
+
+Archived messages (see archive.py) come first in the messages section:
+they're all older than the ones still in the database. A month that's been
+archived but not yet dropped from the database is only exported once.
+"""
+
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+
+from archive import archive
+from models import db, Follows, Likes, Message, User
+
+SECTIONS = ('messages', 'likes', 'following', 'followers')
+FETCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+
+CSV_FIELDS = ('type', 'cursor', 'id', 'text', 'timestamp', 'user_id', 'username')
+
+
+def parse_cursor(cursor):
+    """Split "<section>:<key>" into (section, key); raises ValueError if malformed."""
+
+    section, _, key = (cursor or '').partition(':')
+    if section not in SECTIONS:
+        raise ValueError(f"Unknown export section {section!r}")
+
+    return section, int(key)
+
+
+def _stream(query):
+    """Yield rows of `query` from a server-side cursor, FETCH_SIZE at a time."""
+
+    result = db.session.execute(query.execution_options(stream_results=True))
+
+    try:
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        result.close()
+
+
+def _queries(user_id):
+    """{section: (key column, select of (key, record fields...))} for `user_id`."""
+
+    liked = db.select([Likes.message_id, Message.text, Message.timestamp,
+                       User.id, User.username]).select_from(
+        db.join(Likes, Message, Likes.message_id == Message.id)
+        .join(User, Message.user_id == User.id)).where(
+        db.and_(Likes.user_id == user_id, User.deleted_at.is_(None)))
+
+    following = db.select([Follows.user_being_followed_id, User.username]).select_from(
+        db.join(Follows, User, Follows.user_being_followed_id == User.id)).where(
+        db.and_(Follows.user_following_id == user_id, User.deleted_at.is_(None)))
+
+    followers = db.select([Follows.user_following_id, User.username]).select_from(
+        db.join(Follows, User, Follows.user_following_id == User.id)).where(
+        db.and_(Follows.user_being_followed_id == user_id, User.deleted_at.is_(None)))
+
+    return {
+        'messages': (Message.id, db.select([Message.id, Message.text, Message.timestamp])
+                     .where(Message.user_id == user_id)),
+        'likes': (Likes.message_id, liked),
+        'following': (Follows.user_being_followed_id, following),
+        'followers': (Follows.user_following_id, followers),
+    }
+
+
+def _record(section, row):
+    """Turn a row from `section`'s query into an export record."""
+
+    if section == 'messages':
+        id, text, timestamp = row
+        return dict(type='message', id=id, text=text, timestamp=timestamp.isoformat())
+
+    if section == 'likes':
+        id, text, timestamp, user_id, username = row
+        return dict(type='like', id=id, text=text, timestamp=timestamp.isoformat(),
+                    user_id=user_id, username=username)
+
+    user_id, username = row
+    return dict(type=section, id=user_id, user_id=user_id, username=username)
+
+
+def _messages(user_id, key, query, after):
+    """Message rows after id `after`: archived ones, then the database's after those."""
+
+    for message in archive.iter_user_messages(user_id, after):
+        after = message['id']
+        yield message['id'], message['text'], datetime.fromisoformat(message['timestamp'])
+
+    yield from _stream(query.order_by(key) if after is None
+                       else query.where(key > after).order_by(key))
+
+
+def export_records(user_id, cursor=None):
+    """Yield `user_id`'s export records in order, starting after `cursor` if given."""
+
+    start, after = parse_cursor(cursor) if cursor else (SECTIONS[0], None)
+    queries = _queries(user_id)
+
+    for section in SECTIONS[SECTIONS.index(start):]:
+        key, query = queries[section]
+        section_after = after if section == start else None
+
+        if section == 'messages':
+            rows = _messages(user_id, key, query, section_after)
+        else:
+            rows = _stream(query.order_by(key) if section_after is None
+                           else query.where(key > section_after).order_by(key))
+
+        for row in rows:
+            record = _record(section, row)
+            # Ids are sent as strings: message ids don't fit in a JS number.
+            record['cursor'] = f"{section}:{row[0]}"
+            record['id'] = str(record['id'])
+            yield record
+
+
+def ndjson_lines(records):
+    """One JSON object per line."""
+
+    for record in records:
+        yield json.dumps(record) + "\n"
+
+
+def csv_lines(records):
+    """A header, then one CSV row per record."""
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS, extrasaction='ignore')
+
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def chunked(lines, size=CHUNK_SIZE):
+    """Join lines into encoded chunks of about `size` bytes."""
+
+    parts = []
+    length = 0
+
+    for line in lines:
+        data = line.encode('utf-8')
+        parts.append(data)
+        length += len(data)
+        if length >= size:
+            yield b''.join(parts)
+            parts = []
+            length = 0
+
+    if parts:
+        yield b''.join(parts)
+
+
+def gzipped(chunks):
+    """Gzip a stream of byte chunks on the fly."""
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
@@ -0,0 +1,153 @@
+"""Public "latest warbles" firehose for anonymous visitors.
+
+Anonymous hits are most of our traffic, so they must never reach the
+database. Each process keeps the newest SIZE messages in a ring buffer and
+the feed HTML pre-rendered from it:
+
+- `messages_add` / `messages_destroy` (and account changes) update the
+  buffer in this process straight away
+- a background thread re-reads the newest SIZE messages (one index range
+  scan) every REFRESH_INTERVAL seconds, picking up other workers' writes,
+  and re-renders the HTML if anything changed
+
+Requests only read `page`. It's re-rendered, and its version bumped, under
+the same lock as the buffer changes, so one version always means one body
+(compression.py reuses compressed bodies by version). `warm_up` seeds the
+buffer before workers fork, so they start with a feed.
+"""
+
+import os
+import threading
+from collections import deque
+
+from models import db, Message
+from records import MessageRecord, record_query
+
+SIZE = 50
+REFRESH_INTERVAL = 5
+TEMPLATE = 'messages/firehose.html'
+
+
+class Firehose:
+    """Ring buffer of the newest messages plus their pre-rendered HTML."""
+
+    def __init__(self, size=SIZE, refresh_interval=REFRESH_INTERVAL):
+        self.size = size
+        self.refresh_interval = refresh_interval
+        # (version, html), swapped whole so readers see a matching pair.
+        self.page = (0, None)
+        self._messages = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._app = None
+        self._pid = None
+
+    @property
+    def html(self):
+        return self.page[1]
+
+    @property
+    def messages(self):
+        """The buffered messages, newest first."""
+
+        with self._lock:
+            return list(self._messages)
+
+    def configure(self, refresh_interval):
+        """Re-read the database every `refresh_interval` seconds; None never starts the thread."""
+
+        self.refresh_interval = refresh_interval
+
+    def _render(self):
+        """Re-render `page` from the buffer, as the next version."""
+
+        template = self._app.jinja_env.get_template(TEMPLATE)
+
+        with self._lock:
+            html = template.render(messages=list(self._messages))
+            self.page = (self.page[0] + 1, html)
+
+    def seed(self, app):
+        """Fill the buffer from the database and render it (needs an app context).
+
+        Returns False, without re-rendering, if nothing had changed.
+        """
+
+        self._app = app
+        rows = record_query().order_by(Message.id.desc()).limit(self.size)
+        records = MessageRecord.from_rows(rows)
+
+        with self._lock:
+            unchanged = ([(r.id, r.user) for r in records]
+                         == [(r.id, r.user) for r in self._messages])
+            self._messages = deque(records, maxlen=self.size)
+
+        if unchanged and self.html is not None:
+            return False
+
+        self._render()
+        return True
+
+    def ensure_running(self, app):
+        """Start the refresh thread in this process, if it isn't already running.
+
+        Seeds the buffer first if it's empty, so a cold process serves a feed.
+        """
+
+        if self._pid == os.getpid():
+            return
+
+        if self.refresh_interval is None:
+            if self.html is None:
+                self.seed(app)
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+
+        if self.html is None:
+            self.seed(app)
+
+        self._app = app
+        threading.Thread(target=self._refresh_forever, name='firehose-refresh',
+                         daemon=True).start()
+
+    def _refresh_forever(self):
+        stop = threading.Event()
+
+        while not stop.wait(self.refresh_interval):
+            with self._app.app_context():
+                try:
+                    self.seed(self._app)
+                except Exception:
+                    self._app.logger.exception("Refreshing the firehose failed")
+                finally:
+                    db.session.remove()
+
+    def add(self, record):
+        """Add a message just written in this process."""
+
+        with self._lock:
+            self._messages.appendleft(record)
+
+        if self._app is not None:
+            self._render()
+
+    def remove(self, message_ids=(), author_id=None):
+        """Drop messages by id, or everything by `author_id`."""
+
+        message_ids = set(message_ids)
+
+        with self._lock:
+            kept = [record for record in self._messages
+                    if record.id not in message_ids and record.user_id != author_id]
+            if len(kept) == len(self._messages):
+                return
+            self._messages = deque(kept, maxlen=self.size)
+
+        if self._app is not None:
+            self._render()
+
+
+firehose = Firehose()
@@ -0,0 +1,420 @@
+"""Follow graph shared between worker processes through a memory-mapped file.
+
+A snapshot of `follows` is written as two CSR (compressed sparse row)
+structures - who each user follows, and who follows each user - to one file
+that every worker maps read-only, so the OS page cache holds a single copy
+no matter how many workers there are:
+
+    header        magic, max user id, edge count
+    following     offsets[max_user_id + 2] (int64), targets[edges] (int32)
+    followers     offsets[max_user_id + 2] (int64), targets[edges] (int32)
+
+Targets for user u are targets[offsets[u]:offsets[u + 1]], sorted.
+
+Follows and unfollows made since the snapshot are appended (after their DB
+commit) to a small delta log next to it, which each worker tails into an
+in-memory overlay; a worker's own records go straight into its overlay, and
+the files are checked for other workers' at most every REFRESH_INTERVAL
+seconds. Once the log grows past COMPACT_AFTER_BYTES, `compact` rebuilds the
+snapshot from the database and starts a fresh log.
+
+Lookups return views into the mapping, not copies, unless the overlay has
+changed that user's row.
+
+Build or compact by hand with:
+
+    python follow_graph.py
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from models import db, Follows
+
+MAGIC = b'WBLFGR01'
+HEADER = struct.Struct('<8sqq')
+DELTA_RECORD = struct.Struct('<?xxxii')
+
+ADD = True
+REMOVE = False
+
+COMPACT_AFTER_BYTES = 1024 * 1024
+REFRESH_INTERVAL = 1.0
+EDGE_FETCH_SIZE = 100000
+
+
+def _padded(nbytes):
+    """Round `nbytes` up to a multiple of 8 so int64 arrays stay aligned."""
+
+    return (nbytes + 7) & ~7
+
+
+def _write_csr(out, edges, max_user_id):
+    """Write offsets and targets for `edges`, an iterable of (source, target) sorted by source."""
+
+    offsets = array('q', [0]) * (max_user_id + 2)
+    targets = array('i')
+
+    for source, target in edges:
+        offsets[source + 1] += 1
+        targets.append(target)
+
+    for i in range(1, len(offsets)):
+        offsets[i] += offsets[i - 1]
+
+    out.write(offsets.tobytes())
+    data = targets.tobytes()
+    out.write(data)
+    out.write(b'\0' * (_padded(len(data)) - len(data)))
+
+
+def _stream(query):
+    """Yield rows of `query` from a server-side cursor."""
+
+    result = db.session.execute(query.execution_options(stream_results=True))
+
+    while True:
+        rows = result.fetchmany(EDGE_FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+def write_snapshot(path):
+    """Write a snapshot of `follows` to `path` (atomically, via a temp file)."""
+
+    max_user_id = max(
+        db.session.query(db.func.max(Follows.user_following_id)).scalar() or 0,
+        db.session.query(db.func.max(Follows.user_being_followed_id)).scalar() or 0)
+    edge_count = db.session.query(db.func.count()).select_from(Follows).scalar()
+
+    following = db.select([Follows.user_following_id, Follows.user_being_followed_id]).order_by(
+        Follows.user_following_id, Follows.user_being_followed_id)
+    followers = db.select([Follows.user_being_followed_id, Follows.user_following_id]).order_by(
+        Follows.user_being_followed_id, Follows.user_following_id)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, max_user_id, edge_count))
+        _write_csr(out, _stream(following), max_user_id)
+        _write_csr(out, _stream(followers), max_user_id)
+        out.flush()
+        os.fsync(out.fileno())
+
+    os.replace(tmp_path, path)
+
+
+class _CSR:
+    """Read-only view of one CSR structure inside the mapped snapshot."""
+
+    def __init__(self, buf, start, max_user_id, edge_count):
+        offsets_size = 8 * (max_user_id + 2)
+        self.offsets = buf[start:start + offsets_size].cast('q')
+        self.targets = buf[start + offsets_size:start + offsets_size + 4 * edge_count].cast('i')
+        self.end = start + offsets_size + _padded(4 * edge_count)
+        self.max_user_id = max_user_id
+
+    def row(self, user_id):
+        """Zero-copy view of `user_id`'s sorted targets."""
+
+        if not 0 <= user_id <= self.max_user_id:
+            return self.targets[0:0]
+
+        return self.targets[self.offsets[user_id]:self.offsets[user_id + 1]]
+
+    def release(self):
+        """Drop our views so the mapping can be closed."""
+
+        self.offsets.release()
+        self.targets.release()
+
+
+def _contains(row, user_id):
+    """Binary search a sorted target row for `user_id`."""
+
+    i = bisect_left(row, user_id)
+    return i < len(row) and row[i] == user_id
+
+
+class _Overlay:
+    """Edges changed since the snapshot, replayed from the delta log(s)."""
+
+    def __init__(self):
+        # {source: {target: ADD or REMOVE}}; the last op for an edge wins.
+        self.following = {}
+        self.followers = {}
+
+    def apply(self, op, follower_id, followed_id):
+        """Record the latest op for one edge."""
+
+        self.following.setdefault(follower_id, {})[followed_id] = op
+        self.followers.setdefault(followed_id, {})[follower_id] = op
+
+
+class SharedFollowGraph:
+    """Follow graph lookups from a shared, memory-mapped snapshot plus delta log.
+
+    `path` may be set later (see `configure`); until a snapshot exists,
+    `available` is False and callers should query the database instead.
+    """
+
+    def __init__(self, path=None, refresh_interval=REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._file = None
+        self._map = None
+        self._buf = None
+        self._following = None
+        self._followers = None
+        self._snapshot_id = None
+        self._delta_ids = None
+        self._delta_offset = 0
+        self._overlay = _Overlay()
+        self._checked_at = None
+        self.configure(path)
+
+    def configure(self, path):
+        """Use the snapshot at `path` (and its delta logs)."""
+
+        with self._lock:
+            self._close()
+            self.path = path
+            self.delta_path = f"{path}.delta" if path else None
+            self.old_delta_path = f"{path}.delta.old" if path else None
+            self.lock_path = f"{path}.lock" if path else None
+            self._checked_at = None
+
+    @property
+    def available(self):
+        """Is there a snapshot to read from?"""
+
+        return self.refresh()
+
+    def _close(self):
+        """Unmap the current snapshot, if any."""
+
+        if self._following is not None:
+            self._following.release()
+            self._followers.release()
+            self._buf.release()
+            try:
+                self._map.close()
+            except BufferError:
+                # Rows handed out earlier still point into it; it's unmapped
+                # once the last of them is dropped.
+                pass
+            self._file.close()
+
+        self._file = self._map = self._buf = None
+        self._following = self._followers = None
+        self._snapshot_id = None
+        self._delta_ids = None
+
+    @staticmethod
+    def _file_id(path):
+        """Identity of the file at `path` (None if missing), to spot replacements."""
+
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    def _map_snapshot(self):
+        """Map the snapshot file at `path`."""
+
+        self._close()
+        self._file = open(self.path, 'rb')
+        self._snapshot_id = self._file_id(self.path)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buf = memoryview(self._map)
+
+        magic, max_user_id, edge_count = HEADER.unpack_from(self._buf)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a follow graph snapshot")
+
+        self._following = _CSR(self._buf, HEADER.size, max_user_id, edge_count)
+        self._followers = _CSR(self._buf, self._following.end, max_user_id, edge_count)
+
+    def _read_delta(self, path, offset):
+        """Apply records in the delta log at `path` from `offset`; returns the new offset."""
+
+        try:
+            with open(path, 'rb') as log:
+                log.seek(offset)
+                data = log.read()
+        except FileNotFoundError:
+            return 0
+
+        usable = len(data) - len(data) % DELTA_RECORD.size
+        for op, follower_id, followed_id in DELTA_RECORD.iter_unpack(data[:usable]):
+            self._overlay.apply(op, follower_id, followed_id)
+
+        return offset + usable
+
+    def refresh(self, force=False):
+        """Pick up a new snapshot or new delta records. Returns `available`.
+
+        Only looks at the files every `refresh_interval` seconds, unless `force`.
+        """
+
+        if not self.path:
+            return False
+
+        with self._lock:
+            now = time.monotonic()
+            if (not force and self._checked_at is not None
+                    and now - self._checked_at < self.refresh_interval):
+                return self._following is not None
+            self._checked_at = now
+
+            snapshot_id = self._file_id(self.path)
+            if snapshot_id is None:
+                self._close()
+                return False
+
+            delta_ids = (self._file_id(self.old_delta_path), self._file_id(self.delta_path))
+
+            if snapshot_id != self._snapshot_id or delta_ids != self._delta_ids:
+                # New snapshot or a log rotation: rebuild the overlay from scratch.
+                if snapshot_id != self._snapshot_id:
+                    self._map_snapshot()
+                self._overlay = _Overlay()
+                self._read_delta(self.old_delta_path, 0)
+                self._delta_offset = self._read_delta(self.delta_path, 0)
+                self._delta_ids = delta_ids
+            else:
+                self._delta_offset = self._read_delta(self.delta_path, self._delta_offset)
+
+            return True
+
+    def _ids(self, csr, changes, user_id):
+        """`user_id`'s row of `csr` with overlay `changes` applied, sorted."""
+
+        row = csr.row(user_id)
+        edits = changes.get(user_id)
+
+        if not edits:
+            return row
+
+        ids = [target for target in row if edits.get(target, ADD)]
+        ids.extend(target for target, op in edits.items() if op and not _contains(row, target))
+        return sorted(ids)
+
+    def following_ids(self, user_id):
+        """Sorted ids of users `user_id` follows (a read-only sequence)."""
+
+        with self._lock:
+            self.refresh()
+            return self._ids(self._following, self._overlay.following, user_id)
+
+    def follower_ids(self, user_id):
+        """Sorted ids of users following `user_id` (a read-only sequence)."""
+
+        with self._lock:
+            self.refresh()
+            return self._ids(self._followers, self._overlay.followers, user_id)
+
+    def is_following(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        with self._lock:
+            self.refresh()
+            op = self._overlay.following.get(follower_id, {}).get(followed_id)
+            if op is not None:
+                return op
+            return _contains(self._following.row(follower_id), followed_id)
+
+    def record(self, op, follower_id, followed_id):
+        """Log a committed follow (ADD) or unfollow (REMOVE) for every worker to see.
+
+        Returns True once the log has grown enough that it's time to compact.
+        """
+
+        return self.record_many(op, [(follower_id, followed_id)])
+
+    def record_many(self, op, edges):
+        """`record` for many (follower_id, followed_id) edges, in one append."""
+
+        if not self.path or not edges:
+            return False
+
+        data = b''.join(DELTA_RECORD.pack(op, follower_id, followed_id)
+                        for follower_id, followed_id in edges)
+
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            fd = os.open(self.delta_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+
+        # This worker sees its own changes now, other workers when they next
+        # read the log; replaying them from the log again is harmless.
+        with self._lock:
+            for follower_id, followed_id in edges:
+                self._overlay.apply(op, follower_id, followed_id)
+
+        return size >= COMPACT_AFTER_BYTES
+
+    def compact(self):
+        """Rebuild the snapshot from the database and retire the delta log.
+
+        Returns False without doing anything if another process is already
+        compacting.
+        """
+
+        with open(self.lock_path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+
+            # Rotate the log so new records go to a fresh one while we build.
+            # A leftover .old log (from an interrupted compaction) is kept.
+            if os.path.exists(self.delta_path) and not os.path.exists(self.old_delta_path):
+                os.replace(self.delta_path, self.old_delta_path)
+
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+            # Records in either log are already committed, so the new snapshot
+            # includes them; replaying them on top of it is harmless.
+            write_snapshot(self.path)
+
+            if os.path.exists(self.old_delta_path):
+                os.remove(self.old_delta_path)
+
+        return True
+
+
+graph = SharedFollowGraph()
+
+
+def compact_in_background(app):
+    """Compact `graph` on a background thread, with an app context."""
+
+    def run():
+        with app.app_context():
+            graph.compact()
+
+    threading.Thread(target=run, name='follow-graph-compaction', daemon=True).start()
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    app = create_app()
+
+    with app.app_context():
+        graph.configure(app.config['FOLLOW_GRAPH_PATH'])
+        graph.compact()
+        graph.refresh(force=True)
+        print(f"Wrote follow graph snapshot to {graph.path}")
@@ -1,7 +1,10 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed, FileRequired
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length
 
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'webp']
+
 
 class MessageForm(FlaskForm):
     """Form for adding/editing messages."""
@@ -32,7 +35,18 @@ class UserUpdateForm(FlaskForm):
     email = StringField('E-mail', validators=[Email()])
     image_url = StringField('(Optional) Image URL')
     header_image_url = StringField('(Optional) Header Image URL')
+    image_upload = FileField('(Optional) Upload a profile image',
+                             validators=[FileAllowed(IMAGE_EXTENSIONS, 'Images only!')])
+    header_image_upload = FileField('(Optional) Upload a header image',
+                                    validators=[FileAllowed(IMAGE_EXTENSIONS, 'Images only!')])
     bio = StringField('Bio')
     location = StringField('Location (City, State)')
 
-    password = PasswordField('Current Password')
\ No newline at end of file
+    password = PasswordField('Current Password')
+
+
+class FollowImportForm(FlaskForm):
+    """Form for following everyone in a CSV of usernames or user ids."""
+
+    follows_csv = FileField('CSV of usernames or user ids, one per line',
+                            validators=[FileRequired(), FileAllowed(['csv', 'txt'], 'CSV files only!')])
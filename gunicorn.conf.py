@@ -0,0 +1,59 @@
+"""Gunicorn settings: build and warm the app once in the master, then fork.
+
+    gunicorn -c gunicorn.conf.py
+
+Templates, mappers and hot queries are compiled before forking, so workers
+start warm and share those pages copy-on-write.
+"""
+
+import multiprocessing
+import os
+
+wsgi_app = 'app:create_app()'
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+bind = os.environ.get('BIND', '127.0.0.1:8000')
+
+# Bound to loopback behind one reverse proxy, whose X-Forwarded-For gives
+# the client IPs the per-IP rate limits count.
+os.environ.setdefault('TRUSTED_PROXIES', '1')
+
+# Workers share rate-limit buckets through this file (see ratelimit.py).
+os.environ.setdefault('RATELIMIT_STORAGE_PATH',
+                      os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'instance', 'ratelimit.bin'))
+
+# Message ids embed a worker id that must be unique across every process on
+# every host (see snowflake.py). Each worker gets WARBLER_WORKER_ID_BASE plus
+# its slot (0 to workers - 1, reused when a worker is replaced), so give each
+# host its own base, at least `workers` apart.
+worker_id_base = int(os.environ.get('WARBLER_WORKER_ID_BASE', 0))
+
+# Likes and follows are acknowledged once journaled here (see write_behind.py).
+os.environ.setdefault('WRITE_BEHIND_JOURNAL',
+                      os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'instance', 'write_behind.db'))
+
+
+def when_ready(server):
+    """Warm the preloaded app in the master, before any worker forks."""
+
+    from app import warm_up
+
+    warm_up(server.app.wsgi())
+
+
+def pre_fork(server, worker):
+    """Give the worker about to fork the lowest slot no live worker holds."""
+
+    used = {getattr(other, 'worker_slot', None) for other in server.WORKERS.values()}
+    worker.worker_slot = next(slot for slot in range(len(used) + 1) if slot not in used)
+
+
+def post_fork(server, worker):
+    """Derive the worker's message id worker id from its slot, and start its image pool."""
+
+    from uploads import start_pool
+
+    os.environ['WARBLER_WORKER_ID'] = str(worker_id_base + worker.worker_slot)
+    start_pool(server.app.wsgi().config['UPLOAD_WORKERS'])
@@ -0,0 +1,152 @@
+"""Read-through cache for single-message pages.
+
+A viral message's page gets the same message-plus-author lookup over and
+over. `MessageCache.get` answers from an in-process LRU of `ThreadRecord`s
+and only goes to the database on a miss; concurrent misses for the same
+message wait for one shared load instead of all querying at once.
+
+Entries expire after `ttl` seconds, which bounds how long other worker
+processes can serve a deleted message or a stale author card. In this
+process, `invalidate` (on delete) and `invalidate_author` (on profile edits
+and account deletion) take effect immediately.
+
+Hit / miss counts are exported through `metrics`.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from models import Message
+from records import ThreadRecord, thread_query
+
+CACHE_MAX_MESSAGES = 100000
+CACHE_TTL = 30
+
+
+def load_message(message_id):
+    """The `ThreadRecord` for `message_id`, or None if it (or its author) is gone."""
+
+    return next(iter(ThreadRecord.from_rows(
+        thread_query().filter(Message.id == message_id).limit(1))), None)
+
+
+class _Load:
+    """A load in progress, which concurrent misses for the same key wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class MessageCache:
+    """LRU + TTL read-through cache of `ThreadRecord`s by message id.
+
+    Missing messages are cached (as None) too, so hammering a deleted
+    message's URL doesn't hammer the database.
+    """
+
+    def __init__(self, load=load_message, max_size=CACHE_MAX_MESSAGES, ttl=CACHE_TTL):
+        self.load = load
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, message_id):
+        """The record for `message_id`, loading it on a miss; None if there's no such message."""
+
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is not None:
+                expires, record = entry
+                if expires >= time.monotonic():
+                    self._entries.move_to_end(message_id)
+                    self.hits += 1
+                    return record
+                del self._entries[message_id]
+
+            self.misses += 1
+            pending = self._loading.get(message_id)
+            if pending is None:
+                pending = self._loading[message_id] = _Load()
+                generation = self._generation
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            pending.value = self.load(message_id)
+        except Exception as error:
+            pending.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._loading[message_id]
+                # Don't store a load that raced with an invalidation.
+                if pending.error is None and generation == self._generation:
+                    self._store(message_id, pending.value)
+            pending.done.set()
+
+        return pending.value
+
+    def _store(self, message_id, record):
+        """Add an entry, evicting the least recently used past `max_size`. Call with the lock held."""
+
+        self._entries[message_id] = (time.monotonic() + self.ttl, record)
+        self._entries.move_to_end(message_id)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, message_id):
+        """Forget `message_id`, e.g. after it's deleted."""
+
+        with self._lock:
+            self._entries.pop(message_id, None)
+            self._generation += 1
+
+    def invalidate_author(self, author_id):
+        """Forget every message by `author_id`, e.g. after they edit their profile."""
+
+        with self._lock:
+            stale = [message_id for message_id, (expires, record) in self._entries.items()
+                     if record is not None and record.user_id == author_id]
+            for message_id in stale:
+                del self._entries[message_id]
+            self._generation += 1
+
+    def clear(self):
+        """Forget everything."""
+
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        """Counters for monitoring."""
+
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, coalesced=self.coalesced,
+                        evictions=self.evictions, size=len(self._entries))
+
+
+message_cache = MessageCache()
+
+metrics.register('message_cache', message_cache.stats)
@@ -0,0 +1,33 @@
+"""Process-local counters for monitoring, served at /metrics.
+
+Components register a function returning a dict of numbers; /metrics
+renders every source in the Prometheus text format as
+`warbler_<source>_<name> <value>`. Each worker process reports its own
+counters, so scrape them per process (or sum them in the dashboard).
+"""
+
+_sources = {}
+
+
+def register(source, collect):
+    """Report the dict returned by `collect()` under `source`."""
+
+    _sources[source] = collect
+
+
+def collect():
+    """{metric name: value} for every registered source."""
+
+    values = {}
+
+    for source, collect_source in sorted(_sources.items()):
+        for name, value in sorted(collect_source().items()):
+            values[f"warbler_{source}_{name}"] = value
+
+    return values
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+
+    return "".join(f"{name} {value}\n" for name, value in collect().items())
@@ -0,0 +1,87 @@
+"""Migrate existing messages to time-ordered snowflake ids (Postgres).
+
+Run once, with the app stopped, from the project root:
+
+    python migrations/0001_snowflake_message_ids.py
+
+Widens messages.id and likes.message_id to BIGINT, drops the old serial
+sequence, and re-keys every message with an id derived from its timestamp.
+Rows are walked in (timestamp, id) order and each new id is bumped past the
+previous one if needed, so the new ids are unique and preserve the old order
+even for the many rows that share a timestamp (the old `timestamp` default
+was evaluated once per process).
+
+Everything happens in a single transaction.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from models import db
+from snowflake import ids_for_datetimes
+
+FETCH_SIZE = 10000
+
+
+def migrate(connection):
+    """Re-key messages on `connection`, inside the caller's transaction."""
+
+    connection.execute("ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey")
+    connection.execute("ALTER TABLE messages ALTER COLUMN id DROP DEFAULT")
+    connection.execute("ALTER TABLE messages ALTER COLUMN id TYPE BIGINT")
+    connection.execute("ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT")
+    connection.execute("DROP SEQUENCE IF EXISTS messages_id_seq")
+
+    connection.execute(
+        "CREATE TEMPORARY TABLE message_id_map "
+        "(old_id BIGINT PRIMARY KEY, new_id BIGINT NOT NULL) ON COMMIT DROP")
+
+    rows = (connection
+            .execution_options(stream_results=True)
+            .execute("SELECT id, timestamp FROM messages ORDER BY timestamp, id"))
+
+    migrated = 0
+    last_id = -1
+
+    while True:
+        batch = rows.fetchmany(FETCH_SIZE)
+        if not batch:
+            break
+
+        new_ids = list(ids_for_datetimes((timestamp for _, timestamp in batch),
+                                         last=last_id))
+        last_id = new_ids[-1]
+
+        connection.execute(
+            db.text("INSERT INTO message_id_map (old_id, new_id) VALUES (:old_id, :new_id)"),
+            [dict(old_id=old_id, new_id=new_id)
+             for (old_id, _), new_id in zip(batch, new_ids)])
+
+        migrated += len(batch)
+        print(f"Mapped {migrated} messages")
+
+    connection.execute(
+        "UPDATE likes SET message_id = m.new_id "
+        "FROM message_id_map m WHERE likes.message_id = m.old_id")
+    connection.execute(
+        "UPDATE messages SET id = m.new_id "
+        "FROM message_id_map m WHERE messages.id = m.old_id")
+
+    connection.execute(
+        "ALTER TABLE likes ADD CONSTRAINT likes_message_id_fkey "
+        "FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE")
+
+    return migrated
+
+
+if __name__ == '__main__':
+    app = create_app()
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            count = migrate(connection)
+
+    print(f"Migrated {count} messages to snowflake ids")
@@ -0,0 +1,34 @@
+"""Allow more than one user to like a message (Postgres).
+
+    python migrations/0002_likes_unique_per_user.py
+
+likes.message_id was declared UNIQUE, so only one user could ever like a
+given message. Replace that with a unique (user_id, message_id) constraint.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from models import db
+
+
+def migrate(connection):
+    """Swap the unique constraint on `connection`, inside the caller's transaction."""
+
+    connection.execute("ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key")
+    connection.execute(
+        "ALTER TABLE likes ADD CONSTRAINT likes_user_id_message_id_key "
+        "UNIQUE (user_id, message_id)")
+
+
+if __name__ == '__main__':
+    app = create_app()
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            migrate(connection)
+
+    print("Likes are now unique per (user, message)")
@@ -0,0 +1,34 @@
+"""Add users.deleted_at for tombstoned (deleted, not yet purged) accounts (Postgres).
+
+    python migrations/0003_user_tombstones.py
+
+The partial index keeps purge_users.py's "who's left to purge?" query cheap
+without adding to the cost of every other user write.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from models import db
+
+
+def migrate(connection):
+    """Add the column and index on `connection`, inside the caller's transaction."""
+
+    connection.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_users_deleted_at ON users (deleted_at) "
+        "WHERE deleted_at IS NOT NULL")
+
+
+if __name__ == '__main__':
+    app = create_app()
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            migrate(connection)
+
+    print("Users can now be tombstoned")
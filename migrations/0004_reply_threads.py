@@ -0,0 +1,43 @@
+"""Add reply threads to messages (Postgres).
+
+    python migrations/0004_reply_threads.py
+
+Adds parent_id, path, depth and reply_count (see threads.py). Every
+existing message becomes the root of its own thread, so its path is just
+its id as 16 hex digits. Run with the app stopped: the backfill rewrites
+every row, all in one transaction.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from models import db
+
+
+def migrate(connection):
+    """Add and backfill the columns, and index paths, inside the caller's transaction."""
+
+    connection.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS parent_id BIGINT")
+    connection.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS path TEXT")
+    connection.execute(
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS depth INTEGER NOT NULL DEFAULT 0")
+    connection.execute(
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS reply_count INTEGER NOT NULL DEFAULT 0")
+
+    connection.execute(
+        "UPDATE messages SET path = lpad(to_hex(id), 16, '0') WHERE path IS NULL")
+    connection.execute("ALTER TABLE messages ALTER COLUMN path SET NOT NULL")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_messages_path ON messages (path)")
+
+
+if __name__ == '__main__':
+    app = create_app()
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            migrate(connection)
+
+    print("Messages can now have replies")
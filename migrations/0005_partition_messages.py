@@ -0,0 +1,71 @@
+"""Turn messages into a table partitioned by month of id (Postgres 12+).
+
+    python migrations/0005_partition_messages.py
+
+Run with the app stopped. The old table is renamed aside, a partitioned
+`messages` is created with a partition for every month from the oldest
+message to MONTHS_AHEAD months from now (see partitions.py), the rows are
+copied over, indexes and the foreign keys pointing at messages are
+rebuilt, and the old table is dropped - all in one transaction.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from models import db
+from partitions import ensure_partitions, is_partitioned
+from snowflake import datetime_for_id
+
+# (table, column) of every foreign key to messages.id.
+REFERENCES = (('likes', 'message_id'), ('message_tags', 'message_id'),
+              ('mentions', 'message_id'), ('notifications', 'target_id'))
+
+
+def migrate(connection):
+    """Partition messages on `connection`, inside the caller's transaction."""
+
+    if is_partitioned(connection):
+        return
+
+    for table, column in REFERENCES:
+        connection.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_{column}_fkey")
+
+    # Index names are shared by the whole schema, so free them up first.
+    connection.execute("ALTER TABLE messages RENAME TO messages_unpartitioned")
+    connection.execute("ALTER TABLE messages_unpartitioned "
+                       "RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey")
+    connection.execute("DROP INDEX IF EXISTS ix_messages_user_id_id")
+    connection.execute("DROP INDEX IF EXISTS ix_messages_path")
+
+    connection.execute(
+        "CREATE TABLE messages (LIKE messages_unpartitioned INCLUDING DEFAULTS "
+        "INCLUDING CONSTRAINTS, PRIMARY KEY (id), "
+        "FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE) "
+        "PARTITION BY RANGE (id)")
+
+    oldest = connection.execute("SELECT min(id) FROM messages_unpartitioned").scalar()
+    ensure_partitions(connection, since=datetime_for_id(oldest) if oldest is not None else None)
+
+    connection.execute("INSERT INTO messages SELECT * FROM messages_unpartitioned")
+    connection.execute("DROP TABLE messages_unpartitioned")
+
+    connection.execute("CREATE INDEX ix_messages_user_id_id ON messages (user_id, id)")
+    connection.execute("CREATE INDEX ix_messages_path ON messages (path)")
+
+    for table, column in REFERENCES:
+        connection.execute(
+            f"ALTER TABLE {table} ADD FOREIGN KEY ({column}) "
+            f"REFERENCES messages (id) ON DELETE CASCADE")
+
+
+if __name__ == '__main__':
+    app = create_app()
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            migrate(connection)
+
+    print("Messages are now partitioned by month")
@@ -0,0 +1,35 @@
+"""Record who each notification counts, so repeat actors aren't recounted (Postgres).
+
+    python migrations/0006_notification_actors.py
+
+Existing unread notifications only know their last actor, so that's who
+they're backfilled with; actors before them may be counted again once.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from models import db, NotificationActor
+
+
+def migrate(connection):
+    """Create and backfill notification_actors, inside the caller's transaction."""
+
+    NotificationActor.__table__.create(connection, checkfirst=True)
+    connection.execute(
+        "INSERT INTO notification_actors (notification_id, actor_id) "
+        "SELECT id, last_actor_id FROM notifications WHERE NOT is_read "
+        "ON CONFLICT DO NOTHING")
+
+
+if __name__ == '__main__':
+    app = create_app()
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            migrate(connection)
+
+    print("Notifications now remember who they count")
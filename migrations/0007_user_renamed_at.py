@@ -0,0 +1,35 @@
+"""Record when users change their username or email (Postgres).
+
+    python migrations/0007_user_renamed_at.py
+
+Adds users.renamed_at, which availability.py reads to pick up renames made
+by other workers. Existing users start out NULL: nobody has been renamed
+since the filters were built.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from models import db
+
+
+def migrate(connection):
+    """Add the column and its partial index, inside the caller's transaction."""
+
+    connection.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS renamed_at TIMESTAMP")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_users_renamed_at ON users (renamed_at) "
+        "WHERE renamed_at IS NOT NULL")
+
+
+if __name__ == '__main__':
+    app = create_app()
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            migrate(connection)
+
+    print("Users now record when they're renamed")
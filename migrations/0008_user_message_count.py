@@ -0,0 +1,55 @@
+"""Store each user's message count (Postgres).
+
+    python migrations/0008_user_message_count.py
+
+Adds users.message_count, which profile pages read instead of counting
+messages across every partition, and fills it in from the messages in the
+database plus those in the archive (see archive.py).
+
+Run it before deploying the code that reads and keeps the counts, which
+selects the column. Messages posted in between, by code that doesn't count
+them yet, are picked up by running it again once that code is deployed:
+counts are recomputed from scratch, so that's safe.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from app import create_app
+from archive import archive
+from models import db
+
+
+def migrate(connection, archived=None):
+    """Add and backfill the column inside the caller's transaction.
+
+    `archived` is {user_id: archived message count} (default: read from `archive`).
+    """
+
+    if archived is None:
+        archived = archive.message_counts()
+
+    connection.execute(
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 0")
+    connection.execute(
+        "UPDATE users SET message_count = "
+        "(SELECT count(*) FROM messages WHERE messages.user_id = users.id)")
+
+    if archived:
+        connection.execute(
+            text("UPDATE users SET message_count = message_count + :count WHERE id = :user_id"),
+            [dict(user_id=user_id, count=count) for user_id, count in archived.items()])
+
+
+if __name__ == '__main__':
+    app = create_app()
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            migrate(connection)
+
+    print("Users now store their message counts")
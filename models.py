@@ -5,6 +5,9 @@ from datetime import datetime
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
+from partitions import create_current_partitions
+from snowflake import next_message_id
+
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
@@ -13,6 +16,10 @@ class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
+    __table_args__ = (
+        # The primary key serves "followers of X"; this serves "X follows".
+        db.Index('ix_follows_user_following_id', 'user_following_id', 'user_being_followed_id'),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -31,6 +38,10 @@ class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
+    __table_args__ = (
+        # One like per user per message.
+        db.UniqueConstraint('user_id', 'message_id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -43,16 +54,76 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
 
+class Suggestion(db.Model):
+    """Precomputed "who to follow" suggestion for a user.
+
+    Rows are written in bulk by `recommendations.py`; `rank` 0 is the
+    strongest suggestion.
+    """
+
+    __tablename__ = 'suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    suggested_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    @classmethod
+    def users_for(cls, user_id, limit=5):
+        """Get suggested users for `user_id`, best first.
+
+        Suggestions the user has followed since the last batch run are
+        skipped. This is a single query on the (user_id, rank) primary key.
+        """
+
+        already_following = (db.session
+                             .query(Follows.user_being_followed_id)
+                             .filter(Follows.user_following_id == user_id))
+
+        return (User
+                .query
+                .join(cls, cls.suggested_user_id == User.id)
+                .filter(cls.user_id == user_id)
+                .filter(User.deleted_at.is_(None))
+                .filter(~User.id.in_(already_following))
+                .order_by(cls.rank)
+                .limit(limit)
+                .all())
+
+
 class User(db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
+    __table_args__ = (
+        # Finds tombstoned users left to purge; only they are indexed.
+        db.Index('ix_users_deleted_at', 'deleted_at',
+                 postgresql_where=db.text('deleted_at IS NOT NULL')),
+        db.Index('ix_users_renamed_at', 'renamed_at',
+                 postgresql_where=db.text('renamed_at IS NOT NULL')),
+    )
 
     id = db.Column(
         db.Integer,
@@ -94,6 +165,30 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Set when the user deletes their account; the row (and everything
+    # hanging off it) stays until purge_users.py clears it out.
+    deleted_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    # When the username or email last changed, so every worker's
+    # availability filters pick the new ones up (see availability.py).
+    renamed_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    # Messages posted, archived ones included (see archive.py), so profiles
+    # don't count them across every partition. Kept up to date by
+    # `_count_message` / `_uncount_message`; bulk inserts and deletes
+    # (seed.py, purge_users.py, archive.py) skip those.
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -130,7 +225,11 @@ class User(db.Model):
         found_user_list = [user for user in self.following if user == other_user]
         return len(found_user_list) == 1
 
+    @classmethod
+    def active(cls):
+        """Query of users who haven't deleted their accounts."""
 
+        return cls.query.filter(cls.deleted_at.is_(None))
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -162,7 +261,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -172,14 +271,37 @@ class User(db.Model):
         return False
 
 
+def path_segment(message_id):
+    """A message id as one fixed-width (16 hex digit) segment of `Message.path`."""
+
+    return f"{message_id:016x}"
+
+
+def _root_path(context):
+    """Default `path` for a message that isn't a reply: just its own segment."""
+
+    return path_segment(context.get_current_parameters()['id'])
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        # Serves per-author timelines newest-first (profile pages, merge feed).
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+        # Serves reply threads: a subtree is one range of paths (see threads.py).
+        db.Index('ix_messages_path', 'path'),
+        # One partition per month of ids on Postgres (see partitions.py).
+        {'postgresql_partition_by': 'RANGE (id)'},
+    )
 
+    # Snowflake ids are time-ordered, so timelines sort on the primary key.
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=next_message_id,
     )
 
     text = db.Column(
@@ -190,7 +312,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,16 +321,193 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # The message this replies to. Not a foreign key: replies stay (and keep
+    # their place in the thread) when the message they answer is deleted.
+    parent_id = db.Column(
+        db.BigInteger,
+        nullable=True,
+    )
+
+    # Ids from the thread's root down to this message, as `path_segment`s.
+    path = db.Column(
+        db.Text,
+        nullable=False,
+        default=_root_path,
+    )
+
+    depth = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # Direct replies; kept up to date by threads.py.
+    reply_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
     user = db.relationship('User')
 
     def __repr__(self):
         return f"<Message #{self.id}: user: {self.user.username}, {self.timestamp}>"
 
 
+# A partitioned table can't take rows until it has partitions.
+db.event.listen(Message.__table__, 'after_create', create_current_partitions)
+
+
+def _count_message(mapper, connection, message):
+    """`after_insert` hook: one more message for its author, in the same transaction."""
+
+    connection.execute(User.__table__.update()
+                       .where(User.id == message.user_id)
+                       .values(message_count=User.message_count + 1))
+
+
+def _uncount_message(mapper, connection, message):
+    """`after_delete` hook: one message fewer for its author."""
+
+    connection.execute(User.__table__.update()
+                       .where(User.id == message.user_id)
+                       .values(message_count=User.message_count - 1))
+
+
+db.event.listen(Message, 'after_insert', _count_message)
+db.event.listen(Message, 'after_delete', _uncount_message)
+
+
+class MessageTag(db.Model):
+    """A hashtag used in a message.
+
+    Written when the message is posted; the (tag, message_id) primary key
+    serves tag feeds newest-first.
+    """
+
+    __tablename__ = 'message_tags'
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class Mention(db.Model):
+    """A user @mentioned in a message."""
+
+    __tablename__ = 'mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class Notification(db.Model):
+    """An aggregated notification, e.g. "@bob and 11 others liked your warble".
+
+    Repeated events of the same kind on the same target collapse into one
+    unread row; `actor_count` says how many there were.
+    """
+
+    __tablename__ = 'notifications'
+    __table_args__ = (
+        db.Index('ix_notifications_recipient_id_is_read', 'recipient_id', 'is_read'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    recipient_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # The liked message for 'like'; unused for 'follow'.
+    target_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+    )
+
+    last_actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    is_read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    last_actor = db.relationship('User', foreign_keys=[last_actor_id])
+
+    def __repr__(self):
+        return f"<Notification #{self.id}: {self.kind} x{self.actor_count} for {self.recipient_id}>"
+
+
+class NotificationActor(db.Model):
+    """Someone counted in a notification's `actor_count`, so nobody is counted twice."""
+
+    __tablename__ = 'notification_actors'
+    __table_args__ = (
+        # Finds the notifications a purged user is counted in.
+        db.Index('ix_notification_actors_actor_id', 'actor_id'),
+    )
+
+    notification_id = db.Column(
+        db.Integer,
+        db.ForeignKey('notifications.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
     You should call this in your Flask app.
+
+    Use the database inside the app's context: several apps can share `db`.
     """
 
-    db.app = app
     db.init_app(app)
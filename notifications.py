@@ -0,0 +1,254 @@
+"""Batched, aggregated notifications for likes and follows.
+
+`add_like` / `add_follow` only `enqueue` an event in memory, which costs no
+database writes on those hot POSTs. Once enough events have queued up (or the
+oldest has waited long enough), `flush` writes them in one go, collapsing
+repeats of the same kind on the same target into a single unread row with an
+actor count.
+
+Each unread notification remembers who it counts (`NotificationActor`), so
+someone liking, un-liking and liking again is counted once however the events
+are split across flushes. A batch that fails to write (say, a like whose
+message was deleted meanwhile slipped past the checks) is rolled back, logged
+and dropped, rather than failing the request that happened to flush it.
+
+Unread counts are served from `unread_counts`, a per-process cache that is
+filled with one COUNT the first time a user is asked about and then kept up to
+date by `flush` and `mark_all_read`.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, Message, Notification, NotificationActor, User
+
+LIKE = 'like'
+FOLLOW = 'follow'
+
+FLUSH_BATCH_SIZE = 100
+FLUSH_MAX_DELAY = 5
+UNREAD_COUNT_TTL = 60
+
+Event = namedtuple('Event', ['recipient_id', 'kind', 'target_id', 'actor_id'])
+
+
+class UnreadCounter:
+    """Cached unread notification counts per user."""
+
+    def __init__(self, ttl=UNREAD_COUNT_TTL):
+        self.ttl = ttl
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Unread count for `user_id`, counting in the database only on a miss."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            cached = self._counts.get(user_id)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+
+        count = (Notification
+                 .query
+                 .filter_by(recipient_id=user_id, is_read=False)
+                 .count())
+
+        with self._lock:
+            self._counts[user_id] = (now + self.ttl, count)
+
+        return count
+
+    def add(self, user_id, n):
+        """Adjust a cached count by `n` (uncached users are left alone)."""
+
+        with self._lock:
+            cached = self._counts.get(user_id)
+            if cached is not None:
+                self._counts[user_id] = (cached[0], cached[1] + n)
+
+    def reset(self, user_id):
+        """Mark `user_id` as having nothing unread."""
+
+        with self._lock:
+            self._counts[user_id] = (time.monotonic() + self.ttl, 0)
+
+    def clear(self):
+        """Forget every cached count."""
+
+        with self._lock:
+            self._counts.clear()
+
+
+class NotificationQueue:
+    """In-memory queue of notification events, flushed in batches."""
+
+    def __init__(self, batch_size=FLUSH_BATCH_SIZE, max_delay=FLUSH_MAX_DELAY):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._events = []
+        self._oldest = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._events)
+
+    def enqueue(self, recipient_id, kind, actor_id, target_id=None):
+        """Queue an event; people are never notified about their own actions."""
+
+        if recipient_id == actor_id:
+            return
+
+        with self._lock:
+            if not self._events:
+                self._oldest = time.monotonic()
+            self._events.append(Event(recipient_id, kind, target_id, actor_id))
+
+    def due(self):
+        """Is there a full batch, or an event that has waited long enough?"""
+
+        return bool(self._events) and (
+            len(self._events) >= self.batch_size
+            or time.monotonic() - self._oldest >= self.max_delay)
+
+    def drain(self):
+        """Remove and return all queued events."""
+
+        with self._lock:
+            events, self._events = self._events, []
+            self._oldest = None
+
+        return events
+
+
+queue = NotificationQueue()
+unread_counts = UnreadCounter()
+
+
+def write_events(events, counter=unread_counts):
+    """Write `events` as aggregated notifications, in a single transaction.
+
+    Events with the same (recipient, kind, target) collapse together and are
+    added onto an existing unread notification where there is one; actors it
+    already counts aren't counted again. Events for users or messages that are
+    gone are skipped.
+    """
+
+    user_ids = {event.recipient_id for event in events} | {event.actor_id for event in events}
+    message_ids = {event.target_id for event in events if event.target_id is not None}
+    active_users = {user_id for (user_id,) in (db.session
+                                               .query(User.id)
+                                               .filter(User.id.in_(user_ids),
+                                                       User.deleted_at.is_(None)))} if user_ids else set()
+    messages = {message_id for (message_id,) in (db.session
+                                                 .query(Message.id)
+                                                 .filter(Message.id.in_(message_ids)))} if message_ids else set()
+
+    grouped = {}
+    for event in events:
+        if (event.recipient_id not in active_users or event.actor_id not in active_users
+                or (event.target_id is not None and event.target_id not in messages)):
+            continue
+        key = (event.recipient_id, event.kind, event.target_id)
+        actors = grouped.setdefault(key, [])
+        # Keep actors in order of their latest event; the last one is shown.
+        if event.actor_id in actors:
+            actors.remove(event.actor_id)
+        actors.append(event.actor_id)
+
+    if not grouped:
+        return
+
+    recipient_ids = {recipient_id for recipient_id, _, _ in grouped}
+    existing = {(n.recipient_id, n.kind, n.target_id): n
+                for n in (Notification
+                          .query
+                          .filter(Notification.recipient_id.in_(recipient_ids),
+                                  Notification.is_read.is_(False)))}
+
+    actor_ids = {actor_id for actors in grouped.values() for actor_id in actors}
+    counted = set(db.session
+                  .query(NotificationActor.notification_id, NotificationActor.actor_id)
+                  .filter(NotificationActor.notification_id.in_([n.id for n in existing.values()]),
+                          NotificationActor.actor_id.in_(actor_ids))) if existing else set()
+
+    now = datetime.utcnow()
+    created = []
+    actor_rows = []
+
+    for key, actors in grouped.items():
+        notification = existing.get(key)
+
+        if notification is None:
+            recipient_id, kind, target_id = key
+            notification = Notification(recipient_id=recipient_id,
+                                        kind=kind,
+                                        target_id=target_id,
+                                        last_actor_id=actors[-1],
+                                        actor_count=len(actors),
+                                        is_read=False,
+                                        updated_at=now)
+            created.append((notification, actors))
+            continue
+
+        new_actors = [actor_id for actor_id in actors if (notification.id, actor_id) not in counted]
+        if not new_actors:
+            continue
+
+        # Increment in SQL so concurrent flushes from other workers add up.
+        notification.actor_count = Notification.actor_count + len(new_actors)
+        notification.last_actor_id = new_actors[-1]
+        notification.updated_at = now
+        actor_rows.extend(dict(notification_id=notification.id, actor_id=actor_id)
+                          for actor_id in new_actors)
+
+    if created:
+        db.session.add_all([notification for notification, _ in created])
+        db.session.flush()
+        actor_rows.extend(dict(notification_id=notification.id, actor_id=actor_id)
+                          for notification, actors in created for actor_id in actors)
+
+    if actor_rows:
+        db.session.bulk_insert_mappings(NotificationActor, actor_rows)
+
+    db.session.commit()
+
+    for notification, _ in created:
+        counter.add(notification.recipient_id, 1)
+
+
+def flush(force=False):
+    """Write queued events if a flush is due (or `force` is set).
+
+    Runs after requests, so a batch that fails to write is rolled back,
+    logged and dropped instead of turning this request into a 500.
+    """
+
+    if not (force or queue.due()):
+        return
+
+    events = queue.drain()
+
+    try:
+        write_events(events)
+    except SQLAlchemyError:
+        db.session.rollback()
+        current_app.logger.exception(f"Dropped {len(events)} notification events that failed to write")
+
+
+def mark_all_read(user_id):
+    """Mark all of `user_id`'s notifications as read."""
+
+    (Notification
+     .query
+     .filter_by(recipient_id=user_id, is_read=False)
+     .update({'is_read': True}, synchronize_session=False))
+    db.session.commit()
+
+    unread_counts.reset(user_id)
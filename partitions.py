@@ -0,0 +1,160 @@
+"""Monthly partitions of the messages table (Postgres).
+
+`messages` is range-partitioned on `id`. Snowflake ids are time-ordered, so
+each calendar month (UTC) is one id range, `month_bounds(month)`, and one
+partition, `messages_YYYY_MM`. Queries with an id bound (keyset pages,
+`recent_floor()`) only touch the partitions in range, and old months can be
+dropped whole once archive.py has copied them out.
+
+`ensure_partitions` creates the current month's partition and the next
+MONTHS_AHEAD months'. It runs when the table is created, from `warm_up`, and
+from cron:
+
+    python partitions.py
+
+If cron stops running, writes past the last partition land in the DEFAULT
+partition, `messages_default`, rather than failing. A month with rows there
+doesn't get a partition of its own later (moving the rows would delete
+their likes, tags and mentions through the foreign keys); its rows stay in
+the default partition until archive.py drops the month.
+
+Needs Postgres 12 or later (likes, tags and mentions reference the
+partitioned table). Other databases keep one plain table.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+from snowflake import datetime_for_id, id_for_datetime
+
+MONTHS_AHEAD = 3
+DEFAULT_PARTITION = 'messages_default'
+# Profile pages read these most recent months first (see profiles.py).
+RECENT_MONTHS = 3
+
+
+def month_start(dt):
+    """Midnight on the first of `dt`'s month."""
+
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(month, n):
+    """The first of the month `n` months after (or before) `month`."""
+
+    year, month_index = divmod(month.year * 12 + month.month - 1 + n, 12)
+    return datetime(year, month_index + 1, 1)
+
+
+def month_bounds(month):
+    """Message ids in `month`: (first, first of the next month)."""
+
+    return id_for_datetime(month), id_for_datetime(add_months(month, 1))
+
+
+def month_for_id(message_id):
+    """The month a message was posted in."""
+
+    return month_start(datetime_for_id(message_id))
+
+
+def partition_name(month):
+    return f"messages_{month:%Y_%m}"
+
+
+def recent_floor(now=None):
+    """Lowest message id in the RECENT_MONTHS most recent months."""
+
+    return id_for_datetime(add_months(month_start(now or datetime.utcnow()), 1 - RECENT_MONTHS))
+
+
+def is_partitioned(connection):
+    """Is `messages` a partitioned table on this connection's database?"""
+
+    if connection.dialect.name != 'postgresql':
+        return False
+
+    return connection.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = 'messages'::regclass)").scalar()
+
+
+def create_default_partition(connection):
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF messages DEFAULT")
+
+
+def create_partition(connection, month):
+    """Create `month`'s partition, unless its rows are already in the default partition.
+
+    Returns whether `month` has a partition of its own.
+    """
+
+    low, high = month_bounds(month)
+    in_default = connection.execute(
+        text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE id >= :low AND id < :high)"),
+        low=low, high=high).scalar()
+    if in_default:
+        return False
+
+    connection.execute(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF messages "
+        f"FOR VALUES FROM ({low}) TO ({high})")
+    return True
+
+
+def ensure_partitions(connection, since=None, now=None):
+    """Create any missing partitions from `since`'s month (default: now) to MONTHS_AHEAD ahead.
+
+    Returns the months left to the default partition (see create_partition).
+    """
+
+    create_default_partition(connection)
+
+    current = month_start(now or datetime.utcnow())
+    month = month_start(since) if since else current
+    skipped = []
+
+    while month <= add_months(current, MONTHS_AHEAD):
+        if not create_partition(connection, month):
+            skipped.append(month)
+        month = add_months(month, 1)
+
+    return skipped
+
+
+def drop_partition(connection, month):
+    """Detach and drop `month`'s partition, if there is one."""
+
+    name = partition_name(month)
+    exists = connection.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_inherits "
+             "WHERE inhparent = 'messages'::regclass AND inhrelid::regclass::text = :name)"),
+        name=name).scalar()
+
+    if exists:
+        connection.execute(f"ALTER TABLE messages DETACH PARTITION {name}")
+        connection.execute(f"DROP TABLE {name}")
+
+
+def create_current_partitions(target, connection, **kw):
+    """`after_create` hook for the messages table."""
+
+    if is_partitioned(connection):
+        ensure_partitions(connection)
+
+
+if __name__ == '__main__':
+    from app import create_app
+    from models import db
+
+    app = create_app()
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            if is_partitioned(connection):
+                for month in ensure_partitions(connection):
+                    print(f"{month:%Y-%m} is in {DEFAULT_PARTITION} (was cron down?)")
+                print(f"Partitions exist through {add_months(month_start(datetime.utcnow()), MONTHS_AHEAD):%Y-%m}")
+            else:
+                print("messages isn't partitioned")
@@ -0,0 +1,183 @@
+"""On-demand sampling profiler for single requests.
+
+While a profiled request runs, a background thread samples the request
+thread's Python stack every `interval` seconds (via
+`sys._current_frames()`), so the view itself runs unmodified and the cost is
+one stack walk per sample. Nothing runs for requests that aren't profiled.
+
+Each sample is also put in a bucket by what the innermost interesting frame
+was doing - "sql" (SQLAlchemy or the DB driver), "template" (Jinja) or
+"python" (everything else) - which gives a rough split of the request's
+wall time.
+
+Profiles are written to a directory as two files:
+
+    <name>.collapsed   one "frame;frame;frame count" line per distinct stack,
+                       the input format of flamegraph.pl and speedscope
+    <name>.json        request details, duration and the time split
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+SQL = 'sql'
+TEMPLATE = 'template'
+PYTHON = 'python'
+
+DEFAULT_INTERVAL = 0.005
+DEFAULT_KEEP = 200
+
+_SQL_PATHS = (f"{os.sep}sqlalchemy{os.sep}", f"{os.sep}psycopg2{os.sep}", f"{os.sep}sqlite3{os.sep}")
+_TEMPLATE_PATHS = (f"{os.sep}jinja2{os.sep}",)
+_NAME_RE = re.compile(r'^[\w.-]+$')
+
+
+def categorize(frame):
+    """SQL, TEMPLATE or PYTHON, going by the innermost frame that's either of the first two."""
+
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if any(part in filename for part in _SQL_PATHS):
+            return SQL
+        if filename.endswith('.html') or any(part in filename for part in _TEMPLATE_PATHS):
+            return TEMPLATE
+        frame = frame.f_back
+
+    return PYTHON
+
+
+def collapse(frame):
+    """Stack from `frame` outwards, as a collapsed "outer;...;inner" string."""
+
+    names = []
+
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    """Samples one thread's stack on a timer until stopped."""
+
+    def __init__(self, thread_id=None, interval=DEFAULT_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self.categories = Counter()
+        self.started = None
+        self.duration = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            self.stacks[collapse(frame)] += 1
+            self.categories[categorize(frame)] += 1
+            del frame
+
+    def stop(self):
+        """Stop sampling; returns self."""
+
+        self._stopping.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.started
+        return self
+
+    @property
+    def samples(self):
+        return sum(self.categories.values())
+
+    def split(self):
+        """Estimated seconds spent in SQL, templates and Python."""
+
+        samples = self.samples
+        return {category: (self.categories[category] / samples * self.duration if samples else 0)
+                for category in (SQL, TEMPLATE, PYTHON)}
+
+
+class ProfileStore:
+    """A directory of recent profiles, keeping the newest `keep`."""
+
+    def __init__(self, directory, keep=DEFAULT_KEEP):
+        self.directory = directory
+        self.keep = keep
+
+    def save(self, sampler, **details):
+        """Write `sampler`'s stacks and a summary (plus `details`); returns the profile name."""
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        now = datetime.utcnow()
+        endpoint = re.sub(r'[^\w.-]', '_', details.get('endpoint') or 'unknown')
+        name = f"{now:%Y%m%dT%H%M%S%f}-{os.getpid()}-{endpoint}"
+
+        with open(os.path.join(self.directory, f"{name}.collapsed"), 'w') as out:
+            for stack, count in sampler.stacks.most_common():
+                out.write(f"{stack} {count}\n")
+
+        summary = dict(details, name=name, created_at=now.isoformat(),
+                       duration=sampler.duration, samples=sampler.samples,
+                       interval=sampler.interval, split=sampler.split())
+        with open(os.path.join(self.directory, f"{name}.json"), 'w') as out:
+            json.dump(summary, out)
+
+        self._prune()
+        return name
+
+    def _names(self):
+        """Profile names, oldest first."""
+
+        try:
+            files = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+
+        return sorted(f[:-len('.json')] for f in files if f.endswith('.json'))
+
+    def _prune(self):
+        for name in self._names()[:-self.keep]:
+            for ext in ('.json', '.collapsed'):
+                try:
+                    os.remove(os.path.join(self.directory, name + ext))
+                except FileNotFoundError:
+                    pass
+
+    def recent(self):
+        """Summaries of stored profiles, newest first."""
+
+        summaries = []
+
+        for name in reversed(self._names()):
+            try:
+                with open(os.path.join(self.directory, f"{name}.json")) as summary:
+                    summaries.append(json.load(summary))
+            except (FileNotFoundError, ValueError):
+                continue
+
+        return summaries
+
+    def filename(self, name):
+        """File name of profile `name`'s collapsed stacks, or None if it's not a stored profile."""
+
+        if not _NAME_RE.match(name) or name not in self._names():
+            return None
+
+        return f"{name}.collapsed"
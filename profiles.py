@@ -0,0 +1,239 @@
+"""Everything a profile page header needs, in one round trip.
+
+`detail.html` used to render counts with `user.messages | length` (and the
+same for following, followers and likes), loading every related row just to
+count it, plus another query for the follow button. `load_profile` gets the
+user's columns, all four counts and whether the viewer follows them from one
+statement, and `profile_messages` gets the newest messages from a second.
+The message count is the one stored on the user (see User.message_count):
+counting would touch every partition of `messages`.
+
+The following / followers / likes tabs are paged with keyset cursors over
+`follows` and `likes` (each served by an index), rather than loading a
+user's whole collection; `followed_among` then resolves the follow buttons
+for a page of users in one query. Where the shared follow graph (see
+follow_graph.py) is available, follower pages and follow buttons are read
+from it instead.
+
+Likes and follows still in the write-behind queue (see write_behind.py) are
+laid over the results, so people see their own changes straight away.
+Follower counts and lists catch up when the queue is flushed.
+
+`profile_messages` reads the recent partitions of `messages` first, and only
+goes further back (then on to the archive, see archive.py) if the page
+isn't full.
+"""
+
+from bisect import bisect_left
+from datetime import datetime
+
+import follow_graph
+import partitions
+from archive import archive
+from models import db, Follows, Likes, Message, User
+from records import AuthorCard, MessageRecord, _Frozen, record_query
+from write_behind import FOLLOW, LIKE, overlay_page, write_queue
+
+
+class ProfileSummary(_Frozen):
+    """A user's profile details plus counts, as shown on their pages."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio', 'location',
+                 'message_count', 'following_count', 'follower_count', 'like_count',
+                 'viewer_follows', 'card')
+
+    def __init__(self, **fields):
+        for name in self.__slots__[:-1]:
+            object.__setattr__(self, name, fields[name])
+        object.__setattr__(self, 'card', AuthorCard(self.id, self.username, self.image_url))
+
+    def __repr__(self):
+        return f"<ProfileSummary #{self.id}: {self.username}>"
+
+
+def _count(column, user_column):
+    """Correlated scalar subquery counting rows of `column`'s table for the user."""
+
+    return (db.select([db.func.count()])
+            .select_from(column.table)
+            .where(user_column == User.id)
+            .as_scalar())
+
+
+def _pending_delta(pending, existing):
+    """How much applying `pending` ({target_id: active}) changes a count, given `existing` targets."""
+
+    return sum((1 if active else -1) for target_id, active in pending.items()
+               if active != (target_id in existing))
+
+
+def load_profile(user_id, viewer_id=None):
+    """The `ProfileSummary` for `user_id`, as seen by `viewer_id`; None if no such user."""
+
+    if viewer_id is None:
+        viewer_follows = db.literal(False)
+    else:
+        viewer_follows = db.exists().where(db.and_(
+            Follows.user_following_id == viewer_id,
+            Follows.user_being_followed_id == User.id))
+
+    row = (db.session
+           .query(User.id, User.username, User.image_url, User.header_image_url,
+                  User.bio, User.location,
+                  User.message_count,
+                  _count(Follows.user_being_followed_id,
+                         Follows.user_following_id).label('following_count'),
+                  _count(Follows.user_following_id,
+                         Follows.user_being_followed_id).label('follower_count'),
+                  _count(Likes.id, Likes.user_id).label('like_count'),
+                  viewer_follows.label('viewer_follows'))
+           .filter(User.id == user_id, User.deleted_at.is_(None))
+           .first())
+
+    if row is None:
+        return None
+
+    fields = row._asdict()
+    fields['viewer_follows'] = write_queue.pending(viewer_id, FOLLOW).get(
+        user_id, bool(fields['viewer_follows']))
+
+    following = write_queue.pending(user_id, FOLLOW)
+    if following:
+        fields['following_count'] += _pending_delta(
+            following, followed_among(user_id, list(following), pending=False))
+
+    likes = write_queue.pending(user_id, LIKE)
+    if likes:
+        liked = {message_id for (message_id,) in
+                 (db.session
+                  .query(Likes.message_id)
+                  .filter(Likes.user_id == user_id, Likes.message_id.in_(list(likes))))}
+        fields['like_count'] += _pending_delta(likes, liked)
+
+    return ProfileSummary(**fields)
+
+
+def profile_messages(profile, limit, before=None):
+    """`profile`'s newest `limit` messages (older than `before`) as `MessageRecord`s."""
+
+    messages = []
+    floor = partitions.recent_floor()
+
+    # The recent partitions first, then the older ones.
+    for low, high in ((floor, before), (None, min(before or floor, floor))):
+        if high is not None and low is not None and high <= low:
+            continue
+
+        query = (db.session
+                 .query(Message.id, Message.text, Message.timestamp)
+                 .filter(Message.user_id == profile.id))
+        if low is not None:
+            query = query.filter(Message.id >= low)
+        if high is not None:
+            query = query.filter(Message.id < high)
+
+        rows = query.order_by(Message.id.desc()).limit(limit - len(messages))
+        messages.extend(MessageRecord(id, text, timestamp, profile.card)
+                        for id, text, timestamp in rows)
+        if len(messages) == limit:
+            return messages
+
+    # Then the archive.
+    archived = archive.user_messages(profile.id, limit - len(messages),
+                                     messages[-1].id if messages else before)
+    messages.extend(MessageRecord(m['id'], m['text'], datetime.fromisoformat(m['timestamp']),
+                                  profile.card) for m in archived)
+    return messages
+
+
+def following_page(user_id, limit, before=None):
+    """Users `user_id` follows, newest accounts first, with ids below `before`."""
+
+    query = (User.query
+             .join(Follows, Follows.user_being_followed_id == User.id)
+             .filter(Follows.user_following_id == user_id, User.deleted_at.is_(None)))
+    if before:
+        query = query.filter(Follows.user_being_followed_id < before)
+
+    users = query.order_by(Follows.user_being_followed_id.desc()).limit(limit).all()
+    return overlay_page(users, write_queue.pending(user_id, FOLLOW),
+                        lambda ids: User.active().filter(User.id.in_(ids)).all(),
+                        limit, before)
+
+
+def followers_page(user_id, limit, before=None):
+    """Users following `user_id`, newest accounts first, with ids below `before`."""
+
+    if follow_graph.graph.available:
+        return _graph_followers_page(user_id, limit, before)
+
+    query = (User.query
+             .join(Follows, Follows.user_following_id == User.id)
+             .filter(Follows.user_being_followed_id == user_id, User.deleted_at.is_(None)))
+    if before:
+        query = query.filter(Follows.user_following_id < before)
+
+    return query.order_by(Follows.user_following_id.desc()).limit(limit).all()
+
+
+def _graph_followers_page(user_id, limit, before):
+    """`followers_page` from the follow graph: ids from the graph, users by primary key."""
+
+    follower_ids = follow_graph.graph.follower_ids(user_id)
+    end = bisect_left(follower_ids, before) if before else len(follower_ids)
+    users = []
+
+    # Deleted users are skipped, so keep going back until the page is full.
+    while end > 0 and len(users) < limit:
+        start = max(0, end - limit)
+        ids = list(follower_ids[start:end])
+        users.extend(sorted(User.query.filter(User.id.in_(ids), User.deleted_at.is_(None)),
+                            key=lambda user: user.id, reverse=True))
+        end = start
+
+    return users[:limit]
+
+
+def likes_page(user_id, limit, before=None):
+    """Messages `user_id` likes, newest first, as `MessageRecord`s with their authors."""
+
+    query = (record_query()
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user_id))
+    if before:
+        query = query.filter(Likes.message_id < before)
+
+    likes = MessageRecord.from_rows(query.order_by(Likes.message_id.desc()).limit(limit))
+    return overlay_page(likes, write_queue.pending(user_id, LIKE),
+                        lambda ids: MessageRecord.from_rows(
+                            record_query().filter(Message.id.in_(ids))),
+                        limit, before)
+
+
+def followed_among(viewer_id, user_ids, pending=True):
+    """The subset of `user_ids` that `viewer_id` follows, in one query (or none).
+
+    Includes queued follows and unfollows unless `pending` is False.
+    """
+
+    if viewer_id is None or not user_ids:
+        return set()
+
+    if follow_graph.graph.available:
+        followed = {user_id for user_id in user_ids
+                    if follow_graph.graph.is_following(viewer_id, user_id)}
+    else:
+        followed = {followed_id for (followed_id,) in
+                    (db.session
+                     .query(Follows.user_being_followed_id)
+                     .filter(Follows.user_following_id == viewer_id,
+                             Follows.user_being_followed_id.in_(user_ids)))}
+
+    if pending:
+        for followed_id, active in write_queue.pending(viewer_id, FOLLOW).items():
+            if followed_id in user_ids and active:
+                followed.add(followed_id)
+            else:
+                followed.discard(followed_id)
+
+    return followed
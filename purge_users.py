@@ -0,0 +1,246 @@
+"""Purge the data of users who have deleted their accounts.
+
+    python purge_users.py [--batch-size 1000]
+
+Deleting an account only tombstones the user (sets `users.deleted_at`),
+which hides them everywhere at once; `delete_user` then starts
+`purge_in_background` for them. This script sweeps up any tombstoned users
+whose purge didn't finish (say, the worker restarted), so it's safe to run
+from cron.
+
+Rows are removed with set-based DELETEs of at most `batch_size` rows, one
+transaction per batch, so a prolific account never holds locks on the hot
+tables for long. Every step is idempotent, so a purge can stop anywhere and
+be re-run.
+"""
+
+import argparse
+import threading
+
+import follow_graph
+import threads
+from models import (db, Follows, Likes, Mention, Message, MessageTag, Notification,
+                    NotificationActor, Suggestion, User)
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def _delete_in_batches(model, key, condition, batch_size):
+    """Delete rows of `model` matching `condition`, `batch_size` keys at a time.
+
+    Yields the number of rows deleted by each batch.
+    """
+
+    while True:
+        keys = [k for (k,) in (db.session
+                               .query(key)
+                               .filter(condition)
+                               .limit(batch_size))]
+        if not keys:
+            return
+
+        deleted = (model.query
+                   .filter(condition, key.in_(keys))
+                   .delete(synchronize_session=False))
+        db.session.commit()
+        yield deleted
+
+
+def _purge_messages(user_id, batch_size):
+    """Delete `user_id`'s messages, and everything pointing at them, a batch at a time."""
+
+    while True:
+        ids = [message_id for (message_id,) in (db.session
+                                                .query(Message.id)
+                                                .filter(Message.user_id == user_id)
+                                                .limit(batch_size))]
+        if not ids:
+            return
+
+        # A popular message can have any number of likes, so these are
+        # batched too.
+        for model, key, column in ((Likes, Likes.id, Likes.message_id),
+                                   (MessageTag, MessageTag.tag, MessageTag.message_id),
+                                   (Mention, Mention.user_id, Mention.message_id),
+                                   (Notification, Notification.id, Notification.target_id)):
+            for _ in _delete_in_batches(model, key, column.in_(ids), batch_size):
+                pass
+
+        threads.detach_replies(ids)
+        deleted = Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        yield deleted
+
+
+def _purge_follows(user_id, batch_size):
+    """Delete follows from and to `user_id`, telling the shared follow graph."""
+
+    graph_available = follow_graph.graph.available
+
+    for mine, theirs, is_follower in (
+            (Follows.user_following_id, Follows.user_being_followed_id, True),
+            (Follows.user_being_followed_id, Follows.user_following_id, False)):
+        while True:
+            others = [other for (other,) in (db.session
+                                             .query(theirs)
+                                             .filter(mine == user_id)
+                                             .limit(batch_size))]
+            if not others:
+                break
+
+            deleted = (Follows.query
+                       .filter(mine == user_id, theirs.in_(others))
+                       .delete(synchronize_session=False))
+            db.session.commit()
+
+            if graph_available:
+                follow_graph.graph.record_many(
+                    follow_graph.REMOVE,
+                    [(user_id, other) if is_follower else (other, user_id) for other in others])
+
+            yield deleted
+
+
+def _purge_archive(user_id):
+    """Take `user_id`'s messages, likes and mentions out of the archive (see archive.py)."""
+
+    # archive.py imports this module for its batched deletes.
+    from archive import archive
+
+    yield archive.purge_user(user_id)
+
+
+def _remove_from_notifications(user_id, batch_size):
+    """Take `user_id` out of other users' notifications, a batch at a time.
+
+    Each notification they're counted in loses one from its `actor_count`,
+    and gets another of its actors if they were its last one. Notifications
+    left with nobody (or with nobody to show) are deleted.
+    """
+
+    while True:
+        ids = {notification_id for (notification_id,) in
+               (db.session
+                .query(NotificationActor.notification_id)
+                .filter(NotificationActor.actor_id == user_id)
+                .limit(batch_size))}
+        # Notifications from before notification_actors only know their last actor.
+        ids.update(notification_id for (notification_id,) in
+                   (db.session
+                    .query(Notification.id)
+                    .filter(Notification.last_actor_id == user_id)
+                    .limit(batch_size)))
+        if not ids:
+            return
+
+        (NotificationActor.query
+         .filter(NotificationActor.actor_id == user_id,
+                 NotificationActor.notification_id.in_(ids))
+         .delete(synchronize_session=False))
+
+        other_actor = (db.select([db.func.max(NotificationActor.actor_id)])
+                       .where(NotificationActor.notification_id == Notification.id)
+                       .as_scalar())
+
+        (Notification.query
+         .filter(Notification.id.in_(ids),
+                 db.or_(Notification.actor_count <= 1,
+                        db.and_(Notification.last_actor_id == user_id, other_actor.is_(None))))
+         .delete(synchronize_session=False))
+        (Notification.query
+         .filter(Notification.id.in_(ids))
+         .update({Notification.actor_count: Notification.actor_count - 1},
+                 synchronize_session=False))
+        (Notification.query
+         .filter(Notification.id.in_(ids), Notification.last_actor_id == user_id)
+         .update({Notification.last_actor_id: other_actor}, synchronize_session=False))
+
+        db.session.commit()
+        yield len(ids)
+
+
+def purge_user(user_id, batch_size=DEFAULT_BATCH_SIZE, report=print):
+    """Delete a tombstoned user and all of their rows.
+
+    Calls `report` with a progress line after each batch. Returns False
+    (doing nothing) if the user doesn't exist or hasn't been tombstoned.
+    """
+
+    if not User.query.filter(User.id == user_id, User.deleted_at.isnot(None)).count():
+        return False
+
+    steps = (
+        ('messages', _purge_messages(user_id, batch_size)),
+        ('archived messages', _purge_archive(user_id)),
+        ('likes', _delete_in_batches(Likes, Likes.id, Likes.user_id == user_id, batch_size)),
+        ('follows', _purge_follows(user_id, batch_size)),
+        ('mentions', _delete_in_batches(Mention, Mention.message_id,
+                                        Mention.user_id == user_id, batch_size)),
+        ('notifications', _delete_in_batches(
+            Notification, Notification.id, Notification.recipient_id == user_id, batch_size)),
+        ('notification actors', _remove_from_notifications(user_id, batch_size)),
+        ('suggestions', _delete_in_batches(
+            Suggestion, Suggestion.suggested_user_id,
+            db.or_(Suggestion.user_id == user_id,
+                   Suggestion.suggested_user_id == user_id), batch_size)),
+    )
+
+    for name, batches in steps:
+        total = 0
+        for deleted in batches:
+            total += deleted
+            report(f"user {user_id}: deleted {total} {name}")
+
+    User.query.filter(User.id == user_id).delete(synchronize_session=False)
+    db.session.commit()
+    report(f"user {user_id}: purged")
+
+    return True
+
+
+def purge_tombstoned(batch_size=DEFAULT_BATCH_SIZE, report=print):
+    """Purge every tombstoned user; returns how many were purged."""
+
+    user_ids = [user_id for (user_id,) in (db.session
+                                           .query(User.id)
+                                           .filter(User.deleted_at.isnot(None))
+                                           .order_by(User.deleted_at))]
+
+    for user_id in user_ids:
+        purge_user(user_id, batch_size, report)
+
+    return len(user_ids)
+
+
+def purge_in_background(app, user_id):
+    """Purge `user_id` on a background thread, with an app context.
+
+    Progress goes to the app's log.
+    """
+
+    def run():
+        with app.app_context():
+            try:
+                purge_user(user_id, report=app.logger.info)
+            except Exception:
+                # Left tombstoned; the next purge_users.py run will finish it.
+                app.logger.exception(f"Purging user {user_id} failed")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+    threading.Thread(target=run, name=f'purge-user-{user_id}', daemon=True).start()
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    app = create_app()
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    with app.app_context():
+        count = purge_tombstoned(args.batch_size)
+        print(f"Purged {count} users")
@@ -0,0 +1,265 @@
+"""Token-bucket rate limiting for write endpoints.
+
+Each limited endpoint has a bucket per client IP and/or per logged-in user.
+A bucket holds up to `burst` tokens and refills at `rate` tokens a second;
+every request takes one token, and a request that finds its bucket empty is
+answered with 429 and a Retry-After saying when the next token is due.
+
+Limits are configured per endpoint in `RATE_LIMITS`, e.g.
+
+    {'warbler.messages_add': {'per_user': '30/minute', 'per_ip': '60/minute'}}
+
+Buckets live in one of two backends:
+
+- `MemoryBackend`: a dict in this process. Fastest, but each worker
+  process counts separately.
+- `SharedMemoryBackend`: a fixed-size hash table in a memory-mapped file
+  (RATELIMIT_STORAGE_PATH), shared by every worker on the host. Slots are
+  guarded by fcntl byte-range locks, so workers only contend on the same
+  slot stripe.
+"""
+
+import fcntl
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from hashlib import blake2b
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+# Buckets the memory backend keeps before evicting the least recently used.
+MEMORY_MAX_KEYS = 100000
+
+SHARED_SLOTS = 65536
+SHARED_LOCK_STRIPES = 256
+SHARED_PROBES = 8
+# key hash, tokens, last refill
+SLOT = struct.Struct('<Qdd')
+
+
+class Limit(namedtuple('Limit', 'rate burst')):
+    """`burst` requests at once, refilled at `rate` requests per second."""
+
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse "<count>/<second|minute|hour|day>", e.g. "30/minute"."""
+
+        count, _, period = spec.partition('/')
+        try:
+            count = int(count)
+            seconds = PERIODS[period.strip().lower()]
+        except (ValueError, KeyError):
+            raise ValueError(f"Bad rate limit {spec!r}; expected e.g. '30/minute'")
+
+        if count < 1:
+            raise ValueError(f"Bad rate limit {spec!r}; count must be at least 1")
+
+        return cls(count / seconds, count)
+
+
+def take(tokens, updated, now, limit):
+    """Refill a bucket to `now` and try to take a token.
+
+    Returns (allowed, tokens, retry_after) - the new token count, and if
+    not allowed, the seconds until a token is due.
+    """
+
+    tokens = min(limit.burst, tokens + max(0, now - updated) * limit.rate)
+
+    if tokens >= 1:
+        return True, tokens - 1, 0
+
+    return False, tokens, (1 - tokens) / limit.rate
+
+
+class MemoryBackend:
+    """Buckets in a dict, private to this process, least recently used first.
+
+    Past `max_keys` buckets, the least recently used are dropped: first any
+    idle for `refill_seconds` (long enough to be full again, so a fresh
+    bucket is equivalent), then, if every bucket is busy, the oldest anyway.
+    (As with the shared backend, that can only let a burst through.)
+    """
+
+    def __init__(self, max_keys=MEMORY_MAX_KEYS, refill_seconds=PERIODS['day']):
+        self.max_keys = max_keys
+        self.refill_seconds = refill_seconds
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, now):
+        """Take a token from `key`'s bucket; returns (allowed, retry_after)."""
+
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, None) or (limit.burst, now)
+            allowed, tokens, retry_after = take(tokens, updated, now, limit)
+            self._buckets[key] = (tokens, now)
+
+            if len(self._buckets) > self.max_keys:
+                self._evict(now)
+
+        return allowed, retry_after
+
+    def _evict(self, now):
+        """Drop idle buckets from the old end, and then the oldest, down to `max_keys`."""
+
+        idle_since = now - self.refill_seconds
+        buckets = self._buckets
+
+        while buckets:
+            _, updated = next(iter(buckets.values()))
+            if updated > idle_since:
+                break
+            buckets.popitem(last=False)
+
+        while len(buckets) > self.max_keys:
+            buckets.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SharedMemoryBackend:
+    """Buckets in a memory-mapped file shared by every process on the host.
+
+    Keys are hashed into an open-addressed table of `slots` slots, probing at
+    most SHARED_PROBES slots; if they're all taken, the least recently used
+    one is reclaimed. (A reclaimed bucket starts full, so the worst case is
+    letting a burst through, never wrongly refusing.)
+    """
+
+    def __init__(self, path, slots=SHARED_SLOTS):
+        self.path = path
+        self.slots = slots
+        size = slots * SLOT.size
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self._lock_file = open(f"{path}.lock", 'a')
+        # fcntl locks are per process, so threads also need a lock of their own.
+        self._thread_locks = [threading.Lock() for _ in range(SHARED_LOCK_STRIPES)]
+
+    @staticmethod
+    def _hash(key):
+        """Nonzero 64-bit hash of `key` (zero marks an empty slot)."""
+
+        return int.from_bytes(blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+    def hit(self, key, limit, now):
+        """Take a token from `key`'s bucket; returns (allowed, retry_after)."""
+
+        key_hash = self._hash(key)
+        # Probes stay within one stripe, so one lock covers them all.
+        per_stripe = self.slots // SHARED_LOCK_STRIPES
+        stripe = key_hash % SHARED_LOCK_STRIPES
+        first = stripe * per_stripe
+        start = key_hash // SHARED_LOCK_STRIPES % per_stripe
+
+        with self._thread_locks[stripe]:
+            fcntl.lockf(self._lock_file, fcntl.LOCK_EX, 1, stripe)
+            try:
+                slot = None
+                oldest = None
+
+                for probe in range(min(SHARED_PROBES, per_stripe)):
+                    offset = (first + (start + probe) % per_stripe) * SLOT.size
+                    slot_hash, tokens, updated = SLOT.unpack_from(self._map, offset)
+                    if slot_hash == key_hash:
+                        slot = offset
+                        break
+                    if slot_hash == 0:
+                        slot, tokens, updated = offset, limit.burst, now
+                        break
+                    if oldest is None or updated < oldest[1]:
+                        oldest = (offset, updated)
+                else:
+                    slot, tokens, updated = oldest[0], limit.burst, now
+
+                allowed, tokens, retry_after = take(tokens, updated, now, limit)
+                SLOT.pack_into(self._map, slot, key_hash, tokens, now)
+            finally:
+                fcntl.lockf(self._lock_file, fcntl.LOCK_UN, 1, stripe)
+
+        return allowed, retry_after
+
+    def clear(self):
+        self._map[:] = bytes(len(self._map))
+
+
+class RateLimiter:
+    """Checks requests against per-endpoint limits.
+
+    Call `configure` before use; until then nothing is limited. Each app
+    has one, at `app.extensions['ratelimit']`.
+    """
+
+    def __init__(self):
+        self.limits = {}
+        self.backend = MemoryBackend()
+        self.limited = 0
+
+    def configure(self, limits, storage_path=None):
+        """Use `limits` ({endpoint: {'per_user': spec, 'per_ip': spec}}) and a backend."""
+
+        self.limits = {endpoint: {scope: Limit.parse(spec) for scope, spec in scopes.items()}
+                       for endpoint, scopes in limits.items()}
+
+        if storage_path:
+            self.backend = SharedMemoryBackend(storage_path)
+        else:
+            # The longest any bucket takes to refill from empty.
+            refill_seconds = max((limit.burst / limit.rate for scopes in self.limits.values()
+                                  for limit in scopes.values()), default=0)
+            self.backend = MemoryBackend(refill_seconds=refill_seconds)
+
+    def check(self, endpoint, user_id, ip):
+        """Take a token for this request from each bucket that applies.
+
+        Returns None if the request may go ahead, otherwise the number of
+        seconds to wait (rounded up, for Retry-After).
+        """
+
+        scopes = self.limits.get(endpoint)
+        if not scopes:
+            return None
+
+        # Wall-clock time, since shared buckets outlive any one process.
+        now = time.time()
+        wait = 0
+
+        limit = scopes.get('per_ip')
+        if limit is not None:
+            allowed, retry_after = self.backend.hit(f"ip:{ip}:{endpoint}", limit, now)
+            if not allowed:
+                wait = retry_after
+
+        limit = scopes.get('per_user')
+        if limit is not None and user_id is not None and not wait:
+            allowed, retry_after = self.backend.hit(f"user:{user_id}:{endpoint}", limit, now)
+            if not allowed:
+                wait = retry_after
+
+        if not wait:
+            return None
+
+        self.limited += 1
+        return max(1, math.ceil(wait))
+
+    def stats(self):
+        """Counters for monitoring."""
+
+        return dict(limited=self.limited)
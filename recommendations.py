@@ -0,0 +1,187 @@
+"""Batch job computing "who to follow" suggestions from the follow graph.
+
+Run it from cron (or by hand) with:
+
+    python recommendations.py
+
+The whole `follows` table is loaded into a compressed sparse row (CSR)
+adjacency matrix, where A[i, j] == 1 means user i follows user j. For each
+user u and candidate v we then score:
+
+- friends-of-friends: (A @ A)[u, v], the number of people u follows who
+  follow v
+- common followers: (A.T @ A)[u, v], the number of people following both
+  u and v
+
+Rows are scored in chunks across a pool of worker processes, and the top
+suggestions for every user replace the contents of the `suggestions` table.
+"""
+
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from scipy import sparse
+
+from app import create_app
+from models import db, Follows, Suggestion
+
+SUGGESTIONS_PER_USER = 10
+FRIENDS_OF_FRIENDS_WEIGHT = 1.0
+COMMON_FOLLOWERS_WEIGHT = 0.5
+ROWS_PER_CHUNK = 2000
+EDGE_FETCH_SIZE = 100000
+INSERT_BATCH_SIZE = 10000
+
+# Matrices shared with pool workers; set by `_init_worker`.
+_following = None
+_followed_by = None
+
+
+def load_follow_graph():
+    """Load `follows` into a CSR adjacency matrix.
+
+    Returns (matrix, user_ids), where row/column i of the matrix is the user
+    with id user_ids[i].
+    """
+
+    result = db.session.execute(
+        db.select([Follows.user_following_id, Follows.user_being_followed_id])
+        .execution_options(stream_results=True))
+
+    followers = []
+    followed = []
+
+    while True:
+        rows = result.fetchmany(EDGE_FETCH_SIZE)
+        if not rows:
+            break
+        edges = np.array(rows, dtype=np.int64)
+        followers.append(edges[:, 0])
+        followed.append(edges[:, 1])
+
+    if not followers:
+        return sparse.csr_matrix((0, 0), dtype=np.float32), np.array([], dtype=np.int64)
+
+    followers = np.concatenate(followers)
+    followed = np.concatenate(followed)
+
+    # Compact the (possibly sparse) user ids to 0..n-1 matrix indices.
+    user_ids, indices = np.unique(np.concatenate([followers, followed]),
+                                  return_inverse=True)
+    rows = indices[:len(followers)]
+    cols = indices[len(followers):]
+
+    n = len(user_ids)
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                               shape=(n, n))
+    # Duplicate edges are summed on construction; clamp back to 0/1.
+    matrix.data[:] = 1
+
+    return matrix, user_ids
+
+
+def _init_worker(following, followed_by):
+    """Make the adjacency matrices available to a pool worker."""
+
+    global _following, _followed_by
+    _following = following
+    _followed_by = followed_by
+
+
+def score_rows(bounds):
+    """Score candidates for matrix rows [start, stop).
+
+    Returns a list of (row, candidate, score) arrays, at most
+    SUGGESTIONS_PER_USER per row, in descending score order.
+    """
+
+    start, stop = bounds
+    following = _following[start:stop]
+
+    scores = (FRIENDS_OF_FRIENDS_WEIGHT * (following @ _following)
+              + COMMON_FOLLOWERS_WEIGHT * (_followed_by[start:stop] @ _following))
+    scores = scores.tocsr()
+
+    results = []
+
+    for offset in range(stop - start):
+        row = start + offset
+        lo, hi = scores.indptr[offset], scores.indptr[offset + 1]
+        candidates = scores.indices[lo:hi]
+        row_scores = scores.data[lo:hi]
+
+        # Never suggest yourself or someone you already follow.
+        already = following.indices[following.indptr[offset]:following.indptr[offset + 1]]
+        keep = (candidates != row) & ~np.isin(candidates, already)
+        candidates = candidates[keep]
+        row_scores = row_scores[keep]
+
+        if not len(candidates):
+            continue
+
+        if len(candidates) > SUGGESTIONS_PER_USER:
+            top = np.argpartition(-row_scores, SUGGESTIONS_PER_USER)[:SUGGESTIONS_PER_USER]
+            candidates = candidates[top]
+            row_scores = row_scores[top]
+
+        order = np.argsort(-row_scores, kind='stable')
+        results.append((row, candidates[order], row_scores[order]))
+
+    return results
+
+
+def compute_suggestions(matrix, processes=None):
+    """Yield (row, candidates, scores) for every row of `matrix`."""
+
+    n = matrix.shape[0]
+    followed_by = matrix.T.tocsr()
+    chunks = [(start, min(start + ROWS_PER_CHUNK, n))
+              for start in range(0, n, ROWS_PER_CHUNK)]
+
+    with Pool(processes or cpu_count(),
+              initializer=_init_worker,
+              initargs=(matrix, followed_by)) as pool:
+        for chunk in pool.imap_unordered(score_rows, chunks):
+            yield from chunk
+
+
+def write_suggestions(suggestions, user_ids):
+    """Replace the contents of the `suggestions` table."""
+
+    Suggestion.query.delete()
+
+    batch = []
+
+    for row, candidates, scores in suggestions:
+        user_id = int(user_ids[row])
+        for rank, (candidate, score) in enumerate(zip(candidates, scores)):
+            batch.append(dict(user_id=user_id,
+                              rank=rank,
+                              suggested_user_id=int(user_ids[candidate]),
+                              score=float(score)))
+
+        if len(batch) >= INSERT_BATCH_SIZE:
+            db.session.bulk_insert_mappings(Suggestion, batch)
+            batch = []
+
+    if batch:
+        db.session.bulk_insert_mappings(Suggestion, batch)
+
+    db.session.commit()
+
+
+def main():
+    """Rebuild all follow suggestions."""
+
+    matrix, user_ids = load_follow_graph()
+    print(f"Loaded {matrix.nnz} follows between {len(user_ids)} users")
+
+    write_suggestions(compute_suggestions(matrix), user_ids)
+    print(f"Wrote {Suggestion.query.count()} suggestions")
+
+
+if __name__ == '__main__':
+    app = create_app()
+
+    with app.app_context():
+        main()
@@ -0,0 +1,136 @@
+"""Compact, immutable message records for in-process caches.
+
+A cached timeline entry doesn't need a full SQLAlchemy `Message` (identity
+map entry, instrumentation state, lazy relationships). `MessageRecord` keeps
+just what the timeline templates render, in `__slots__`, and shares one
+`AuthorCard` per author between all of that author's records.
+
+Records quack like `Message` as far as templates go: `message.id`,
+`message.text`, `message.timestamp`, `message.user_id` and
+`message.user.id` / `.username` / `.image_url` all work.
+"""
+
+from models import db, Message, User
+
+
+class _Frozen:
+    """Base for slotted records that can't be changed after construction."""
+
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+
+class AuthorCard(_Frozen):
+    """The bits of a `User` shown next to their messages."""
+
+    __slots__ = ('id', 'username', 'image_url')
+
+    def __init__(self, id, username, image_url):
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'username', username)
+        object.__setattr__(self, 'image_url', image_url)
+
+    def __repr__(self):
+        return f"<AuthorCard #{self.id}: {self.username}>"
+
+    def __eq__(self, other):
+        return isinstance(other, AuthorCard) and (self.id, self.username, self.image_url) == (
+            other.id, other.username, other.image_url)
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class MessageRecord(_Frozen):
+    """A message plus its author's card."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user')
+
+    def __init__(self, id, text, timestamp, user):
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'text', text)
+        object.__setattr__(self, 'timestamp', timestamp)
+        object.__setattr__(self, 'user', user)
+
+    def __repr__(self):
+        return f"<MessageRecord #{self.id}: user: {self.user.username}, {self.timestamp}>"
+
+    def __eq__(self, other):
+        return isinstance(other, MessageRecord) and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    @property
+    def user_id(self):
+        return self.user.id
+
+    @classmethod
+    def from_message(cls, message):
+        """Build a record from a `Message` (loads `message.user` if needed)."""
+
+        user = message.user
+        return cls(message.id, message.text, message.timestamp,
+                   AuthorCard(user.id, user.username, user.image_url))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build records from rows of `record_columns()`, sharing one card per author.
+
+        Any further columns are passed on to the constructor (see `ThreadRecord`).
+        """
+
+        cards = {}
+        records = []
+
+        for id, text, timestamp, user_id, username, image_url, *extra in rows:
+            card = cards.get(user_id)
+            if card is None:
+                card = cards[user_id] = AuthorCard(user_id, username, image_url)
+            records.append(cls(id, text, timestamp, card, *extra))
+
+        return records
+
+
+class ThreadRecord(MessageRecord):
+    """A message record plus its place in a reply thread."""
+
+    __slots__ = ('parent_id', 'path', 'depth', 'reply_count')
+
+    def __init__(self, id, text, timestamp, user, parent_id, path, depth, reply_count):
+        super().__init__(id, text, timestamp, user)
+        object.__setattr__(self, 'parent_id', parent_id)
+        object.__setattr__(self, 'path', path)
+        object.__setattr__(self, 'depth', depth)
+        object.__setattr__(self, 'reply_count', reply_count)
+
+    def __repr__(self):
+        return f"<ThreadRecord #{self.id}: user: {self.user.username}, depth {self.depth}>"
+
+
+def record_columns():
+    """Columns to select for `MessageRecord.from_rows`, in order."""
+
+    return (Message.id, Message.text, Message.timestamp,
+            User.id, User.username, User.image_url)
+
+
+def record_query():
+    """Query selecting `record_columns()` for messages joined to their (active) authors."""
+
+    return (db.session
+            .query(*record_columns())
+            .join(User, Message.user_id == User.id)
+            .filter(User.deleted_at.is_(None)))
+
+
+def thread_query():
+    """`record_query()` plus the columns `ThreadRecord.from_rows` needs."""
+
+    return record_query().add_columns(Message.parent_id, Message.path,
+                                      Message.depth, Message.reply_count)
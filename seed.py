@@ -1,9 +1,14 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from datetime import datetime
+from app import create_app
+from models import db, User, Message, Follows
+from partitions import ensure_partitions, is_partitioned
+from snowflake import ids_for_datetimes
 
+app = create_app()
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -12,7 +17,27 @@ with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    # Message ids are time-ordered, so derive them from the CSV timestamps.
+    rows = list(DictReader(messages))
+    for row in rows:
+        row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+    rows.sort(key=lambda row: row['timestamp'])
+
+    timestamps = [row['timestamp'] for row in rows]
+    for row, message_id in zip(rows, ids_for_datetimes(timestamps)):
+        row['id'] = message_id
+
+    with db.engine.begin() as connection:
+        if is_partitioned(connection):
+            ensure_partitions(connection, since=timestamps[0])
+
+    db.session.bulk_insert_mappings(Message, rows)
+
+    # Bulk inserts skip the hooks that keep users.message_count.
+    User.query.update({User.message_count: (db.select([db.func.count()])
+                                            .where(Message.user_id == User.id)
+                                            .as_scalar())},
+                      synchronize_session=False)
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
@@ -0,0 +1,216 @@
+"""Slow query log.
+
+Every statement run through SQLAlchemy is timed (two engine events, so the
+cost is a couple of clock reads). Statements slower than `threshold` seconds
+are recorded with:
+
+- the SQL, and the shape (types / lengths) of its bound parameters, not
+  their values
+- the Flask endpoint that ran it
+- on Postgres, for a sampled fraction (`explain_rate`) of slow SELECTs, the
+  `EXPLAIN (ANALYZE, BUFFERS)` plan, captured on the same connection.
+  ANALYZE runs the statement again, so only plain SELECTs are explained (not
+  WITH, whose CTEs may modify data, nor SELECT ... FOR UPDATE / INTO), and
+  always inside a savepoint that's rolled back
+
+Each slow query is appended as a JSON line to a rotating log file, and
+folded into an in-memory table of the worst statements in this process,
+shown at /admin/slow-queries.
+"""
+
+import json
+import logging
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import metrics
+
+DEFAULT_THRESHOLD = 0.1
+DEFAULT_EXPLAIN_RATE = 0.1
+DEFAULT_TOP_N = 50
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_EXPLAINABLE_RE = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+# SELECTs that lock or write rows.
+_UNEXPLAINABLE_RE = re.compile(
+    r'\bFOR\s+(UPDATE|NO\s+KEY\s+UPDATE|SHARE|KEY\s+SHARE)\b|\bINTO\b', re.IGNORECASE)
+
+
+def explainable(statement):
+    """Is `statement` a plain SELECT, safe to run again under EXPLAIN ANALYZE?"""
+
+    return bool(_EXPLAINABLE_RE.match(statement)) and not _UNEXPLAINABLE_RE.search(statement)
+
+
+def parameter_shape(value):
+    """Describe a bound parameter without its value, e.g. 'int' or 'list[120]'."""
+
+    if isinstance(value, (list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    if isinstance(value, str):
+        return 'str'
+    return type(value).__name__
+
+
+def parameter_shapes(parameters, executemany=False):
+    """Shapes of a statement's parameters (a dict, a sequence, or many of either)."""
+
+    if executemany:
+        rows = list(parameters)
+        return dict(rows=len(rows), first=parameter_shapes(rows[0]) if rows else None)
+    if isinstance(parameters, dict):
+        return {name: parameter_shape(value) for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [parameter_shape(value) for value in parameters]
+    return None
+
+
+class SlowQueryLog:
+    """Records statements slower than `threshold` seconds."""
+
+    def __init__(self):
+        self.threshold = DEFAULT_THRESHOLD
+        self.explain_rate = DEFAULT_EXPLAIN_RATE
+        self.top_n = DEFAULT_TOP_N
+        self.enabled = False
+        self.recorded = 0
+        self.explained = 0
+        self._top = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger('warbler.slow_queries')
+        self._logger.propagate = False
+        self._handler = None
+
+    def configure(self, threshold=DEFAULT_THRESHOLD, explain_rate=DEFAULT_EXPLAIN_RATE,
+                  top_n=DEFAULT_TOP_N, log_path=None):
+        """Set the threshold (seconds; None turns recording off), sampling and log file."""
+
+        self.enabled = threshold is not None
+        self.threshold = threshold
+        self.explain_rate = explain_rate
+        self.top_n = top_n
+
+        if self._handler is not None:
+            self._logger.removeHandler(self._handler)
+            self._handler.close()
+            self._handler = None
+
+        if log_path:
+            self._handler = RotatingFileHandler(log_path, maxBytes=LOG_MAX_BYTES,
+                                                backupCount=LOG_BACKUPS, delay=True)
+            self._logger.addHandler(self._handler)
+            self._logger.setLevel(logging.INFO)
+
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    def _explain(self, cursor, statement, parameters):
+        """EXPLAIN (ANALYZE, BUFFERS) `statement` on the cursor's connection.
+
+        Runs inside a savepoint that's rolled back whether or not it worked,
+        so nothing the statement did is kept.
+        """
+
+        explain_cursor = cursor.connection.cursor()
+        try:
+            explain_cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                explain_cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {statement}", parameters)
+                plan = "\n".join(row[0] for row in explain_cursor.fetchall())
+            except Exception as error:
+                plan = f"EXPLAIN failed: {error}"
+            finally:
+                explain_cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                explain_cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+            return plan
+        finally:
+            explain_cursor.close()
+
+    def record(self, conn, cursor, statement, parameters, executemany, elapsed):
+        """Log a slow statement and add it to the top table."""
+
+        plan = None
+        if (conn.dialect.name == 'postgresql' and not executemany
+                and explainable(statement) and random.random() < self.explain_rate):
+            plan = self._explain(cursor, statement, parameters)
+
+        sql = _WHITESPACE_RE.sub(' ', statement).strip()
+        entry = dict(at=datetime.utcnow().isoformat(),
+                     duration=elapsed,
+                     endpoint=request.endpoint if has_request_context() else None,
+                     sql=sql,
+                     parameters=parameter_shapes(parameters, executemany),
+                     plan=plan)
+
+        self._logger.info(json.dumps(entry, default=str))
+
+        with self._lock:
+            self.recorded += 1
+            if plan is not None:
+                self.explained += 1
+
+            stats = self._top.get(sql)
+            if stats is None:
+                stats = self._top[sql] = dict(sql=sql, count=0, total=0.0, max=0.0,
+                                              endpoints=set(), parameters=None, plan=None)
+            stats['count'] += 1
+            stats['total'] += elapsed
+            stats['endpoints'].add(entry['endpoint'])
+            if elapsed >= stats['max']:
+                stats['max'] = elapsed
+                stats['parameters'] = entry['parameters']
+            if plan is not None:
+                stats['plan'] = plan
+
+            if len(self._top) > 2 * self.top_n:
+                self._top = {s['sql']: s for s in self._worst()[:self.top_n]}
+
+    def _worst(self):
+        return sorted(self._top.values(), key=lambda s: s['total'], reverse=True)
+
+    def top(self):
+        """The worst statements seen by this process, by total time spent in them."""
+
+        with self._lock:
+            return [dict(stats, endpoints=sorted(e or '' for e in stats['endpoints']))
+                    for stats in self._worst()[:self.top_n]]
+
+    def reset(self):
+        with self._lock:
+            self._top.clear()
+
+    def stats(self):
+        """Counters for monitoring."""
+
+        return dict(recorded=self.recorded, explained=self.explained)
+
+
+slow_query_log = SlowQueryLog()
+
+metrics.register('slow_queries', slow_query_log.stats)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if slow_query_log.enabled:
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start_time')
+    if not starts:
+        return
+
+    elapsed = time.perf_counter() - starts.pop()
+    if slow_query_log.enabled and elapsed >= slow_query_log.threshold:
+        slow_query_log.record(conn, cursor, statement, parameters, executemany, elapsed)
@@ -0,0 +1,164 @@
+"""Time-ordered 64-bit ids ("snowflakes") for messages.
+
+An id packs, from the most significant bit down:
+
+- 41 bits: milliseconds since EPOCH
+- 10 bits: worker id
+- 12 bits: per-worker sequence within the millisecond
+
+so sorting by id sorts by creation time (to the millisecond) across all
+workers, and timelines can order and paginate on the primary key alone.
+"""
+
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# 2015-01-01T00:00:00Z, in milliseconds since the Unix epoch.
+EPOCH = 1420070400000
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+# For processes not run by gunicorn; its workers count up from
+# WARBLER_WORKER_ID_BASE (see gunicorn.conf.py).
+DEV_WORKER_ID = MAX_WORKER_ID
+
+
+def default_worker_id():
+    """Worker id from $WARBLER_WORKER_ID, or DEV_WORKER_ID outside gunicorn.
+
+    Two processes minting ids under the same worker id can mint the same
+    id. gunicorn.conf.py gives each worker its own, so under gunicorn an
+    unset id is a mistake. One-off processes (`flask run`, seed.py, scripts)
+    fall back to DEV_WORKER_ID, which gunicorn's slots don't reach; run at
+    most one of those at a time against a database, or set the variable.
+    """
+
+    worker_id = os.environ.get('WARBLER_WORKER_ID')
+
+    if worker_id is None:
+        if 'gunicorn' in sys.modules:
+            raise RuntimeError(
+                "WARBLER_WORKER_ID is not set: give every process that writes messages "
+                f"a worker id between 0 and {MAX_WORKER_ID}, unique across all hosts")
+        return DEV_WORKER_ID
+
+    worker_id = int(worker_id)
+    if not 0 <= worker_id <= MAX_WORKER_ID:
+        raise ValueError(f"WARBLER_WORKER_ID must be between 0 and {MAX_WORKER_ID}")
+
+    return worker_id
+
+
+def _datetime_to_ms(dt):
+    """Milliseconds since the Unix epoch for `dt` (naive datetimes are UTC)."""
+
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+
+    return int(dt.timestamp() * 1000)
+
+
+def id_for_datetime(dt, worker_id=0, sequence=0):
+    """Smallest id that could have been generated at `dt`.
+
+    Handy as a keyset bound: `Message.id >= id_for_datetime(since)`.
+    """
+
+    return (((_datetime_to_ms(dt) - EPOCH) << TIMESTAMP_SHIFT)
+            | (worker_id << SEQUENCE_BITS)
+            | sequence)
+
+
+def datetime_for_id(snowflake):
+    """Naive UTC datetime (millisecond precision) at which `snowflake` was made."""
+
+    ms = (snowflake >> TIMESTAMP_SHIFT) + EPOCH
+    return datetime.utcfromtimestamp(ms / 1000)
+
+
+def ids_for_datetimes(datetimes, last=-1):
+    """Yield unique, increasing ids for an ascending sequence of datetimes.
+
+    Used when backfilling ids for existing rows: each id is the id for its
+    timestamp, or one more than the previous id if that would collide. Pass
+    the last id of a previous batch as `last` to continue from it.
+    """
+
+    for dt in datetimes:
+        last = max(id_for_datetime(dt), last + 1)
+        yield last
+
+
+class SnowflakeGenerator:
+    """Thread-safe generator of snowflake ids for a single worker."""
+
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be between 0 and {MAX_WORKER_ID}")
+
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def __repr__(self):
+        return f"<SnowflakeGenerator worker={self.worker_id}>"
+
+    def next_id(self):
+        """Return the next id from this worker."""
+
+        with self._lock:
+            now = int(time.time() * 1000)
+
+            # If the clock went backwards, keep issuing ids from the last
+            # millisecond we saw rather than risk duplicates.
+            if now < self._last_ms:
+                now = self._last_ms
+
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond; wait for the next.
+                    while now <= self._last_ms:
+                        now = int(time.time() * 1000)
+            else:
+                self._sequence = 0
+
+            self._last_ms = now
+
+            return (((now - EPOCH) << TIMESTAMP_SHIFT)
+                    | (self.worker_id << SEQUENCE_BITS)
+                    | self._sequence)
+
+
+_generator = None
+_generator_pid = None
+_generator_lock = threading.Lock()
+
+
+def next_message_id():
+    """Next message id for this process.
+
+    The generator is created lazily and re-created after a fork, so workers
+    forked from a preloaded master don't share a worker id.
+    """
+
+    global _generator, _generator_pid
+
+    pid = os.getpid()
+
+    if _generator_pid != pid:
+        with _generator_lock:
+            if _generator_pid != pid:
+                _generator = SnowflakeGenerator(default_worker_id())
+                _generator_pid = pid
+
+    return _generator.next_id()
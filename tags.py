@@ -0,0 +1,96 @@
+"""Hashtag and @mention indexing.
+
+Tags and mentions are parsed out of a message when it's posted and written
+to `message_tags` / `mentions`, so tag and mention feeds are index range
+scans instead of text searches over every message.
+"""
+
+import re
+
+from models import db, Message, MessageTag, Mention, User
+from records import MessageRecord, record_query
+
+HASHTAG_RE = re.compile(r'(?<![\w&])#(\w{1,100})')
+MENTION_RE = re.compile(r'(?<![\w@])@([\w.]*\w)')
+
+
+def extract_tags(text):
+    """Set of (lowercased) hashtags in `text`, without the '#'."""
+
+    return {tag.lower() for tag in HASHTAG_RE.findall(text)}
+
+
+def extract_mentions(text):
+    """Set of usernames @mentioned in `text`, without the '@'."""
+
+    return set(MENTION_RE.findall(text))
+
+
+def tag_and_mention_rows(messages):
+    """Rows for `message_tags` and `mentions` for `messages`.
+
+    Mentioned usernames are resolved to users in a single query; unknown
+    usernames are ignored.
+    """
+
+    tag_rows = []
+    mentioned = {}
+
+    for message in messages:
+        tag_rows.extend(dict(tag=tag, message_id=message.id)
+                        for tag in extract_tags(message.text))
+        mentioned[message.id] = extract_mentions(message.text)
+
+    usernames = set().union(*mentioned.values())
+    user_ids = {}
+    if usernames:
+        user_ids = dict(db.session
+                        .query(User.username, User.id)
+                        .filter(User.username.in_(usernames), User.deleted_at.is_(None)))
+
+    mention_rows = [dict(user_id=user_ids[username], message_id=message_id)
+                    for message_id, names in mentioned.items()
+                    for username in names
+                    if username in user_ids]
+
+    return tag_rows, mention_rows
+
+
+def index_messages(messages):
+    """Add tag and mention rows for `messages` to the session.
+
+    The messages must already have ids (i.e. have been flushed).
+    """
+
+    tag_rows, mention_rows = tag_and_mention_rows(messages)
+
+    if tag_rows:
+        db.session.bulk_insert_mappings(MessageTag, tag_rows)
+    if mention_rows:
+        db.session.bulk_insert_mappings(Mention, mention_rows)
+
+
+def tag_feed(tag, limit, before=None):
+    """Newest `limit` messages tagged `tag`, older than message id `before`."""
+
+    query = (record_query()
+             .join(MessageTag, MessageTag.message_id == Message.id)
+             .filter(MessageTag.tag == tag.lower()))
+
+    if before:
+        query = query.filter(MessageTag.message_id < before)
+
+    return MessageRecord.from_rows(query.order_by(MessageTag.message_id.desc()).limit(limit))
+
+
+def mention_feed(user_id, limit, before=None):
+    """Newest `limit` messages mentioning `user_id`, older than message id `before`."""
+
+    query = (record_query()
+             .join(Mention, Mention.message_id == Message.id)
+             .filter(Mention.user_id == user_id))
+
+    if before:
+        query = query.filter(Mention.message_id < before)
+
+    return MessageRecord.from_rows(query.order_by(Mention.message_id.desc()).limit(limit))
@@ -0,0 +1,117 @@
+"""App factory and warm-up tests."""
+
+from unittest import TestCase, mock
+
+from sqlalchemy import event
+
+import app as app_module
+from app import create_app, warm_up
+from models import db
+from testing import DatabaseTestCase, app, isolate_services
+
+
+class CreateAppTestCase(TestCase):
+    """Test building apps."""
+
+    def test_importing_builds_no_app(self):
+        """Is an app only made when asked for?"""
+
+        self.assertFalse(hasattr(app_module, 'app'))
+
+    def tearDown(self):
+        isolate_services()
+
+    def test_state_is_per_app(self):
+        """Does each app get its own limiter and compressor, configured from its settings?"""
+
+        settings = dict(SQLALCHEMY_DATABASE_URI='sqlite://', JINJA_BYTECODE_CACHE_DIR=None,
+                        SLOW_QUERY_LOG=None)
+        first = create_app(dict(settings, RATE_LIMITS={'warbler.login': {'per_ip': '1/minute'}},
+                                COMPRESSION_MIN_SIZE=''))
+        second = create_app(dict(settings, RATE_LIMITS={}, COMPRESSION_MIN_SIZE='100'))
+
+        self.assertIsNot(first.extensions['ratelimit'], second.extensions['ratelimit'])
+        self.assertIn('warbler.login', first.extensions['ratelimit'].limits)
+        self.assertEqual(second.extensions['ratelimit'].limits, {})
+        self.assertIsNone(first.extensions['compression'].min_size)
+        self.assertEqual(second.extensions['compression'].min_size, 100)
+
+    def test_rate_limits_forwarded_client_ips(self):
+        """Behind a trusted proxy, does each forwarded client IP get its own bucket?"""
+
+        proxied = create_app(dict(SQLALCHEMY_DATABASE_URI='sqlite://', JINJA_BYTECODE_CACHE_DIR=None,
+                                  SLOW_QUERY_LOG=None, TRUSTED_PROXIES=1,
+                                  RATE_LIMITS={'warbler.login': {'per_ip': '1/minute'}},
+                                  RATELIMIT_STORAGE_PATH=None))
+        client = proxied.test_client()
+
+        def login(client_ip):
+            return client.post("/login", environ_base={'REMOTE_ADDR': '127.0.0.1'},
+                               headers={'X-Forwarded-For': client_ip}).status_code
+
+        self.assertNotEqual(login('203.0.113.1'), 429)
+        self.assertEqual(login('203.0.113.1'), 429)
+        self.assertNotEqual(login('203.0.113.2'), 429)
+
+    def test_apps_keep_their_own_database(self):
+        """Does making an app leave the database of the app the tests use alone?"""
+
+        create_app(dict(SQLALCHEMY_DATABASE_URI='sqlite://', JINJA_BYTECODE_CACHE_DIR=None,
+                        SLOW_QUERY_LOG=None))
+
+        self.assertEqual(str(db.engine.url), app.config['SQLALCHEMY_DATABASE_URI'])
+
+
+class MetricsTestCase(TestCase):
+    """Test who may scrape /metrics."""
+
+    def setUp(self):
+        self.client = create_app(dict(SQLALCHEMY_DATABASE_URI='sqlite://', JINJA_BYTECODE_CACHE_DIR=None,
+                                      SLOW_QUERY_LOG=None, METRICS_TOKEN='s3cret')).test_client()
+
+    def tearDown(self):
+        isolate_services()
+
+    def scrape(self, remote_addr, **headers):
+        return self.client.get("/metrics", environ_base={'REMOTE_ADDR': remote_addr},
+                               headers=headers).status_code
+
+    def test_loopback(self):
+        """Can a scraper on this host read the metrics without a token?"""
+
+        self.assertEqual(self.scrape('127.0.0.1'), 200)
+        self.assertEqual(self.scrape('::1'), 200)
+
+    def test_token(self):
+        """Are remote scrapers let in with the token, and only with it?"""
+
+        self.assertEqual(self.scrape('203.0.113.1'), 403)
+        self.assertEqual(self.scrape('203.0.113.1', Authorization='Bearer wrong'), 403)
+        self.assertEqual(self.scrape('203.0.113.1', Authorization='Bearer s3cret'), 200)
+
+
+class WarmUpTestCase(DatabaseTestCase):
+    """Test the pre-fork warm-up."""
+
+    def test_warm_up(self):
+        """Are templates compiled and the hot queries run, leaving the app serving?"""
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            with mock.patch('app.availability') as availability:
+                warm_up(app)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        availability.refresh.assert_called_once_with()
+
+        self.assertIn('home.html', {name for _, name in app.jinja_env.cache.keys()})
+        self.assertTrue(any('FROM users' in statement for statement in statements))
+        self.assertTrue(any('FROM follows' in statement for statement in statements))
+
+        self.assertEqual(self.client.get("/").status_code, 200)
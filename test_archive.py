@@ -0,0 +1,202 @@
+"""Message archive tests."""
+
+import json
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase, mock
+
+import zstandard
+
+import partitions
+import threads
+from archive import drop_month, MessageArchive, write_month
+from models import db, Likes, Mention, Message, MessageTag, User
+from snowflake import id_for_datetime
+from testing import DatabaseTestCase, fixture_ids
+
+
+def write_archive(directory, name, min_id, max_id, messages_by_user):
+    """Write an archived month the way archive.write_month lays it out."""
+
+    users = {}
+    offset = 0
+    compressor = zstandard.ZstdCompressor()
+
+    with open(os.path.join(directory, f"{name}.ndjson.zst"), 'wb') as out:
+        for user_id, messages in messages_by_user.items():
+            frame = compressor.compress("".join(json.dumps(m) + "\n" for m in messages).encode())
+            out.write(frame)
+            users[str(user_id)] = [offset, len(frame), len(messages)]
+            offset += len(frame)
+
+    with open(os.path.join(directory, f"{name}.index.json"), 'w') as out:
+        json.dump(dict(month=name, min_id=min_id, max_id=max_id, users=users), out)
+
+
+def message(id, user_id):
+    return dict(id=id, text=f"message {id}", timestamp="2020-01-01T00:00:00", user_id=user_id)
+
+
+class MessageArchiveTestCase(TestCase):
+    """Test reading one user's messages back out of archived months."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        write_archive(self.dir.name, '2020-01', 100, 199,
+                      {1: [message(150, 1), message(120, 1)], 2: [message(130, 2)]})
+        write_archive(self.dir.name, '2020-02', 200, 299,
+                      {1: [message(250, 1), message(210, 1)]})
+        self.archive = MessageArchive()
+        self.archive.configure(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def ids(self, messages):
+        return [m['id'] for m in messages]
+
+    def test_user_messages_newest_first(self):
+        """Are pages read newest first across months, honouring `before`?"""
+
+        self.assertEqual(self.ids(self.archive.user_messages(1, 3)), [250, 210, 150])
+        self.assertEqual(self.ids(self.archive.user_messages(1, 10, before=210)), [150, 120])
+        self.assertEqual(self.archive.user_messages(3, 10), [])
+
+    def test_iter_oldest_first(self):
+        """Are all messages after `after` yielded oldest first?"""
+
+        self.assertEqual(self.ids(self.archive.iter_user_messages(1, after=120)), [150, 210, 250])
+
+    def test_message_count(self):
+        self.assertEqual(self.archive.message_count(1), 4)
+        self.assertEqual(self.archive.message_count(2), 1)
+
+    def test_no_directory(self):
+        """Is a missing archive directory just an empty archive?"""
+
+        self.archive.configure(os.path.join(self.dir.name, 'missing'))
+
+        self.assertEqual(self.archive.user_messages(1, 10), [])
+        self.assertEqual(self.archive.message_count(1), 0)
+
+    def test_catalog_cached_until_directory_changes(self):
+        """Is the directory only listed again once a month has been added?"""
+
+        self.archive.message_count(1)
+        # Old enough that the cached listing is trusted.
+        os.utime(self.dir.name, (0, 0))
+        self.archive.message_count(1)
+
+        with mock.patch('archive.os.listdir', side_effect=AssertionError("listed again")):
+            self.assertEqual(self.archive.message_count(1), 4)
+            self.assertEqual(self.archive.user_messages(3, 10), [])
+
+        write_archive(self.dir.name, '2020-03', 300, 399, {3: [message(300, 3)]})
+
+        self.assertEqual(self.archive.message_count(3), 1)
+        self.assertEqual(self.ids(self.archive.user_messages(3, 10)), [300])
+
+
+class WriteMonthTestCase(DatabaseTestCase):
+    """Test archiving a month out of the database and dropping it."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.archive = MessageArchive()
+        self.archive.configure(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+        super().tearDown()
+
+    def test_related_rows_archived_before_drop(self):
+        """Are a month's likes, tags and mentions archived with its messages, then dropped?"""
+
+        author, liker = fixture_ids['testuser'], fixture_ids['otheruser']
+        msg = Message(text="#news for @otheruser", user_id=author)
+        db.session.add(msg)
+        db.session.commit()
+        message_id = msg.id
+        db.session.add_all([Likes(user_id=liker, message_id=message_id),
+                            MessageTag(tag='news', message_id=message_id),
+                            Mention(user_id=liker, message_id=message_id)])
+        db.session.commit()
+        like_id = Likes.query.one().id
+
+        month = partitions.month_for_id(message_id)
+        self.assertEqual(write_month(month, self.dir.name), 1)
+        drop_month(month)
+
+        for model in (Message, Likes, MessageTag, Mention):
+            self.assertEqual(model.query.count(), 0, model.__name__)
+
+        self.assertEqual(self.archive.index(month)['related'],
+                         dict(likes=1, tags=1, mentions=1))
+        self.assertEqual(list(self.archive.related(month, 'likes')),
+                         [dict(id=like_id, user_id=liker, message_id=message_id)])
+        self.assertEqual(list(self.archive.related(month, 'tags')),
+                         [dict(tag='news', message_id=message_id)])
+        self.assertEqual(list(self.archive.related(month, 'mentions')),
+                         [dict(user_id=liker, message_id=message_id)])
+        self.assertEqual([m['text'] for m in self.archive.user_messages(author, 10)],
+                         ["#news for @otheruser"])
+
+    def test_purge_user(self):
+        """Is a purged user taken out of an archived month, leaving everyone else readable?"""
+
+        author = fixture_ids['testuser']
+        gone = User(username="gone", email="gone@test.com", password="HASHED_PASSWORD")
+        db.session.add(gone)
+        db.session.commit()
+        gone_id = gone.id
+
+        mine = Message(text="#news for @gone", user_id=author)
+        theirs = Message(text="#news from gone", user_id=gone_id)
+        db.session.add_all([mine, theirs])
+        db.session.commit()
+        mine_id, theirs_id = mine.id, theirs.id
+        db.session.add_all([Likes(user_id=gone_id, message_id=mine_id),
+                            Likes(user_id=author, message_id=theirs_id),
+                            MessageTag(tag='news', message_id=mine_id),
+                            MessageTag(tag='news', message_id=theirs_id),
+                            Mention(user_id=gone_id, message_id=mine_id)])
+        db.session.commit()
+
+        month = partitions.month_for_id(mine_id)
+        write_month(month, self.dir.name)
+
+        self.assertEqual(self.archive.purge_user(gone_id), 1)
+
+        self.assertEqual(self.archive.message_counts(), {author: 1})
+        self.assertEqual(self.archive.user_messages(gone_id, 10), [])
+        self.assertEqual([m['id'] for m in self.archive.user_messages(author, 10)], [mine_id])
+        self.assertEqual(list(self.archive.related(month, 'likes')), [])
+        self.assertEqual(list(self.archive.related(month, 'tags')),
+                         [dict(tag='news', message_id=mine_id)])
+        self.assertEqual(list(self.archive.related(month, 'mentions')), [])
+        self.assertEqual(self.archive.index(month)['related'], dict(likes=0, tags=1, mentions=0))
+        self.assertEqual(self.archive.index(month)['count'], 1)
+
+        # Nothing left to do the second time.
+        self.assertEqual(self.archive.purge_user(gone_id), 0)
+
+    def test_drop_recounts_older_parents(self):
+        """Do parents older than a dropped month stop counting its replies?"""
+
+        author = fixture_ids['testuser']
+        parent = Message(id=id_for_datetime(datetime(2020, 1, 15)), text="old",
+                         user_id=author)
+        db.session.add(parent)
+        db.session.commit()
+        threads.add_reply(parent, author, "new reply")
+        db.session.commit()
+        self.assertEqual(Message.query.get(parent.id).reply_count, 1)
+
+        reply = Message.query.filter(Message.parent_id == parent.id).one()
+        drop_month(partitions.month_for_id(reply.id))
+        db.session.expire_all()
+
+        self.assertEqual(Message.query.get(parent.id).reply_count, 0)
@@ -0,0 +1,85 @@
+"""Username / email availability tests."""
+
+from datetime import datetime
+from unittest import mock
+
+from availability import AvailabilityService
+from models import db, User
+from testing import DatabaseTestCase
+
+
+class AvailabilityTestCase(DatabaseTestCase):
+    """Test the filters staying in step with the users table."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.service = AvailabilityService(capacity=1000)
+        self.service.rebuild()
+
+    def test_taken_and_free(self):
+        """Are fixture users taken, and unknown names free?"""
+
+        self.assertFalse(self.service.username_available("testuser"))
+        self.assertFalse(self.service.email_available("otheruser@test.com"))
+        self.assertTrue(self.service.username_available("nobody"))
+        self.assertTrue(self.service.email_available("nobody@test.com"))
+
+    def test_refresh_picks_up_renames_elsewhere(self):
+        """Is a rename made by another worker (so never `add`ed here) picked up?"""
+
+        user = self.fixture_user("otheruser")
+        user.username = "renamed"
+        user.renamed_at = datetime.utcnow()
+        db.session.commit()
+
+        self.service.refresh(force=True)
+
+        self.assertIn("renamed", self.service._usernames)
+        self.assertFalse(self.service.username_available("renamed"))
+
+    def test_refresh_picks_up_new_users(self):
+        """Are users signed up by another worker picked up?"""
+
+        db.session.add(User(username="newcomer", email="newcomer@test.com", password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        self.service.refresh(force=True)
+
+        self.assertIn("newcomer", self.service._usernames)
+
+    def test_add_during_rebuild_is_kept(self):
+        """Does a name added while a rebuild is loading survive the swap?"""
+
+        load_users = self.service._load_users
+
+        def load_then_add(usernames, emails, after_id):
+            loaded_through = load_users(usernames, emails, after_id)
+            self.service.add("midway", "midway@test.com")
+            return loaded_through
+
+        with mock.patch.object(self.service, '_load_users', side_effect=load_then_add):
+            self.service.rebuild()
+
+        self.assertIn("midway", self.service._usernames)
+        self.assertIn("midway@test.com", self.service._emails)
+        self.assertIsNone(self.service._added_during_rebuild)
+
+    def test_refresh_queries_outside_lock(self):
+        """Can lookups and adds go ahead while a refresh is querying?"""
+
+        load_users = self.service._load_users
+        held = []
+
+        def load_and_check(usernames, emails, after_id):
+            held.append(self.service._lock.locked())
+            return load_users(usernames, emails, after_id)
+
+        db.session.add(User(username="newcomer", email="newcomer@test.com", password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        with mock.patch.object(self.service, '_load_users', side_effect=load_and_check):
+            self.service.refresh(force=True)
+
+        self.assertEqual(held, [False])
+        self.assertIn("newcomer", self.service._usernames)
@@ -0,0 +1,50 @@
+"""Bloom filter tests."""
+
+from unittest import TestCase
+
+from bloom import BloomFilter
+
+
+class BloomFilterTestCase(TestCase):
+    """Test the Bloom filter behind username availability checks."""
+
+    def test_no_false_negatives(self):
+        """Is every added item reported as present?"""
+
+        bloom = BloomFilter(capacity=1000)
+        names = [f"user{i}" for i in range(1000)]
+        for name in names:
+            bloom.add(name)
+
+        self.assertTrue(all(name in bloom for name in names))
+
+    def test_false_positive_rate(self):
+        """Do unseen items rarely show up as present?"""
+
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"user{i}")
+
+        false_positives = sum(f"other{i}" in bloom for i in range(10000))
+
+        self.assertLess(false_positives, 300)
+
+    def test_saturated(self):
+        """Does the filter know when it's over capacity?"""
+
+        bloom = BloomFilter(capacity=2)
+        bloom.add("a")
+        bloom.add("b")
+        self.assertFalse(bloom.saturated)
+
+        bloom.add("c")
+        self.assertTrue(bloom.saturated)
+
+    def test_invalid_arguments(self):
+        """Are nonsense sizes rejected?"""
+
+        with self.assertRaises(ValueError):
+            BloomFilter(capacity=0)
+
+        with self.assertRaises(ValueError):
+            BloomFilter(capacity=10, error_rate=1.5)
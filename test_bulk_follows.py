@@ -0,0 +1,87 @@
+"""Bulk follow tests."""
+
+from unittest import TestCase, mock
+
+from bulk_follows import (ALREADY_FOLLOWING, FOLLOWED, follow_many, NOT_FOUND, parse_target,
+                          targets_from_csv)
+from models import db, Follows, User
+from testing import DatabaseTestCase
+from write_behind import FOLLOW, write_queue
+
+
+class BulkFollowsTestCase(TestCase):
+    """Test reading follow targets."""
+
+    def test_parse_target(self):
+        """Are ints read as ids, digits as either and anything else as a username?"""
+
+        self.assertEqual(parse_target(12), ('id', 12))
+        self.assertEqual(parse_target(' 12 '), ('id_or_username', '12'))
+        self.assertEqual(parse_target('@12'), ('username', '12'))
+        self.assertEqual(parse_target('@alice'), ('username', 'alice'))
+        self.assertEqual(parse_target('bob'), ('username', 'bob'))
+
+    def test_targets_from_csv(self):
+        """Is the first column read, minus a header and blank rows?"""
+
+        text = "username,note\r\nalice,friend\r\n\r\n 42 \r\n,\r\n@bob\r\n"
+
+        self.assertEqual(targets_from_csv(text), ['alice', '42', '@bob'])
+        self.assertEqual(targets_from_csv("alice\nbob\n"), ['alice', 'bob'])
+
+
+class FollowManyTestCase(DatabaseTestCase):
+    """Test following a batch of users."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.testuser = self.fixture_user("testuser")
+        self.otheruser = self.fixture_user("otheruser")
+        self.third = User(username="third", email="third@test.com", password="HASHED_PASSWORD")
+        db.session.add(self.third)
+        db.session.commit()
+
+    def followed_ids(self):
+        return {followed_id for (followed_id,) in
+                (db.session
+                 .query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == self.testuser.id))}
+
+    def test_digits_resolve_as_id_or_username(self):
+        """Are digits an id when there's such a user, and a username otherwise?"""
+
+        numbered = User(username="31337", email="numbered@test.com", password="HASHED_PASSWORD")
+        db.session.add(numbered)
+        db.session.commit()
+
+        results = follow_many(self.testuser.id, [str(self.third.id), "31337", "99999999"])
+
+        self.assertEqual([(result.user_id, result.status) for result in results],
+                         [(self.third.id, FOLLOWED), (numbered.id, FOLLOWED), (None, NOT_FOUND)])
+        self.assertEqual(self.followed_ids(), {self.otheruser.id, self.third.id, numbered.id})
+
+    def test_queued_changes_go_through_the_queue(self):
+        """Are targets with queued follows or unfollows queued after them, not inserted?"""
+
+        pending = {self.otheruser.id: False, self.third.id: False}
+
+        with mock.patch.object(write_queue, 'pending', return_value=pending), \
+                mock.patch.object(write_queue, 'submit') as submit:
+            results = follow_many(self.testuser.id, [self.otheruser.id, self.third.id])
+
+        self.assertEqual([result.status for result in results], [FOLLOWED, FOLLOWED])
+        self.assertEqual(submit.call_args_list,
+                         [mock.call(FOLLOW, self.testuser.id, self.otheruser.id, True, None),
+                          mock.call(FOLLOW, self.testuser.id, self.third.id, True, None)])
+        # Inserting third now would be undone when the queued unfollow is applied.
+        self.assertEqual(self.followed_ids(), {self.otheruser.id})
+
+    def test_already_following(self):
+        """Are follows, in the database or queued, reported as already there?"""
+
+        with mock.patch.object(write_queue, 'pending', return_value={self.third.id: True}):
+            results = follow_many(self.testuser.id, [self.otheruser.id, self.third.id])
+
+        self.assertEqual([result.status for result in results],
+                         [ALREADY_FOLLOWING, ALREADY_FOLLOWING])
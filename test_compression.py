@@ -0,0 +1,97 @@
+"""Response compression tests."""
+
+import zlib
+from unittest import TestCase
+
+import brotli
+import zstandard
+from flask import Flask, request
+from flask_wtf.csrf import generate_csrf
+
+from compression import ResponseCompressor, compress, negotiate
+
+DECOMPRESS = {
+    'gzip': lambda data: zlib.decompress(data, 47),
+    'br': brotli.decompress,
+    'zstd': lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data),
+}
+
+
+class NegotiateTestCase(TestCase):
+    """Test picking an encoding from Accept-Encoding."""
+
+    def test_prefers_best_accepted(self):
+        """Is zstd, then brotli, then gzip picked among equally weighted encodings?"""
+
+        self.assertEqual(negotiate('gzip, deflate, br'), 'br')
+        self.assertEqual(negotiate('gzip, br, zstd'), 'zstd')
+        self.assertEqual(negotiate('*'), 'zstd')
+
+    def test_weights(self):
+        """Are q-values honoured, and q=0 refused?"""
+
+        self.assertEqual(negotiate('gzip;q=1.0, br;q=0.5'), 'gzip')
+        self.assertEqual(negotiate('zstd;q=0, br;q=0, *;q=0.1'), 'gzip')
+        self.assertIsNone(negotiate('gzip;q=0'))
+        self.assertIsNone(negotiate('identity'))
+        self.assertIsNone(negotiate(None))
+
+
+class CompressTestCase(TestCase):
+    """Test whole and streamed compression."""
+
+    data = b"<li class='message'>hello world</li>\n" * 200
+
+    def test_round_trip(self):
+        """Does each encoding decompress back to the original?"""
+
+        for encoding, decompress in DECOMPRESS.items():
+            self.assertEqual(decompress(compress(self.data, encoding, 5)), self.data)
+
+    def test_stream_round_trip(self):
+        """Is every chunk flushed as it's compressed, and the whole stream intact?"""
+
+        chunks = [self.data[i:i + 500] for i in range(0, len(self.data), 500)]
+
+        for encoding, decompress in DECOMPRESS.items():
+            compressor = ResponseCompressor()
+            parts = list(compressor._stream(iter(chunks), encoding, 3))
+
+            self.assertEqual(len(parts), len(chunks) + 1)
+            self.assertEqual(decompress(b''.join(parts)), self.data)
+            self.assertEqual(compressor.stats()['bytes_in'], len(self.data))
+
+
+class CompressResponseTestCase(TestCase):
+    """Test which responses get compressed."""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.secret_key = "test"
+        self.app.after_request(ResponseCompressor(min_size=100).compress_response)
+
+        @self.app.route('/page')
+        def page():
+            return f"<p>{request.args.get('q', '')}</p>" * 100
+
+        @self.app.route('/form')
+        def form():
+            return f"<input value='{generate_csrf()}'><p>{request.args.get('q', '')}</p>" * 100
+
+        self.client = self.app.test_client()
+
+    def test_compresses_pages(self):
+        """Are big enough pages compressed for clients that accept it?"""
+
+        resp = self.client.get('/page?q=hello', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(DECOMPRESS['gzip'](resp.get_data()), b"<p>hello</p>" * 100)
+
+    def test_leaves_csrf_tokens_uncompressed(self):
+        """Are responses with a CSRF token sent as is, so their size can't leak it (BREACH)?"""
+
+        resp = self.client.get('/form?q=csrf_token', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b"<p>csrf_token</p>", resp.get_data())
@@ -0,0 +1,130 @@
+"""Export stream tests."""
+
+import gzip
+import tempfile
+from unittest import TestCase
+
+from archive import archive
+from exports import chunked, csv_lines, export_records, gzipped, ndjson_lines, parse_cursor
+from models import db, Likes, Message
+from test_archive import write_archive
+from testing import DatabaseTestCase, app
+
+
+RECORDS = [
+    dict(type='message', cursor='messages:1', id='1', text='hi, "you"', timestamp='2020-01-01'),
+    dict(type='following', cursor='following:2', id='2', user_id=2, username='bob'),
+]
+
+
+class ExportFormatTestCase(TestCase):
+    """Test encoding export records."""
+
+    def test_parse_cursor(self):
+        """Are cursors split into a section and key, and bad ones rejected?"""
+
+        self.assertEqual(parse_cursor('likes:42'), ('likes', 42))
+
+        for cursor in ['nope:1', 'likes:', 'likes']:
+            with self.assertRaises(ValueError):
+                parse_cursor(cursor)
+
+    def test_ndjson(self):
+        """Is each record one line of JSON?"""
+
+        lines = list(ndjson_lines(RECORDS))
+
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('{"type": "message"'))
+        self.assertTrue(all(line.endswith('\n') for line in lines))
+
+    def test_csv(self):
+        """Does CSV get a header and quote awkward text?"""
+
+        text = ''.join(csv_lines(RECORDS))
+
+        self.assertEqual(text.splitlines(), [
+            'type,cursor,id,text,timestamp,user_id,username',
+            'message,messages:1,1,"hi, ""you""",2020-01-01,,',
+            'following,following:2,2,,,2,bob',
+        ])
+
+    def test_csv_header_without_records(self):
+        """Does an empty export still get a header?"""
+
+        self.assertEqual(''.join(csv_lines([])).strip(),
+                         'type,cursor,id,text,timestamp,user_id,username')
+
+    def test_chunked_gzip(self):
+        """Do chunking and streaming gzip round-trip the lines?"""
+
+        lines = [f"line {i}\n" for i in range(10000)]
+        chunks = list(chunked(lines, size=1000))
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(gzip.decompress(b''.join(gzipped(chunks))).decode(), ''.join(lines))
+
+
+class ExportRecordsTestCase(DatabaseTestCase):
+    """Test the record stream: section order, archived messages and resuming."""
+
+    def setUp(self):
+        """testuser has three archived messages, two in the database, a like and a follow."""
+
+        super().setUp()
+
+        self.testuser = self.fixture_user("testuser")
+        self.otheruser = self.fixture_user("otheruser")
+
+        self.mine = [Message(text=f"mine {i}", user_id=self.testuser.id) for i in range(2)]
+        self.theirs = Message(text="theirs", user_id=self.otheruser.id)
+        for message in self.mine + [self.theirs]:
+            db.session.add(message)
+            db.session.commit()
+        db.session.add(Likes(user_id=self.testuser.id, message_id=self.theirs.id))
+        db.session.commit()
+
+        self.archive_dir = tempfile.TemporaryDirectory()
+        archive.configure(self.archive_dir.name)
+
+    def tearDown(self):
+        archive.configure(app.config['ARCHIVE_DIR'])
+        self.archive_dir.cleanup()
+        super().tearDown()
+
+    def archive_messages(self, *ids):
+        write_archive(self.archive_dir.name, '2020-01', min(ids), max(ids), {
+            self.testuser.id: [dict(id=id, text=f"archived {id}", timestamp="2020-01-15T00:00:00",
+                                    user_id=self.testuser.id) for id in sorted(ids, reverse=True)]})
+
+    def cursors(self, cursor=None):
+        return [record['cursor'] for record in export_records(self.testuser.id, cursor)]
+
+    def test_sections_in_order(self):
+        """Do archived messages run on into the database's, then likes, following and followers?"""
+
+        self.archive_messages(5, 6, 7)
+
+        self.assertEqual(self.cursors(), [
+            'messages:5', 'messages:6', 'messages:7',
+            f"messages:{self.mine[0].id}", f"messages:{self.mine[1].id}",
+            f"likes:{self.theirs.id}", f"following:{self.otheruser.id}"])
+
+    def test_resume_from_every_cursor(self):
+        """Does resuming after any record give exactly the rest, with no gaps or repeats?"""
+
+        self.archive_messages(5, 6, 7)
+        cursors = self.cursors()
+
+        for i, cursor in enumerate(cursors):
+            self.assertEqual(self.cursors(cursor), cursors[i + 1:], cursor)
+
+    def test_archived_and_not_yet_dropped(self):
+        """Is a message still in the database after being archived exported once?"""
+
+        self.archive_messages(5, self.mine[0].id)
+
+        self.assertEqual(self.cursors()[:3], [
+            'messages:5', f"messages:{self.mine[0].id}", f"messages:{self.mine[1].id}"])
+        self.assertEqual(self.cursors('messages:5')[:2], [
+            f"messages:{self.mine[0].id}", f"messages:{self.mine[1].id}"])
@@ -0,0 +1,152 @@
+"""Anonymous firehose tests."""
+
+import threading
+from unittest import mock
+
+from firehose import Firehose
+from models import db, Message
+from records import MessageRecord
+from testing import DatabaseTestCase, app
+
+
+class FirehoseTestCase(DatabaseTestCase):
+    """Test the in-memory feed of the newest messages."""
+
+    def setUp(self):
+        """Four messages, two each by testuser and otheruser, and a three-message firehose."""
+
+        super().setUp()
+
+        self.testuser = self.fixture_user("testuser")
+        self.otheruser = self.fixture_user("otheruser")
+
+        self.messages = [Message(text=f"warble {i}", user_id=user.id)
+                         for i, user in enumerate([self.testuser, self.otheruser,
+                                                   self.testuser, self.otheruser])]
+        for message in self.messages:
+            db.session.add(message)
+            db.session.commit()
+
+        self.firehose = Firehose(size=3)
+
+    def ids(self):
+        return [record.id for record in self.firehose.messages]
+
+    def test_seed(self):
+        """Is the buffer filled with the newest messages, and rendered?"""
+
+        self.assertTrue(self.firehose.seed(app))
+
+        self.assertEqual(self.ids(), [m.id for m in reversed(self.messages[1:])])
+        self.assertIn("warble 3", self.firehose.html)
+        self.assertNotIn("warble 0", self.firehose.html)
+        self.assertIn("@otheruser", self.firehose.html)
+
+    def test_seed_unchanged(self):
+        """Is an unchanged feed left alone, and a changed one re-rendered?"""
+
+        self.firehose.seed(app)
+        version, html = self.firehose.page
+
+        self.assertFalse(self.firehose.seed(app))
+        self.assertEqual(self.firehose.page, (version, html))
+
+        db.session.add(Message(text="warble 4", user_id=self.testuser.id))
+        db.session.commit()
+
+        self.assertTrue(self.firehose.seed(app))
+        self.assertEqual(self.firehose.page[0], version + 1)
+        self.assertIn("warble 4", self.firehose.html)
+
+    def test_add(self):
+        """Is a new message put first, pushing the oldest out, and rendered?"""
+
+        self.firehose.seed(app)
+        message = Message(text="just posted", user_id=self.otheruser.id)
+        db.session.add(message)
+        db.session.commit()
+
+        self.firehose.add(MessageRecord.from_message(message))
+
+        self.assertEqual(self.ids(), [message.id, self.messages[3].id, self.messages[2].id])
+        self.assertIn("just posted", self.firehose.html)
+        self.assertNotIn("warble 1", self.firehose.html)
+
+    def test_remove_by_id(self):
+        """Is a deleted message dropped and the feed re-rendered?"""
+
+        self.firehose.seed(app)
+        version = self.firehose.page[0]
+
+        self.firehose.remove([self.messages[3].id])
+
+        self.assertEqual(self.ids(), [self.messages[2].id, self.messages[1].id])
+        self.assertNotIn("warble 3", self.firehose.html)
+        self.assertEqual(self.firehose.page[0], version + 1)
+
+    def test_remove_by_author(self):
+        """Are all of an author's messages dropped?"""
+
+        self.firehose.seed(app)
+
+        self.firehose.remove(author_id=self.otheruser.id)
+
+        self.assertEqual(self.ids(), [self.messages[2].id])
+        self.assertNotIn("@otheruser", self.firehose.html)
+
+    def test_remove_nothing(self):
+        """Is the feed left un-rendered when nothing it shows was removed?"""
+
+        self.firehose.seed(app)
+        page = self.firehose.page
+
+        self.firehose.remove([self.messages[0].id])
+        self.firehose.remove(author_id=999999)
+
+        self.assertEqual(self.firehose.page, page)
+
+    def test_empty(self):
+        """Does an empty database render the empty feed?"""
+
+        for message in self.messages:
+            db.session.delete(message)
+        db.session.commit()
+
+        self.firehose.seed(app)
+
+        self.assertEqual(self.firehose.messages, [])
+        self.assertIn("No warbles yet.", self.firehose.html)
+
+    def test_versions_match_bodies(self):
+        """With adds from several threads, does every version have exactly one body?"""
+
+        self.firehose.seed(app)
+        records = self.firehose.messages
+        pages = []
+
+        def add(record):
+            for _ in range(20):
+                self.firehose.add(record)
+                pages.append(self.firehose.page)
+
+        threads = [threading.Thread(target=add, args=(record,)) for record in records]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        bodies = {}
+        for version, html in pages:
+            self.assertEqual(bodies.setdefault(version, html), html)
+        self.assertEqual(self.firehose.page[0], 1 + 20 * len(records))
+
+    def test_no_refresh_thread(self):
+        """Does a firehose configured without a refresh interval only seed?"""
+
+        self.firehose.configure(refresh_interval=None)
+
+        with mock.patch('firehose.threading.Thread') as thread:
+            self.firehose.ensure_running(app)
+
+        thread.assert_not_called()
+        self.assertIsNotNone(self.firehose.html)
@@ -0,0 +1,158 @@
+"""Shared follow graph tests."""
+
+import os
+import tempfile
+import threading
+from unittest import mock
+
+import follow_graph
+from follow_graph import ADD, REMOVE, SharedFollowGraph, write_snapshot
+from models import db, Follows, User
+from profiles import followed_among, followers_page
+from testing import DatabaseTestCase
+
+
+class FollowGraphTestCase(DatabaseTestCase):
+    """Test snapshots, delta logs and compaction against the follows table."""
+
+    def setUp(self):
+        """Add users a, b and c: a follows b and c, and b follows c."""
+
+        super().setUp()
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'follow_graph.bin')
+
+        self.a, self.b, self.c = [
+            User(username=name, email=f"{name}@test.com", password="HASHED_PASSWORD")
+            for name in ("a", "b", "c")]
+        db.session.add_all([self.a, self.b, self.c])
+        db.session.commit()
+
+        self.follow(self.a, self.b)
+        self.follow(self.a, self.c)
+        self.follow(self.b, self.c)
+
+        write_snapshot(self.path)
+        self.graph = SharedFollowGraph(self.path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+        super().tearDown()
+
+    def follow(self, follower, followed):
+        db.session.add(Follows(user_following_id=follower.id, user_being_followed_id=followed.id))
+        db.session.commit()
+
+    def test_round_trip(self):
+        """Does a snapshot answer what the follows table does, both ways round?"""
+
+        a, b, c = self.a.id, self.b.id, self.c.id
+
+        self.assertTrue(self.graph.available)
+        self.assertEqual(list(self.graph.following_ids(a)), [b, c])
+        self.assertEqual(list(self.graph.follower_ids(c)), [a, b])
+        self.assertEqual(list(self.graph.following_ids(c)), [])
+        self.assertTrue(self.graph.is_following(a, b))
+        self.assertFalse(self.graph.is_following(b, a))
+        # Beyond the snapshot's largest id.
+        self.assertEqual(list(self.graph.follower_ids(c + 1000)), [])
+
+    def test_rows_are_views(self):
+        """Are unchanged rows served from the mapping rather than copied?"""
+
+        self.assertIsInstance(self.graph.following_ids(self.a.id), memoryview)
+
+    def test_delta_replay(self):
+        """Are records seen at once by their writer, and by other workers on refresh?"""
+
+        a, b, c = self.a.id, self.b.id, self.c.id
+        other = SharedFollowGraph(self.path, refresh_interval=3600)
+        other.refresh()
+
+        self.graph.record(REMOVE, a, b)
+        self.graph.record_many(ADD, [(c, a), (b, a)])
+
+        self.assertEqual(self.graph.following_ids(a), [c])
+        self.assertEqual(self.graph.follower_ids(a), [b, c])
+
+        # Not looked for until the interval's up...
+        self.assertTrue(other.is_following(a, b))
+        other.refresh(force=True)
+        self.assertFalse(other.is_following(a, b))
+        self.assertTrue(other.is_following(c, a))
+        self.assertEqual(other.follower_ids(b), [])
+
+        # ...and a fresh process replays the whole log.
+        self.assertEqual(SharedFollowGraph(self.path).follower_ids(a), [b, c])
+
+    def test_compaction(self):
+        """Does compacting fold committed changes into a new snapshot and retire the log?"""
+
+        a, c = self.a.id, self.c.id
+        held = self.graph.follower_ids(c)
+
+        self.follow(self.c, self.a)
+        self.graph.record(ADD, c, a)
+
+        self.assertTrue(self.graph.compact())
+        self.assertFalse(os.path.exists(self.graph.delta_path))
+        self.assertFalse(os.path.exists(self.graph.old_delta_path))
+
+        self.graph.refresh(force=True)
+        self.assertIsInstance(self.graph.follower_ids(a), memoryview)
+        self.assertEqual(list(self.graph.follower_ids(a)), [c])
+        # A row handed out before the remap is still readable.
+        self.assertEqual(list(held), [a, self.b.id])
+
+    def test_concurrent_refresh(self):
+        """Do readers always see a consistent graph while another worker records and compacts?"""
+
+        a, b, c = self.a.id, self.b.id, self.c.id
+        reader = SharedFollowGraph(self.path, refresh_interval=0)
+        stop = threading.Event()
+        errors = []
+
+        def read():
+            try:
+                while not stop.is_set():
+                    # In every snapshot, and never unfollowed.
+                    assert list(reader.following_ids(a)) == [b, c]
+                    assert reader.is_following(b, c)
+                    assert list(reader.follower_ids(c)) == [a, b]
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for _ in range(20):
+                self.graph.record_many(ADD, [(c, a)])
+                self.graph.record_many(REMOVE, [(c, a)])
+                self.graph.compact()
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        reader.refresh(force=True)
+        self.assertFalse(reader.is_following(c, a))
+
+    def test_profile_lookups_use_graph(self):
+        """Do follower pages and follow buttons come from the graph when there is one?"""
+
+        a, b, c = self.a.id, self.b.id, self.c.id
+        # Recorded in the graph only, so only the graph can answer with it.
+        self.graph.record(ADD, c, b)
+
+        with mock.patch.object(follow_graph, 'graph', self.graph):
+            self.assertEqual([user.id for user in followers_page(b, 10)], [c, a])
+            self.assertEqual([user.id for user in followers_page(b, 1, before=c)], [a])
+            self.assertEqual(followed_among(c, [a, b]), {b})
+
+            self.a.deleted_at = db.func.now()
+            db.session.commit()
+            self.assertEqual([user.id for user in followers_page(c, 1)], [b])
@@ -0,0 +1,102 @@
+"""Single-message read-through cache tests."""
+
+import threading
+import time
+from unittest import TestCase
+
+from message_cache import MessageCache
+from records import AuthorCard, MessageRecord
+
+
+class FakeLoader:
+    """Stands in for the database: counts loads, optionally slowly."""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = 0
+        self.author = AuthorCard(1, "testuser", None)
+
+    def __call__(self, message_id):
+        self.calls += 1
+        time.sleep(self.delay)
+        if message_id < 0:
+            return None
+        return MessageRecord(message_id, "text", None, self.author)
+
+
+class MessageCacheTestCase(TestCase):
+    """Test the LRU/TTL message cache."""
+
+    def setUp(self):
+        self.load = FakeLoader()
+        self.cache = MessageCache(load=self.load, max_size=2, ttl=60)
+
+    def test_read_through(self):
+        """Is a message loaded once, then served from the cache?"""
+
+        self.assertEqual(self.cache.get(10).id, 10)
+        self.assertEqual(self.cache.get(10).id, 10)
+
+        self.assertEqual(self.load.calls, 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_missing_message_cached(self):
+        """Are lookups of missing messages cached too?"""
+
+        self.assertIsNone(self.cache.get(-1))
+        self.assertIsNone(self.cache.get(-1))
+
+        self.assertEqual(self.load.calls, 1)
+
+    def test_lru_eviction(self):
+        """Is the least recently used entry evicted first?"""
+
+        self.cache.get(1)
+        self.cache.get(2)
+        self.cache.get(1)
+        self.cache.get(3)
+
+        self.cache.get(1)
+        self.assertEqual(self.load.calls, 3)
+        self.cache.get(2)
+        self.assertEqual(self.load.calls, 4)
+        self.assertEqual(self.cache.stats()['evictions'], 2)
+
+    def test_ttl(self):
+        """Are expired entries reloaded?"""
+
+        cache = MessageCache(load=self.load, ttl=-1)
+        cache.get(1)
+        cache.get(1)
+
+        self.assertEqual(self.load.calls, 2)
+
+    def test_invalidate(self):
+        """Do invalidate and invalidate_author drop entries?"""
+
+        self.cache.get(1)
+        self.cache.invalidate(1)
+        self.cache.get(1)
+        self.assertEqual(self.load.calls, 2)
+
+        self.cache.invalidate_author(1)
+        self.cache.get(1)
+        self.assertEqual(self.load.calls, 3)
+
+    def test_concurrent_misses_share_one_load(self):
+        """Do simultaneous misses for one message make a single load?"""
+
+        self.load.delay = 0.1
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get(7)))
+                   for _ in range(5)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.load.calls, 1)
+        self.assertEqual([r.id for r in results], [7] * 5)
+        self.assertEqual(self.cache.stats()['coalesced'], 4)
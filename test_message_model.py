@@ -1,23 +1,9 @@
 """User model tests."""
 
-import os
 from re import U
-from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 from models import db, User, Message, Likes, Follows
-
-# set an environmental variable to use a different database for tests -
-# we need to do this before we import our app, since that will have already connected to the database
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# import the app
-from app import app
-
-
-# Create our tables (we do this here, so we only create the tables once for all tests --- in each test, we'll delete the data and create fresh new clean test data
-db.drop_all()
-db.create_all()
-
+from testing import DatabaseTestCase, app
 
 
 # Data to create test users
@@ -38,18 +24,7 @@ MSG_1 = {"text":"This is a test message for testuser1"}
 MSG_2 = {"text":"This is a test message for testuser2"}
 
 
-class MessageModelTestCase(TestCase):
-    def setUp(self):
-        """Clear errors, clear tables, add data, create test client"""
-
-        db.session.rollback()
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-
-        self.client = app.test_client()
-
-
+class MessageModelTestCase(DatabaseTestCase):
     def test_message_model(self):
         """Does the basic model work to add a message"""
 
@@ -1,49 +1,20 @@
 """Message View tests."""
 
-import os
-from unittest import TestCase
-from models import db, connect_db, Message, User
+from models import db, Message, User
+from testing import DatabaseTestCase, app
+from app import CURR_USER_KEY
 
-# set an environmental variable to use a different database for tests -
-# we need to do this before we import our app, since that will have already connected to the database
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
-# import the app
-from app import app, CURR_USER_KEY
-
-# Create our tables (we do this here, so we only create the tables once for all tests --- in each test, we'll delete the data and create fresh new clean test data
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
-app.config['WTF_CSRF_ENABLED'] = False
-
-
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
-        """Create test client, add sample data."""
-
-        User.query.delete()
-        Message.query.delete()
-
-        self.client = app.test_client()
-
-        self.testuser = User.signup(username="testuser",
-                                    email="test@test.com",
-                                    password="testuser",
-                                    image_url=None)
-
-        self.otheruser = User.signup(username="otheruser",
-                                    email="other@test.com",
-                                    password="otheruser",
-                                    image_url=None)
-
-        self.testuser.following = [self.otheruser]
-
-        db.session.commit()
+        """Start a test transaction, load the fixture users (testuser follows otheruser)."""
 
+        super().setUp()
 
+        self.testuser = self.fixture_user("testuser")
+        self.otheruser = self.fixture_user("otheruser")
 
 
     ####################################################
@@ -139,37 +110,33 @@ class MessageViewTestCase(TestCase):
 
 
 
-    # def test_delete_msg_other_user(self):
-    #     """Ensure logged in user cannot delete a message as another user"""
+    def test_delete_msg_other_user(self):
+        """Ensure logged in user cannot delete a message as another user"""
 
-    #     other_user_data = dict(
-    #         email="otheruser@test.com",
-    #         username="otheruser",
-    #         password="HASHED_PASSWORD"
-    #     )
+        msg = Message(text="This is a test message for otheruser")
+        self.otheruser.messages.append(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
 
-    #     other_user = User(**other_user_data)
-    #     db.session.add(other_user)
-    #     db.session.commit()
+            resp = c.post(f"/messages/{msg.id}/delete", follow_redirects=True)
 
-    #     msg = Message(text="This is a test message for testuser1")
-    #     other_user.messages.append(msg)
-    #     db.session.commit()
+            self.assertIn(b"Access unauthorized.", resp.data)
+            self.assertIsNotNone(Message.query.get(msg.id))
 
+    def test_delete_missing_msg(self):
+        """Ensure deleting a message that doesn't exist is a 404"""
 
-    #     with self.client as c:
-    #         with c.session_transaction() as sess:
-    #             sess[CURR_USER_KEY] = self.testuser.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
 
-    #         resp = c.post(f"/messages/{msg.id}/delete")
+            resp = c.post("/messages/999999/delete")
 
-    #         # Make sure it redirects
-    #         self.assertEqual(resp.status_code, 302)
-    #         self.assertIn(b"Access unauthorized.", resp)
+            self.assertEqual(resp.status_code, 404)
 
-        #giving me this error:
-        #sqlalchemy.orm.exc.DetachedInstanceError: Instance <Message at 0x7f99183f2d00> is not bound to a Session
-    
 
     ####################################################
     # Testing not logged in functionality
@@ -0,0 +1,109 @@
+"""Migration tests, run against a schema laid out as it was before each migration.
+
+Partitioning needs Postgres (point TEST_DATABASE_URL at one); elsewhere
+these are skipped.
+"""
+
+import importlib.util
+import os
+from datetime import datetime
+from unittest import skipUnless
+
+from models import db
+from partitions import is_partitioned
+from snowflake import id_for_datetime
+from testing import DatabaseTestCase
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def load_migration(name):
+    """Import migrations/<name>.py (their names aren't valid module names)."""
+
+    spec = importlib.util.spec_from_file_location(f"migration_{name}",
+                                                  os.path.join(MIGRATIONS_DIR, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@skipUnless(db.engine.dialect.name == 'postgresql', "partitioning needs Postgres")
+class PartitionMessagesTestCase(DatabaseTestCase):
+    """Test 0005_partition_messages on a populated, unpartitioned schema."""
+
+    def setUp(self):
+        """Lay out (in a schema of its own, rolled back with the test) the tables as before 0005."""
+
+        super().setUp()
+
+        self.migration = load_migration('0005_partition_messages')
+        execute = self.connection.execute
+
+        execute("CREATE SCHEMA before_0005")
+        execute("SET LOCAL search_path TO before_0005")
+        execute("CREATE TABLE users (id INTEGER PRIMARY KEY)")
+        execute("CREATE TABLE messages (id BIGINT PRIMARY KEY, text VARCHAR(140) NOT NULL, "
+                "timestamp TIMESTAMP NOT NULL, "
+                "user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, "
+                "parent_id BIGINT, path TEXT NOT NULL, depth INTEGER NOT NULL DEFAULT 0, "
+                "reply_count INTEGER NOT NULL DEFAULT 0)")
+        execute("CREATE INDEX ix_messages_user_id_id ON messages (user_id, id)")
+        execute("CREATE INDEX ix_messages_path ON messages (path)")
+        execute("CREATE TABLE likes (id SERIAL PRIMARY KEY, user_id INTEGER REFERENCES users (id), "
+                "message_id BIGINT REFERENCES messages (id) ON DELETE CASCADE)")
+        execute("CREATE TABLE message_tags (tag TEXT, "
+                "message_id BIGINT REFERENCES messages (id) ON DELETE CASCADE, "
+                "PRIMARY KEY (tag, message_id))")
+        execute("CREATE TABLE mentions (user_id INTEGER REFERENCES users (id), "
+                "message_id BIGINT REFERENCES messages (id) ON DELETE CASCADE, "
+                "PRIMARY KEY (user_id, message_id))")
+        execute("CREATE TABLE notifications (id SERIAL PRIMARY KEY, "
+                "recipient_id INTEGER NOT NULL REFERENCES users (id), kind TEXT NOT NULL, "
+                "target_id BIGINT REFERENCES messages (id) ON DELETE CASCADE, "
+                "last_actor_id INTEGER NOT NULL REFERENCES users (id), "
+                "actor_count INTEGER NOT NULL DEFAULT 1)")
+
+        self.old = id_for_datetime(datetime(2024, 1, 15))
+        self.new = id_for_datetime(datetime(2024, 3, 1))
+        execute("INSERT INTO users VALUES (1), (2)")
+        for message_id in (self.old, self.new):
+            execute(f"INSERT INTO messages (id, text, timestamp, user_id, path) "
+                    f"VALUES ({message_id}, 'hi', now(), 1, lpad(to_hex({message_id}), 16, '0'))")
+            execute(f"INSERT INTO likes (user_id, message_id) VALUES (2, {message_id})")
+            execute(f"INSERT INTO message_tags VALUES ('news', {message_id})")
+            execute(f"INSERT INTO mentions VALUES (2, {message_id})")
+            execute(f"INSERT INTO notifications (recipient_id, kind, target_id, last_actor_id) "
+                    f"VALUES (1, 'like', {message_id}, 2)")
+
+    def count(self, table):
+        return self.connection.execute(f"SELECT count(*) FROM {table}").scalar()
+
+    def test_partitions_and_keeps_rows(self):
+        """Are the rows moved into monthly partitions, and every reference kept?"""
+
+        self.migration.migrate(self.connection)
+
+        self.assertTrue(is_partitioned(self.connection))
+        for table in ('messages', 'likes', 'message_tags', 'mentions', 'notifications'):
+            self.assertEqual(self.count(table), 2, table)
+        self.assertEqual(self.count('messages_2024_01'), 1)
+        self.assertEqual(self.count('messages_2024_03'), 1)
+
+        references = set(self.connection.execute(
+            "SELECT conrelid::regclass::text, attname FROM pg_constraint "
+            "JOIN pg_attribute ON attrelid = conrelid AND attnum = ANY (conkey) "
+            "WHERE contype = 'f' AND confrelid = 'messages'::regclass"))
+        self.assertEqual(references, set(self.migration.REFERENCES))
+
+        # Deleting a message still cascades everywhere, notifications included.
+        self.connection.execute(f"DELETE FROM messages WHERE id = {self.old}")
+        for table in ('likes', 'message_tags', 'mentions', 'notifications'):
+            self.assertEqual(self.count(table), 1, table)
+
+    def test_rerun(self):
+        """Is running it again a no-op?"""
+
+        self.migration.migrate(self.connection)
+        self.migration.migrate(self.connection)
+
+        self.assertEqual(self.count('messages'), 2)
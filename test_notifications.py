@@ -0,0 +1,139 @@
+"""Notification queue tests."""
+
+from unittest import TestCase, mock
+
+from sqlalchemy.exc import IntegrityError
+
+import notifications
+from models import db, Message, Notification, User
+from notifications import NotificationQueue, UnreadCounter, Event, LIKE, FOLLOW, write_events
+from testing import DatabaseTestCase, app
+
+
+class NotificationQueueTestCase(TestCase):
+    """Test queueing notification events before they are flushed."""
+
+    def test_self_notifications_skipped(self):
+        """Are people kept from being notified about their own actions?"""
+
+        queue = NotificationQueue()
+        queue.enqueue(1, FOLLOW, actor_id=1)
+
+        self.assertEqual(len(queue), 0)
+
+    def test_due_on_batch_size(self):
+        """Is a flush due once a full batch is queued?"""
+
+        queue = NotificationQueue(batch_size=2, max_delay=60)
+        queue.enqueue(1, LIKE, actor_id=2, target_id=10)
+        self.assertFalse(queue.due())
+
+        queue.enqueue(1, LIKE, actor_id=3, target_id=10)
+        self.assertTrue(queue.due())
+
+    def test_due_on_delay(self):
+        """Is a flush due once the oldest event has waited long enough?"""
+
+        queue = NotificationQueue(batch_size=100, max_delay=0)
+        self.assertFalse(queue.due())
+
+        queue.enqueue(1, FOLLOW, actor_id=2)
+        self.assertTrue(queue.due())
+
+    def test_drain(self):
+        """Does drain hand back every event and empty the queue?"""
+
+        queue = NotificationQueue()
+        queue.enqueue(1, LIKE, actor_id=2, target_id=10)
+        queue.enqueue(3, FOLLOW, actor_id=2)
+
+        events = queue.drain()
+
+        self.assertEqual([(e.recipient_id, e.kind) for e in events], [(1, LIKE), (3, FOLLOW)])
+        self.assertEqual(len(queue), 0)
+
+
+class WriteEventsTestCase(DatabaseTestCase):
+    """Test writing queued events as aggregated notifications."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.testuser = self.fixture_user("testuser")
+        self.otheruser = self.fixture_user("otheruser")
+        self.thirduser = User(username="thirduser", email="third@test.com", password="HASHED_PASSWORD")
+        db.session.add(self.thirduser)
+        self.message = Message(text="Like me", user_id=self.testuser.id)
+        db.session.add(self.message)
+        db.session.commit()
+
+        self.counter = UnreadCounter()
+
+    def like(self, actor):
+        return Event(self.testuser.id, LIKE, self.message.id, actor.id)
+
+    def notifications(self):
+        return Notification.query.filter_by(recipient_id=self.testuser.id).all()
+
+    def test_aggregates_a_batch(self):
+        """Do likes of one message collapse into one row counting each actor once?"""
+
+        self.counter.get(self.testuser.id)
+        write_events([self.like(self.otheruser), self.like(self.thirduser),
+                      self.like(self.otheruser)], self.counter)
+
+        [notification] = self.notifications()
+        self.assertEqual(notification.actor_count, 2)
+        self.assertEqual(notification.last_actor_id, self.otheruser.id)
+        self.assertEqual(self.counter.get(self.testuser.id), 1)
+
+    def test_merges_into_unread(self):
+        """Are later batches added onto the unread row, without recounting actors?"""
+
+        write_events([self.like(self.otheruser)], self.counter)
+        write_events([self.like(self.otheruser)], self.counter)
+
+        [notification] = self.notifications()
+        self.assertEqual(notification.actor_count, 1)
+
+        write_events([self.like(self.thirduser), self.like(self.otheruser)], self.counter)
+
+        [notification] = self.notifications()
+        db.session.refresh(notification)
+        self.assertEqual(notification.actor_count, 2)
+        self.assertEqual(notification.last_actor_id, self.thirduser.id)
+
+    def test_read_notifications_not_merged(self):
+        """Does a new event after everything was read start a new row?"""
+
+        write_events([self.like(self.otheruser)], self.counter)
+        notifications.mark_all_read(self.testuser.id)
+        write_events([self.like(self.otheruser)], self.counter)
+
+        self.assertEqual(sorted(n.is_read for n in self.notifications()), [False, True])
+
+    def test_skips_missing_rows(self):
+        """Are events about deleted messages or tombstoned users dropped?"""
+
+        gone = Event(self.testuser.id, LIKE, self.message.id + 1, self.otheruser.id)
+        self.thirduser.deleted_at = self.message.timestamp
+        db.session.commit()
+
+        write_events([gone, self.like(self.thirduser),
+                      Event(self.testuser.id, FOLLOW, None, self.otheruser.id)], self.counter)
+
+        self.assertEqual([n.kind for n in self.notifications()], [FOLLOW])
+
+    def test_flush_drops_failed_batch(self):
+        """Does a batch that fails to write get rolled back and dropped, not raised?"""
+
+        notifications.queue.enqueue(self.testuser.id, FOLLOW, self.otheruser.id)
+        error = IntegrityError("INSERT", {}, Exception("boom"))
+
+        with app.test_request_context(), \
+                mock.patch('notifications.write_events', side_effect=error), \
+                self.assertLogs(app.logger, 'ERROR'):
+            notifications.flush(force=True)
+
+        self.assertEqual(len(notifications.queue), 0)
+        self.assertEqual(self.notifications(), [])
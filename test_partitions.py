@@ -0,0 +1,71 @@
+"""Message partition tests."""
+
+from datetime import datetime
+from unittest import skipUnless, TestCase
+
+from models import db, Message
+from partitions import (add_months, DEFAULT_PARTITION, ensure_partitions, month_bounds,
+                        month_for_id, month_start, MONTHS_AHEAD, partition_name, recent_floor,
+                        RECENT_MONTHS)
+from snowflake import id_for_datetime
+from testing import DatabaseTestCase, fixture_ids
+
+
+class PartitionTestCase(TestCase):
+    """Test month arithmetic and id ranges."""
+
+    def test_add_months(self):
+        """Do months roll over years in both directions?"""
+
+        self.assertEqual(add_months(datetime(2024, 11, 1), 3), datetime(2025, 2, 1))
+        self.assertEqual(add_months(datetime(2024, 1, 1), -1), datetime(2023, 12, 1))
+
+    def test_bounds_are_contiguous(self):
+        """Does each month's id range start where the last one's ended?"""
+
+        month = datetime(2024, 1, 1)
+        for _ in range(14):
+            _, high = month_bounds(month)
+            month = add_months(month, 1)
+            self.assertEqual(month_bounds(month)[0], high)
+
+    def test_month_for_id(self):
+        """Is a message's month the one whose range holds its id?"""
+
+        message_id = id_for_datetime(datetime(2024, 2, 29, 23, 59, 59), worker_id=7, sequence=99)
+        month = month_for_id(message_id)
+        low, high = month_bounds(month)
+
+        self.assertEqual(month, datetime(2024, 2, 1))
+        self.assertTrue(low <= message_id < high)
+        self.assertEqual(partition_name(month), 'messages_2024_02')
+
+    def test_recent_floor(self):
+        """Does the recent window start at a partition boundary RECENT_MONTHS back?"""
+
+        now = datetime(2024, 5, 17, 12)
+        expected = add_months(month_start(now), 1 - RECENT_MONTHS)
+
+        self.assertEqual(recent_floor(now), month_bounds(expected)[0])
+
+
+@skipUnless(db.engine.dialect.name == 'postgresql', "partitioning needs Postgres")
+class DefaultPartitionTestCase(DatabaseTestCase):
+    """Test writes past the last partition."""
+
+    def test_missed_month_goes_to_default(self):
+        """Does a write past the last partition land in the default one, and is its month left there?"""
+
+        now = datetime.utcnow()
+        late = add_months(month_start(now), MONTHS_AHEAD + 2)
+        low, _ = month_bounds(late)
+
+        db.session.add(Message(id=low, text="from the future", user_id=fixture_ids['testuser']))
+        db.session.commit()
+
+        count = self.connection.execute(f"SELECT count(*) FROM {DEFAULT_PARTITION}").scalar()
+        self.assertEqual(count, 1)
+
+        # Cron catching up, two months on.
+        self.assertEqual(ensure_partitions(self.connection, now=add_months(now, 2)), [late])
+        self.assertEqual(Message.query.get(low).text, "from the future")
@@ -0,0 +1,65 @@
+"""Request profiler tests."""
+
+import tempfile
+import time
+from unittest import TestCase
+
+from profiler import ProfileStore, StackSampler
+
+
+def busy_wait(seconds):
+    """Spin (in Python) for `seconds`."""
+
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class StackSamplerTestCase(TestCase):
+    """Test sampling the current thread."""
+
+    def test_samples_running_code(self):
+        """Do samples land in the function that was running?"""
+
+        sampler = StackSampler(interval=0.001).start()
+        busy_wait(0.05)
+        sampler.stop()
+
+        self.assertGreater(sampler.samples, 0)
+        stack, count = sampler.stacks.most_common(1)[0]
+        self.assertTrue(stack.endswith('test_profiler.py:busy_wait'))
+        self.assertEqual(set(sampler.categories), {'python'})
+        self.assertAlmostEqual(sum(sampler.split().values()), sampler.duration)
+
+
+class ProfileStoreTestCase(TestCase):
+    """Test saving and listing profiles."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = ProfileStore(self.dir.name, keep=2)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def save(self, endpoint):
+        sampler = StackSampler(interval=0.001).start()
+        busy_wait(0.005)
+        return self.store.save(sampler.stop(), endpoint=endpoint)
+
+    def test_keeps_newest(self):
+        """Are only the newest `keep` profiles kept, listed newest first?"""
+
+        names = [self.save(f"view{i}") for i in range(3)]
+
+        self.assertEqual([p['name'] for p in self.store.recent()], names[:0:-1])
+        self.assertIsNone(self.store.filename(names[0]))
+        self.assertEqual(self.store.filename(names[2]), f"{names[2]}.collapsed")
+
+    def test_filename_rejects_paths(self):
+        """Can only stored profile names be downloaded?"""
+
+        self.save("view")
+
+        self.assertIsNone(self.store.filename("../app"))
+        self.assertIsNone(self.store.filename("nope"))
@@ -0,0 +1,189 @@
+"""Profile summary and profile page tests."""
+
+import tempfile
+from datetime import datetime
+from unittest import mock
+
+from app import CURR_USER_KEY
+import partitions
+from archive import archive, drop_month, write_month
+from models import db, Follows, Likes, Message, User
+from profiles import followed_among, load_profile, profile_messages
+from test_archive import write_archive
+from testing import DatabaseTestCase, app
+from write_behind import write_queue
+
+
+class ProfilesTestCase(DatabaseTestCase):
+    """Test loading profiles, follow buttons and the profile pages."""
+
+    def setUp(self):
+        """testuser (following otheruser) posts twice and likes one of otheruser's messages."""
+
+        super().setUp()
+
+        self.testuser = self.fixture_user("testuser")
+        self.otheruser = self.fixture_user("otheruser")
+
+        self.first = Message(text="first post", user_id=self.testuser.id)
+        self.second = Message(text="second post", user_id=self.testuser.id)
+        self.theirs = Message(text="their post", user_id=self.otheruser.id)
+        db.session.add_all([self.first, self.second, self.theirs])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.testuser.id, message_id=self.theirs.id))
+        db.session.commit()
+
+        self.archive_dir = tempfile.TemporaryDirectory()
+        archive.configure(self.archive_dir.name)
+
+    def tearDown(self):
+        archive.configure(app.config['ARCHIVE_DIR'])
+        self.archive_dir.cleanup()
+        super().tearDown()
+
+    def archive_messages(self, *ids):
+        """Archive messages by testuser that were posted (and counted) long ago."""
+
+        (User.query
+         .filter_by(id=self.testuser.id)
+         .update({User.message_count: User.message_count + len(ids)}, synchronize_session=False))
+        write_archive(self.archive_dir.name, '2020-01', min(ids), max(ids), {
+            self.testuser.id: [dict(id=id, text=f"archived {id}", timestamp="2020-01-15T00:00:00",
+                                    user_id=self.testuser.id) for id in sorted(ids, reverse=True)]})
+
+    def test_load_profile_counts(self):
+        """Are all four counts, and the viewer's follow, loaded?"""
+
+        profile = load_profile(self.testuser.id)
+
+        self.assertEqual((profile.message_count, profile.following_count,
+                          profile.follower_count, profile.like_count), (2, 1, 0, 1))
+        self.assertFalse(profile.viewer_follows)
+
+        other = load_profile(self.otheruser.id, viewer_id=self.testuser.id)
+        self.assertEqual((other.message_count, other.follower_count), (1, 1))
+        self.assertTrue(other.viewer_follows)
+        self.assertEqual(other.card.username, "otheruser")
+
+    def test_load_profile_counts_archived_messages(self):
+        """Do archived messages count towards the message count?"""
+
+        self.archive_messages(5, 6, 7)
+
+        self.assertEqual(load_profile(self.testuser.id).message_count, 5)
+        self.assertEqual(load_profile(self.otheruser.id).message_count, 1)
+
+    def test_message_count_kept(self):
+        """Is the stored message count kept through posting, deleting and archiving?"""
+
+        db.session.add(Message(text="third post", user_id=self.testuser.id))
+        db.session.commit()
+        self.assertEqual(load_profile(self.testuser.id).message_count, 3)
+
+        db.session.delete(self.first)
+        db.session.commit()
+        self.assertEqual(load_profile(self.testuser.id).message_count, 2)
+
+        month = partitions.month_for_id(self.second.id)
+        write_month(month, self.archive_dir.name)
+        drop_month(month)
+
+        self.assertEqual(Message.query.count(), 0)
+        profile = load_profile(self.testuser.id)
+        self.assertEqual(profile.message_count, 2)
+        self.assertEqual(len(profile_messages(profile, 10)), 2)
+
+    def test_load_profile_missing_or_deleted(self):
+        """Is there no profile for unknown or tombstoned users?"""
+
+        self.assertIsNone(load_profile(999999))
+
+        self.otheruser.deleted_at = datetime.utcnow()
+        db.session.commit()
+        self.assertIsNone(load_profile(self.otheruser.id))
+
+    def test_load_profile_pending_follows(self):
+        """Do queued follows and unfollows show in the following count and follow button?"""
+
+        third = User(username="third", email="third@test.com", password="HASHED_PASSWORD")
+        db.session.add(third)
+        db.session.commit()
+
+        def pending(user_id, kind):
+            return {self.otheruser.id: False, third.id: True} if user_id == self.testuser.id else {}
+
+        with mock.patch.object(write_queue, 'pending', side_effect=pending):
+            self.assertEqual(load_profile(self.testuser.id).following_count, 1)
+            self.assertFalse(load_profile(self.otheruser.id, self.testuser.id).viewer_follows)
+            self.assertTrue(load_profile(third.id, self.testuser.id).viewer_follows)
+
+    def test_followed_among(self):
+        """Is the subset followed found, with queued changes laid over it?"""
+
+        third = User(username="third", email="third@test.com", password="HASHED_PASSWORD")
+        db.session.add(third)
+        db.session.commit()
+        ids = [self.otheruser.id, third.id]
+
+        self.assertEqual(followed_among(self.testuser.id, ids), {self.otheruser.id})
+        self.assertEqual(followed_among(None, ids), set())
+        self.assertEqual(followed_among(self.testuser.id, []), set())
+
+        with mock.patch.object(write_queue, 'pending',
+                               return_value={self.otheruser.id: False, third.id: True}):
+            self.assertEqual(followed_among(self.testuser.id, ids), {third.id})
+            self.assertEqual(followed_among(self.testuser.id, ids, pending=False),
+                             {self.otheruser.id})
+
+    def test_profile_messages_run_on_into_archive(self):
+        """Are archived messages paged in after the database's, newest first?"""
+
+        self.archive_messages(5, 6, 7)
+        profile = load_profile(self.testuser.id)
+
+        messages = profile_messages(profile, 4)
+        self.assertEqual([m.id for m in messages], [self.second.id, self.first.id, 7, 6])
+        self.assertEqual(messages[2].text, "archived 7")
+        self.assertEqual([m.id for m in profile_messages(profile, 10, before=6)], [5])
+
+    def test_profile_messages_skip_archive_for_unarchived_users(self):
+        """Are no archive files read for users with nothing archived?"""
+
+        self.archive_messages(5)
+        profile = load_profile(self.otheruser.id)
+        archive.message_count(self.otheruser.id)
+
+        with mock.patch.object(archive, '_read_frame', side_effect=AssertionError("read")):
+            self.assertEqual([m.id for m in profile_messages(profile, 10)], [self.theirs.id])
+
+    def test_profile_page(self):
+        """Does the profile page show counts and messages, archived ones included?"""
+
+        self.archive_messages(5)
+
+        resp = self.client.get(f"/users/{self.testuser.id}")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(f'<a href="/users/{self.testuser.id}">3</a>', html)
+        self.assertIn(f'<a href="/users/{self.testuser.id}/following">1</a>', html)
+        self.assertIn("second post", html)
+        self.assertIn("archived 5", html)
+
+        self.assertEqual(self.client.get("/users/999999").status_code, 404)
+
+    def test_following_and_followers_pages(self):
+        """Do the following / followers tabs list users, with the viewer's follow buttons?"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.otheruser.id
+
+            html = client.get(f"/users/{self.testuser.id}/following").get_data(as_text=True)
+            self.assertIn("@otheruser", html)
+
+            html = client.get(f"/users/{self.otheruser.id}/followers").get_data(as_text=True)
+            self.assertIn("@testuser", html)
+            # otheruser doesn't follow testuser back.
+            self.assertIn(f'action="/users/follow/{self.testuser.id}"', html)
@@ -0,0 +1,135 @@
+"""Purging deleted users tests."""
+
+from datetime import datetime
+from unittest import mock
+
+from models import db, Follows, Likes, Message, Notification, NotificationActor, User
+from notifications import FOLLOW, LIKE, Event, UnreadCounter, write_events
+from archive import archive
+from purge_users import purge_user
+from testing import DatabaseTestCase
+
+
+class PurgeUserTestCase(DatabaseTestCase):
+    """Test removing a tombstoned user and everything of theirs."""
+
+    def setUp(self):
+        """gone (to be purged) and thirduser both like testuser's message; gone posts and follows."""
+
+        super().setUp()
+
+        self.testuser = self.fixture_user("testuser")
+        self.otheruser = self.fixture_user("otheruser")
+        self.gone, self.thirduser = [
+            User(username=name, email=f"{name}@test.com", password="HASHED_PASSWORD")
+            for name in ("gone", "thirduser")]
+        db.session.add_all([self.gone, self.thirduser])
+        db.session.commit()
+
+        self.message = Message(text="Like me", user_id=self.testuser.id)
+        self.their_message = Message(text="Gone soon", user_id=self.gone.id)
+        db.session.add_all([self.message, self.their_message])
+        db.session.commit()
+
+        db.session.add_all([Likes(user_id=self.gone.id, message_id=self.message.id),
+                            Follows(user_following_id=self.gone.id,
+                                    user_being_followed_id=self.testuser.id)])
+        db.session.commit()
+
+    def write(self, *events):
+        write_events(list(events), UnreadCounter())
+
+    def purge(self):
+        self.gone.deleted_at = datetime.utcnow()
+        db.session.commit()
+        gone_id = self.gone.id
+        self.assertTrue(purge_user(gone_id, report=lambda line: None))
+        db.session.expire_all()
+        return gone_id
+
+    def notification(self, kind):
+        return Notification.query.filter_by(recipient_id=self.testuser.id, kind=kind).one_or_none()
+
+    def test_only_tombstoned_users(self):
+        """Are live and unknown users left alone?"""
+
+        self.assertFalse(purge_user(self.gone.id, report=lambda line: None))
+        self.assertFalse(purge_user(999999, report=lambda line: None))
+        self.assertIsNotNone(User.query.get(self.gone.id))
+
+    def test_purges_their_rows(self):
+        """Are the user, their messages, likes and follows all deleted?"""
+
+        gone_id = self.purge()
+
+        self.assertIsNone(User.query.get(gone_id))
+        self.assertEqual(Message.query.filter_by(user_id=gone_id).count(), 0)
+        self.assertEqual(Likes.query.filter_by(user_id=gone_id).count(), 0)
+        self.assertEqual(Follows.query.filter_by(user_following_id=gone_id).count(), 0)
+        self.assertIsNotNone(Message.query.get(self.message.id))
+
+    def test_last_actor_reassigned(self):
+        """Does a notification they were the last actor on count one fewer, naming someone else?"""
+
+        self.write(Event(self.testuser.id, LIKE, self.message.id, self.thirduser.id),
+                   Event(self.testuser.id, LIKE, self.message.id, self.gone.id))
+        self.assertEqual(self.notification(LIKE).last_actor_id, self.gone.id)
+
+        gone_id = self.purge()
+
+        notification = self.notification(LIKE)
+        self.assertEqual((notification.actor_count, notification.last_actor_id),
+                         (1, self.thirduser.id))
+        self.assertEqual(NotificationActor.query.filter_by(actor_id=gone_id).count(), 0)
+
+    def test_earlier_actor_uncounted(self):
+        """Does a notification they weren't the last actor on just count one fewer?"""
+
+        self.write(Event(self.testuser.id, LIKE, self.message.id, self.gone.id),
+                   Event(self.testuser.id, LIKE, self.message.id, self.thirduser.id))
+
+        self.purge()
+
+        notification = self.notification(LIKE)
+        self.assertEqual((notification.actor_count, notification.last_actor_id),
+                         (1, self.thirduser.id))
+
+    def test_sole_actor_notification_deleted(self):
+        """Is a notification only they acted in deleted, leaving others alone?"""
+
+        self.write(Event(self.testuser.id, FOLLOW, None, self.gone.id),
+                   Event(self.testuser.id, LIKE, self.message.id, self.thirduser.id))
+
+        self.purge()
+
+        self.assertIsNone(self.notification(FOLLOW))
+        self.assertEqual(self.notification(LIKE).actor_count, 1)
+
+    def test_notification_without_actor_rows(self):
+        """Is an older notification naming only them as last actor deleted?"""
+
+        db.session.add(Notification(recipient_id=self.testuser.id, kind=LIKE,
+                                    target_id=self.message.id, last_actor_id=self.gone.id,
+                                    actor_count=3, is_read=True))
+        db.session.commit()
+
+        self.purge()
+
+        self.assertIsNone(self.notification(LIKE))
+
+    def test_their_notifications_deleted(self):
+        """Are notifications sent to them deleted?"""
+
+        self.write(Event(self.gone.id, FOLLOW, None, self.testuser.id))
+
+        gone_id = self.purge()
+
+        self.assertEqual(Notification.query.filter_by(recipient_id=gone_id).count(), 0)
+
+    def test_purges_archive(self):
+        """Is the user taken out of the archive too?"""
+
+        with mock.patch.object(archive, 'purge_user', return_value=0) as purge_archive:
+            gone_id = self.purge()
+
+        purge_archive.assert_called_once_with(gone_id)
@@ -0,0 +1,160 @@
+"""Rate limiter tests."""
+
+import os
+import tempfile
+from unittest import TestCase
+
+from ratelimit import Limit, MemoryBackend, RateLimiter, SharedMemoryBackend
+
+
+class LimitTestCase(TestCase):
+    """Test parsing limit specs."""
+
+    def test_parse(self):
+        """Are specs turned into a rate per second and a burst?"""
+
+        self.assertEqual(Limit.parse("30/minute"), Limit(0.5, 30))
+        self.assertEqual(Limit.parse("2/second"), Limit(2, 2))
+
+    def test_parse_bad_spec(self):
+        """Are malformed specs rejected?"""
+
+        for spec in ["30", "x/minute", "30/fortnight", "0/second"]:
+            with self.assertRaises(ValueError):
+                Limit.parse(spec)
+
+
+class BackendTests:
+    """Tests run against each backend; subclasses set `self.backend`."""
+
+    limit = Limit(rate=1, burst=3)
+
+    def test_burst_then_refuse(self):
+        """Are `burst` hits allowed, then the next refused with a retry time?"""
+
+        results = [self.backend.hit("k", self.limit, 100) for _ in range(4)]
+
+        self.assertEqual([allowed for allowed, _ in results], [True, True, True, False])
+        self.assertAlmostEqual(results[-1][1], 1)
+
+    def test_refill(self):
+        """Do tokens come back at `rate` per second, up to `burst`?"""
+
+        for _ in range(3):
+            self.backend.hit("k", self.limit, 100)
+
+        self.assertTrue(self.backend.hit("k", self.limit, 101)[0])
+        self.assertFalse(self.backend.hit("k", self.limit, 101)[0])
+
+        results = [self.backend.hit("k", self.limit, 1000)[0] for _ in range(4)]
+        self.assertEqual(results, [True, True, True, False])
+
+    def test_keys_are_independent(self):
+        """Does one key running dry leave others alone?"""
+
+        for _ in range(4):
+            self.backend.hit("a", self.limit, 100)
+
+        self.assertTrue(self.backend.hit("b", self.limit, 100)[0])
+
+
+class MemoryBackendTestCase(BackendTests, TestCase):
+    """Test the in-process backend."""
+
+    def setUp(self):
+        self.backend = MemoryBackend()
+
+    def test_evicts_least_recently_used(self):
+        """Past `max_keys`, are the buckets used longest ago dropped, busy or not?"""
+
+        backend = MemoryBackend(max_keys=3, refill_seconds=3)
+
+        for key in ("a", "b", "c"):
+            backend.hit(key, self.limit, 100)
+        for _ in range(3):
+            backend.hit("a", self.limit, 100)
+        backend.hit("d", self.limit, 100)
+
+        self.assertEqual(list(backend._buckets), ["c", "a", "d"])
+        # "a" kept its empty bucket.
+        self.assertFalse(backend.hit("a", self.limit, 100)[0])
+
+    def test_evicts_idle_buckets(self):
+        """Are buckets idle long enough to have refilled dropped, however many are left?"""
+
+        backend = MemoryBackend(max_keys=3, refill_seconds=3)
+
+        for i, key in enumerate("abc"):
+            backend.hit(key, self.limit, 100 + i)
+        backend.hit("d", self.limit, 104.5)
+
+        self.assertEqual(list(backend._buckets), ["c", "d"])
+
+
+class SharedMemoryBackendTestCase(BackendTests, TestCase):
+    """Test the memory-mapped backend."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'ratelimit.bin')
+        self.backend = SharedMemoryBackend(self.path, slots=1024)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_shared_between_instances(self):
+        """Do two mappings of one file (as in two workers) share buckets?"""
+
+        other = SharedMemoryBackend(self.path, slots=1024)
+
+        for _ in range(3):
+            self.backend.hit("k", self.limit, 100)
+
+        self.assertFalse(other.hit("k", self.limit, 100)[0])
+
+    def test_full_table_reclaims_slots(self):
+        """When every probed slot is taken, is a slot reclaimed rather than failing?"""
+
+        backend = SharedMemoryBackend(os.path.join(self.dir.name, 'tiny.bin'), slots=256)
+
+        for i in range(1000):
+            self.assertTrue(backend.hit(f"key{i}", self.limit, 100 + i)[0])
+
+
+class RateLimiterTestCase(TestCase):
+    """Test per-endpoint checks."""
+
+    def setUp(self):
+        self.limiter = RateLimiter()
+        self.limiter.configure({'post': {'per_user': '2/minute', 'per_ip': '3/minute'}})
+
+    def test_unlimited_endpoint(self):
+        """Are endpoints without limits let through?"""
+
+        for _ in range(10):
+            self.assertIsNone(self.limiter.check('other', 1, '10.0.0.1'))
+
+    def test_per_user(self):
+        """Is a user limited however many IPs they use?"""
+
+        self.assertIsNone(self.limiter.check('post', 1, '10.0.0.1'))
+        self.assertIsNone(self.limiter.check('post', 1, '10.0.0.2'))
+        self.assertEqual(self.limiter.check('post', 1, '10.0.0.3'), 30)
+
+    def test_per_ip(self):
+        """Is an IP limited across users (and anonymous requests)?"""
+
+        self.assertIsNone(self.limiter.check('post', 1, '10.0.0.1'))
+        self.assertIsNone(self.limiter.check('post', 2, '10.0.0.1'))
+        self.assertIsNone(self.limiter.check('post', None, '10.0.0.1'))
+        self.assertEqual(self.limiter.check('post', 3, '10.0.0.1'), 20)
+        self.assertEqual(self.limiter.stats(), {'limited': 1})
+
+    def test_idle_window_from_longest_limit(self):
+        """Are in-memory buckets kept until the slowest configured limit would have refilled?"""
+
+        self.assertEqual(self.limiter.backend.refill_seconds, 60)
+
+        self.limiter.configure({'post': {'per_user': '2/minute'},
+                                'import': {'per_ip': '5/hour'}})
+        self.assertEqual(self.limiter.backend.refill_seconds, 3600)
@@ -0,0 +1,80 @@
+"""Follow suggestion tests."""
+
+from datetime import datetime
+
+from models import db, Follows, Suggestion, User
+from recommendations import compute_suggestions, load_follow_graph, write_suggestions
+from testing import DatabaseTestCase
+
+
+class RecommendationsTestCase(DatabaseTestCase):
+    """Test scoring suggestions and reading them back."""
+
+    def setUp(self):
+        """Build a small follow graph around the fixture testuser.
+
+        testuser follows otheruser (a fixture) and x; otheruser follows c and
+        d, x follows d, and y follows both testuser and c.
+        """
+
+        super().setUp()
+
+        self.testuser = self.fixture_user("testuser")
+        self.otheruser = self.fixture_user("otheruser")
+
+        self.c, self.d, self.x, self.y = [
+            User(username=name, email=f"{name}@test.com", password="HASHED_PASSWORD")
+            for name in ("c", "d", "x", "y")]
+        db.session.add_all([self.c, self.d, self.x, self.y])
+        db.session.commit()
+
+        edges = [(self.testuser, self.x), (self.otheruser, self.c), (self.otheruser, self.d),
+                 (self.x, self.d), (self.y, self.testuser), (self.y, self.c)]
+        db.session.add_all([Follows(user_following_id=follower.id, user_being_followed_id=followed.id)
+                            for follower, followed in edges])
+        db.session.commit()
+
+    def rebuild(self):
+        matrix, user_ids = load_follow_graph()
+        write_suggestions(compute_suggestions(matrix, processes=1), user_ids)
+
+    def test_scores(self):
+        """Are friends-of-friends and common followers weighted, and follows and self skipped?"""
+
+        self.rebuild()
+
+        rows = (Suggestion.query
+                .filter_by(user_id=self.testuser.id)
+                .order_by(Suggestion.rank)
+                .all())
+
+        # d: followed by otheruser and x (2 x 1.0); c: followed by
+        # otheruser (1.0), and y follows both testuser and c (0.5).
+        self.assertEqual([(row.suggested_user_id, row.score) for row in rows],
+                         [(self.d.id, 2.0), (self.c.id, 1.5)])
+
+    def test_users_for_skips_deleted_and_followed(self):
+        """Are tombstoned users, and users followed since the batch ran, left out?"""
+
+        self.rebuild()
+        self.assertEqual(Suggestion.users_for(self.testuser.id), [self.d, self.c])
+
+        self.d.deleted_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(Suggestion.users_for(self.testuser.id), [self.c])
+
+        db.session.add(Follows(user_following_id=self.testuser.id, user_being_followed_id=self.c.id))
+        db.session.commit()
+        self.assertEqual(Suggestion.users_for(self.testuser.id), [])
+
+    def test_rebuild_replaces_suggestions(self):
+        """Does a rebuild drop suggestions that no longer score?"""
+
+        self.rebuild()
+        Follows.query.filter_by(user_following_id=self.x.id).delete()
+        Follows.query.filter_by(user_following_id=self.otheruser.id).delete()
+        db.session.commit()
+
+        self.rebuild()
+
+        self.assertEqual([user.id for user in Suggestion.users_for(self.testuser.id)], [self.c.id])
@@ -0,0 +1,141 @@
+"""Slow query log tests."""
+
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from sqlalchemy import create_engine, text
+
+from slow_queries import explainable, parameter_shapes, slow_query_log
+
+
+class ParameterShapesTestCase(TestCase):
+    """Test describing bound parameters without their values."""
+
+    def test_shapes(self):
+        """Are values reduced to their types (and lengths for lists)?"""
+
+        self.assertEqual(parameter_shapes({'id': 5, 'name': 'bob', 'ids': [1, 2, 3]}),
+                         {'id': 'int', 'name': 'str', 'ids': 'list[3]'})
+        self.assertEqual(parameter_shapes((5, None)), ['int', 'NoneType'])
+        self.assertEqual(parameter_shapes([{'id': 1}, {'id': 2}], executemany=True),
+                         {'rows': 2, 'first': {'id': 'int'}})
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Test recording statements over the threshold."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.dir.name, 'slow.log')
+        self.engine = create_engine('sqlite://')
+        slow_query_log.reset()
+
+    def tearDown(self):
+        slow_query_log.configure(threshold=None)
+        slow_query_log.reset()
+        self.engine.dispose()
+        self.dir.cleanup()
+
+    def test_records_slow_statements(self):
+        """Are statements over the threshold logged and ranked?"""
+
+        slow_query_log.configure(threshold=0, log_path=self.log_path)
+
+        with self.engine.connect() as conn:
+            for _ in range(3):
+                conn.execute(text("SELECT :value"), {'value': 1})
+
+        top = slow_query_log.top()
+        self.assertEqual(top[0]['sql'], "SELECT ?")
+        self.assertEqual(top[0]['count'], 3)
+        self.assertIsNone(top[0]['plan'])
+
+        with open(self.log_path) as log:
+            entries = [json.loads(line) for line in log]
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(entries[0]['parameters'], ['int'])
+
+    def test_fast_statements_ignored(self):
+        """Are statements under the threshold left out?"""
+
+        slow_query_log.configure(threshold=60)
+
+        with self.engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+        self.assertEqual(slow_query_log.top(), [])
+
+
+class FakeCursor:
+    """A DBAPI cursor that records what it runs, optionally failing on EXPLAIN."""
+
+    def __init__(self, executed, fail=False):
+        self.executed = executed
+        self.fail = fail
+        self.connection = self
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement, parameters=None):
+        self.executed.append(statement)
+        if self.fail and statement.startswith("EXPLAIN"):
+            raise RuntimeError("canceling statement")
+
+    def fetchall(self):
+        return [("Seq Scan on users",)]
+
+    def close(self):
+        pass
+
+
+class ExplainTestCase(TestCase):
+    """Test capturing plans for slow statements (with a stand-in Postgres connection)."""
+
+    def setUp(self):
+        self.executed = []
+        self.conn = mock.Mock()
+        self.conn.dialect.name = 'postgresql'
+        slow_query_log.configure(threshold=0, explain_rate=1)
+        slow_query_log.reset()
+
+    def tearDown(self):
+        slow_query_log.configure(threshold=None)
+        slow_query_log.reset()
+
+    def record(self, statement, fail=False):
+        slow_query_log.record(self.conn, FakeCursor(self.executed, fail), statement, {}, False, 1.0)
+        return slow_query_log.top()[0]['plan']
+
+    def test_explains_in_a_rolled_back_savepoint(self):
+        """Is the plan captured, and the re-run statement always rolled back?"""
+
+        self.assertEqual(self.record("SELECT * FROM users"), "Seq Scan on users")
+        self.assertEqual(self.executed, [
+            "SAVEPOINT slow_query_explain",
+            "EXPLAIN (ANALYZE, BUFFERS) SELECT * FROM users",
+            "ROLLBACK TO SAVEPOINT slow_query_explain",
+            "RELEASE SAVEPOINT slow_query_explain",
+        ])
+
+    def test_failed_explain(self):
+        """Is a failed EXPLAIN noted in place of the plan, and rolled back too?"""
+
+        self.assertEqual(self.record("SELECT * FROM users", fail=True),
+                         "EXPLAIN failed: canceling statement")
+        self.assertEqual(self.executed[-2:], ["ROLLBACK TO SAVEPOINT slow_query_explain",
+                                              "RELEASE SAVEPOINT slow_query_explain"])
+
+    def test_only_plain_selects(self):
+        """Are statements that could change data never re-run?"""
+
+        for statement in ["WITH gone AS (DELETE FROM likes RETURNING id) SELECT count(*) FROM gone",
+                          "SELECT * FROM users WHERE id = 1 FOR UPDATE",
+                          "SELECT * INTO users_copy FROM users",
+                          "UPDATE users SET bio = ''"]:
+            self.assertIsNone(self.record(statement), statement)
+
+        self.assertEqual(self.executed, [])
+        self.assertTrue(explainable("  select id from users"))
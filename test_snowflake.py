@@ -0,0 +1,77 @@
+"""Snowflake id tests."""
+
+import os
+import sys
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+
+from snowflake import (SnowflakeGenerator, id_for_datetime, datetime_for_id, default_worker_id,
+                       DEV_WORKER_ID, ids_for_datetimes, MAX_WORKER_ID, SEQUENCE_BITS)
+
+
+class SnowflakeTestCase(TestCase):
+    """Test generating and decoding snowflake ids."""
+
+    def test_ids_increase(self):
+        """Are ids from one generator unique and strictly increasing?"""
+
+        gen = SnowflakeGenerator(worker_id=7)
+        ids = [gen.next_id() for i in range(10000)]
+
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_worker_bits(self):
+        """Is the worker id encoded in every id?"""
+
+        gen = SnowflakeGenerator(worker_id=42)
+        worker = (gen.next_id() >> SEQUENCE_BITS) & MAX_WORKER_ID
+
+        self.assertEqual(worker, 42)
+
+    def test_invalid_worker(self):
+        """Are out of range worker ids rejected?"""
+
+        with self.assertRaises(ValueError):
+            SnowflakeGenerator(worker_id=MAX_WORKER_ID + 1)
+
+    def test_datetime_round_trip(self):
+        """Can the creation time be recovered from an id?"""
+
+        dt = datetime(2020, 5, 17, 12, 30, 15, 123000)
+
+        self.assertEqual(datetime_for_id(id_for_datetime(dt, worker_id=3, sequence=9)), dt)
+
+    def test_ids_for_datetimes(self):
+        """Do backfilled ids stay unique when timestamps collide?"""
+
+        dt = datetime(2019, 1, 1)
+        dts = [dt, dt, dt, dt + timedelta(seconds=1)]
+        ids = list(ids_for_datetimes(dts))
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(ids[0], id_for_datetime(dt))
+        self.assertEqual(ids[3], id_for_datetime(dts[3]))
+
+        more = list(ids_for_datetimes([dt], last=ids[-1]))
+        self.assertGreater(more[0], ids[-1])
+
+    def test_default_worker_id(self):
+        """Is the worker id in range, and required under gunicorn but not elsewhere?"""
+
+        with mock.patch.dict(os.environ, {'WARBLER_WORKER_ID': '17'}):
+            self.assertEqual(default_worker_id(), 17)
+
+        with mock.patch.dict(os.environ, {'WARBLER_WORKER_ID': str(MAX_WORKER_ID + 1)}):
+            with self.assertRaises(ValueError):
+                default_worker_id()
+
+        with mock.patch.dict(os.environ):
+            os.environ.pop('WARBLER_WORKER_ID', None)
+            with mock.patch.dict(sys.modules):
+                sys.modules.pop('gunicorn', None)
+                self.assertEqual(default_worker_id(), DEV_WORKER_ID)
+
+                sys.modules['gunicorn'] = mock.Mock()
+                with self.assertRaises(RuntimeError):
+                    default_worker_id()
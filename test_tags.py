@@ -0,0 +1,101 @@
+"""Hashtag and mention parsing, indexing and feed tests."""
+
+from unittest import TestCase, mock
+
+from app import CURR_USER_KEY
+from backfill_tags import backfill
+from models import db, Mention, Message, MessageTag
+from tags import extract_tags, extract_mentions, index_messages, mention_feed, tag_feed
+from testing import DatabaseTestCase
+
+
+class TagParsingTestCase(TestCase):
+    """Test pulling hashtags and mentions out of warbles."""
+
+    def test_extract_tags(self):
+        """Are hashtags found, lowercased and deduplicated?"""
+
+        text = "Loving #Flask and #flask, also #python3! Not a&#39;tag or email#tag"
+
+        self.assertEqual(extract_tags(text), {"flask", "python3"})
+
+    def test_extract_mentions(self):
+        """Are @mentions found, without trailing punctuation or emails?"""
+
+        text = "Hi @jane.doe. and @bob_99, mail me at me@example.com"
+
+        self.assertEqual(extract_mentions(text), {"jane.doe", "bob_99"})
+
+    def test_no_tags_or_mentions(self):
+        """Does plain text produce nothing?"""
+
+        self.assertEqual(extract_tags("just words"), set())
+        self.assertEqual(extract_mentions("just words"), set())
+
+
+class TagFeedTestCase(DatabaseTestCase):
+    """Test indexing posted messages and reading the tag and mention feeds."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.testuser = self.fixture_user("testuser")
+        self.otheruser = self.fixture_user("otheruser")
+
+    def post(self, text):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            c.post("/messages/new", data={"text": text})
+
+        return Message.query.filter_by(text=text).one().id
+
+    def test_posted_messages_in_feeds(self):
+        """Do posted messages show in their tags' and mentioned users' feeds, newest first?"""
+
+        first = self.post("#Flask tip for @otheruser")
+        second = self.post("more #flask, cc @otheruser and @nobody")
+        self.post("#python only")
+
+        self.assertEqual([r.id for r in tag_feed("FLASK", 10)], [second, first])
+        self.assertEqual([r.id for r in tag_feed("flask", 10, before=second)], [first])
+        self.assertEqual([r.id for r in tag_feed("flask", 1)], [second])
+        self.assertEqual(tag_feed("django", 10), [])
+
+        self.assertEqual([r.id for r in mention_feed(self.otheruser.id, 10)], [second, first])
+        self.assertEqual([r.id for r in mention_feed(self.otheruser.id, 10, before=second)],
+                         [first])
+        self.assertEqual(mention_feed(self.testuser.id, 10), [])
+
+    def test_index_messages(self):
+        """Are tag and mention rows added for flushed messages, skipping unknown users?"""
+
+        msg = Message(text="#a #b @otheruser @ghost", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.flush()
+        index_messages([msg])
+        db.session.commit()
+
+        self.assertEqual({t.tag for t in MessageTag.query.filter_by(message_id=msg.id)}, {"a", "b"})
+        self.assertEqual([m.user_id for m in Mention.query.filter_by(message_id=msg.id)],
+                         [self.otheruser.id])
+
+    def test_backfill_twice(self):
+        """Does the backfill index unindexed messages, and add nothing running again?"""
+
+        messages = [Message(text=f"#old{i % 2} for @otheruser", user_id=self.testuser.id)
+                    for i in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+        ids = [message.id for message in messages]
+        otheruser_id = self.otheruser.id
+
+        with mock.patch('builtins.print'):
+            self.assertEqual(backfill(batch_size=2), 3)
+            self.assertEqual(backfill(batch_size=2), 3)
+
+        self.assertEqual(MessageTag.query.count(), 3)
+        self.assertEqual(Mention.query.count(), 3)
+        self.assertEqual([r.id for r in tag_feed("old0", 10)], [ids[2], ids[0]])
+        # The backfill expunges the session, so go by id.
+        self.assertEqual([r.id for r in mention_feed(otheruser_id, 10)], ids[::-1])
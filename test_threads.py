@@ -0,0 +1,118 @@
+"""Reply thread tests."""
+
+from unittest import TestCase, mock
+
+import threads
+from models import db, path_segment, Message
+from testing import DatabaseTestCase
+from threads import add_reply, ancestor_ids, ancestors, detach_replies, is_path, thread_page
+
+
+class PathTestCase(TestCase):
+    """Test materialized paths."""
+
+    def test_segments_sort_like_ids(self):
+        """Do segments have a fixed width and sort in id order?"""
+
+        ids = [5, 1 << 40, 1561688576475406336, (1 << 63) - 1]
+        segments = [path_segment(id) for id in ids]
+
+        self.assertEqual({len(segment) for segment in segments}, {16})
+        self.assertEqual(sorted(segments), segments)
+
+    def test_ancestor_ids(self):
+        """Are a path's ids, minus the message's own, returned root first?"""
+
+        path = path_segment(10) + path_segment(20) + path_segment(30)
+
+        self.assertEqual(ancestor_ids(path), [10, 20])
+        self.assertEqual(ancestor_ids(path_segment(10)), [])
+
+    def test_is_path(self):
+        """Are only whole segments of lowercase hex accepted?"""
+
+        self.assertTrue(is_path(path_segment(10) + path_segment(20)))
+
+        for value in [None, '', 'abc', path_segment(10) + 'a', path_segment(10).upper() + 'X']:
+            self.assertFalse(is_path(value))
+
+
+class ThreadTestCase(DatabaseTestCase):
+    """Test replying, paging threads and deleting replied-to messages."""
+
+    def setUp(self):
+        """testuser posts a root; otheruser replies twice, and testuser answers the first reply."""
+
+        super().setUp()
+
+        self.testuser = self.fixture_user("testuser")
+        self.otheruser = self.fixture_user("otheruser")
+
+        self.root = Message(text="root", user_id=self.testuser.id)
+        db.session.add(self.root)
+        db.session.commit()
+
+        self.first = self.reply(self.root, self.otheruser, "first")
+        self.second = self.reply(self.root, self.otheruser, "second")
+        self.answer = self.reply(self.first, self.testuser, "answer")
+
+    def reply(self, parent, user, text):
+        reply = add_reply(parent, user.id, text)
+        db.session.commit()
+        return reply
+
+    def test_add_reply(self):
+        """Does a reply get its parent's path plus its own id, one level down, and count?"""
+
+        self.assertEqual(self.first.parent_id, self.root.id)
+        self.assertEqual(self.first.path, self.root.path + path_segment(self.first.id))
+        self.assertEqual(self.answer.path, self.first.path + path_segment(self.answer.id))
+        self.assertEqual((self.first.depth, self.answer.depth), (1, 2))
+
+        db.session.expire_all()
+        self.assertEqual(Message.query.get(self.root.id).reply_count, 2)
+        self.assertEqual(Message.query.get(self.first.id).reply_count, 1)
+        self.assertEqual(Message.query.get(self.second.id).reply_count, 0)
+
+    def test_thread_page(self):
+        """Are replies paged in thread order, depth first, and cut off at `max_depth`?"""
+
+        page = thread_page(self.root.id)
+        self.assertEqual([r.text for r in page], ["first", "answer", "second"])
+        self.assertEqual([r.text for r in ancestors(page[1])], ["root", "first"])
+
+        first_page = thread_page(self.root.id, limit=2)
+        self.assertEqual([r.text for r in first_page], ["first", "answer"])
+        rest = thread_page(self.root.id, limit=2, after=first_page[-1].path)
+        self.assertEqual([r.text for r in rest], ["second"])
+
+        self.assertEqual([r.text for r in thread_page(self.root.id, max_depth=1)],
+                         ["first", "second"])
+        self.assertEqual([r.text for r in thread_page(self.first.id)], ["answer"])
+
+    def test_max_depth(self):
+        """Does a reply to a message at MAX_DEPTH become its sibling?"""
+
+        with mock.patch.object(threads, 'MAX_DEPTH', 2):
+            deeper = self.reply(self.answer, self.otheruser, "deeper")
+
+        self.assertEqual(deeper.parent_id, self.first.id)
+        self.assertEqual(deeper.depth, 2)
+        self.assertEqual(deeper.path, self.first.path + path_segment(deeper.id))
+
+        db.session.expire_all()
+        self.assertEqual(Message.query.get(self.first.id).reply_count, 2)
+        self.assertEqual(Message.query.get(self.answer.id).reply_count, 0)
+
+    def test_detach_replies(self):
+        """Does deleting a reply take it off its parent's count, leaving its own replies in place?"""
+
+        self.assertEqual(detach_replies([self.first.id, self.root.id]), [self.root.id])
+        db.session.delete(self.first)
+        db.session.commit()
+
+        db.session.expire_all()
+        self.assertEqual(Message.query.get(self.root.id).reply_count, 1)
+        self.assertEqual([r.text for r in thread_page(self.root.id)], ["answer", "second"])
+        self.assertEqual([r.text for r in ancestors(self.answer)], ["root"])
+        self.assertEqual(detach_replies([self.root.id]), [])
@@ -0,0 +1,193 @@
+"""Timeline engine, cache and message record tests."""
+
+from datetime import datetime
+from unittest import TestCase, mock
+
+from models import db, Message, User
+from records import AuthorCard, MessageRecord
+from snowflake import id_for_datetime
+from testing import DatabaseTestCase
+from timeline import (AuthorTimelineCache, fetch_recent, home_timeline, in_query_timeline,
+                      merged_timeline)
+
+
+def records(user_id, *ids):
+    """Records with `ids` by one author."""
+
+    author = AuthorCard(user_id, f"user{user_id}", None)
+    return [MessageRecord(id, "text", None, author) for id in ids]
+
+
+def ids(found):
+    """{author_id: [records]} -> {author_id: [ids]}"""
+
+    return {author_id: [r.id for r in recs] for author_id, recs in found.items()}
+
+
+class AuthorTimelineCacheTestCase(TestCase):
+    """Test the per-author recent message cache."""
+
+    def setUp(self):
+        self.cache = AuthorTimelineCache(max_authors=2, ttl=60)
+
+    def test_get_many(self):
+        """Are cached authors returned, trimmed to the limit?"""
+
+        self.cache.set_many({1: records(1, 30, 20, 10), 2: records(2, 25)}, limit=3)
+
+        self.assertEqual(ids(self.cache.get_many([1, 2, 3], limit=2)), {1: [30, 20], 2: [25]})
+
+    def test_incomplete_entry_not_used_for_bigger_limit(self):
+        """Is a partial list skipped when more ids are needed than were fetched?"""
+
+        self.cache.set_many({1: records(1, 30, 20)}, limit=2)
+
+        self.assertEqual(ids(self.cache.get_many([1], limit=5)), {})
+
+    def test_add_message(self):
+        """Do new messages go to the front of a cached author's list?"""
+
+        self.cache.set_many({1: records(1, 30, 20)}, limit=2)
+        self.cache.add_message(records(1, 40)[0])
+
+        self.assertEqual(ids(self.cache.get_many([1], limit=2)), {1: [40, 30]})
+
+    def test_remove_author(self):
+        """Is an author forgotten after removal?"""
+
+        self.cache.set_many({1: records(1, 30)}, limit=2)
+        self.cache.remove_author(1)
+
+        self.assertEqual(ids(self.cache.get_many([1], limit=2)), {})
+
+    def test_lru_eviction(self):
+        """Is the least recently used author evicted when full?"""
+
+        self.cache.set_many({1: records(1, 10)}, limit=2)
+        self.cache.set_many({2: records(2, 20)}, limit=2)
+        self.cache.get_many([1], limit=2)
+        self.cache.set_many({3: records(3, 30)}, limit=2)
+
+        self.assertEqual(ids(self.cache.get_many([1, 2, 3], limit=2)), {1: [10], 3: [30]})
+
+    def test_expiry(self):
+        """Are expired entries ignored?"""
+
+        self.cache.ttl = -1
+        self.cache.set_many({1: records(1, 10)}, limit=2)
+
+        self.assertEqual(ids(self.cache.get_many([1], limit=2)), {})
+
+
+class MessageRecordTestCase(TestCase):
+    """Test compact message records."""
+
+    def test_from_rows_shares_author_cards(self):
+        """Do records by the same author share one card?"""
+
+        rows = [(2, "b", None, 7, "seven", "/7.png"),
+                (1, "a", None, 7, "seven", "/7.png")]
+        first, second = MessageRecord.from_rows(rows)
+
+        self.assertIs(first.user, second.user)
+        self.assertEqual(first.user_id, 7)
+        self.assertEqual(second.user.username, "seven")
+
+    def test_immutable(self):
+        """Can records be changed after construction?"""
+
+        record = records(1, 10)[0]
+
+        with self.assertRaises(AttributeError):
+            record.text = "changed"
+
+        with self.assertRaises(AttributeError):
+            record.extra = "nope"
+
+
+class TimelineEnginesTestCase(DatabaseTestCase):
+    """Test the merge and IN-query engines against a plain ORDER BY id DESC."""
+
+    def setUp(self):
+        """Authors a and b post interleaved, all at the same moment; c never posts.
+
+        testuser posts too, but isn't one of the authors asked for.
+        """
+
+        super().setUp()
+
+        self.a, self.b, self.c = [
+            User(username=name, email=f"{name}@test.com", password="HASHED_PASSWORD")
+            for name in ("a", "b", "c")]
+        db.session.add_all([self.a, self.b, self.c])
+        db.session.commit()
+
+        moment = datetime(2024, 5, 1)
+        base = id_for_datetime(moment)
+        authors = [self.a, self.b, self.a, self.a, self.b, self.fixture_user("testuser"), self.b]
+        db.session.add_all([Message(id=base + i, text=f"m{i}", timestamp=moment, user_id=user.id)
+                            for i, user in enumerate(authors)])
+        db.session.commit()
+
+        self.base = base
+        self.author_ids = [self.a.id, self.b.id, self.c.id]
+
+    def expected(self, limit, before=None):
+        query = Message.query.filter(Message.user_id.in_(self.author_ids))
+        if before:
+            query = query.filter(Message.id < before)
+        return [message.id for message in query.order_by(Message.id.desc()).limit(limit)]
+
+    def test_engines_match_order_by(self):
+        """Do both engines return exactly the plain query's page, for every limit and cursor?"""
+
+        for limit in (1, 2, 3, 10):
+            for before in (None, self.base + 6, self.base + 3, self.base + 1, self.base):
+                expected = self.expected(limit, before)
+                merged = merged_timeline(self.author_ids, limit, before,
+                                         cache=AuthorTimelineCache())
+                in_query = in_query_timeline(self.author_ids, limit, before)
+
+                self.assertEqual([r.id for r in merged], expected, (limit, before))
+                self.assertEqual([r.id for r in in_query], expected, (limit, before))
+
+    def test_fetch_recent(self):
+        """Is each author's newest `limit` fetched, with an empty list for authors with none?"""
+
+        recent = fetch_recent(self.author_ids, 2)
+        self.assertEqual(ids(recent), {self.a.id: [self.base + 3, self.base + 2],
+                                       self.b.id: [self.base + 6, self.base + 4],
+                                       self.c.id: []})
+
+        recent = fetch_recent(self.author_ids, 2, before=self.base + 3)
+        self.assertEqual(ids(recent), {self.a.id: [self.base + 2, self.base],
+                                       self.b.id: [self.base + 1],
+                                       self.c.id: []})
+
+    def test_first_page_cached(self):
+        """Is the first page served from the cache the second time, and older pages not?"""
+
+        cache = AuthorTimelineCache()
+        first = merged_timeline(self.author_ids, 3, cache=cache)
+
+        with mock.patch('timeline.fetch_recent', side_effect=fetch_recent) as fetch:
+            self.assertEqual(merged_timeline(self.author_ids, 3, cache=cache), first)
+            fetch.assert_not_called()
+
+            merged_timeline(self.author_ids, 3, before=first[-1].id, cache=cache)
+            fetch.assert_called_once()
+
+    def test_home_timeline_threshold(self):
+        """Is the merge engine used from `merge_threshold` authors up, and the IN query below?"""
+
+        with mock.patch('timeline.merged_timeline', return_value=[]) as merged, \
+                mock.patch('timeline.in_query_timeline', return_value=[]) as in_query:
+            home_timeline(self.author_ids, 5, merge_threshold=3)
+            merged.assert_called_once_with(self.author_ids, 5, None)
+            in_query.assert_not_called()
+
+            home_timeline(self.author_ids, 5, merge_threshold=4)
+            in_query.assert_called_once_with(self.author_ids, 5, None)
+
+        self.assertEqual([r.id for r in home_timeline(self.author_ids, 4, merge_threshold=1)],
+                         self.expected(4))
@@ -0,0 +1,134 @@
+"""Profile image upload tests."""
+
+import os
+import tempfile
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from unittest import TestCase, mock
+
+from PIL import Image
+
+import uploads
+from uploads import AVATAR, HEADER, ImageError, render_variants, store_images, thumbnail
+
+
+def image_bytes(size=(800, 600)):
+    """A PNG of `size`."""
+
+    out = BytesIO()
+    Image.new('RGB', size, 'blue').save(out, 'PNG')
+    return out.getvalue()
+
+
+class RenderVariantsTestCase(TestCase):
+    """Test generating image variants (in-process, without the pool)."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def open(self, url):
+        return Image.open(os.path.join(self.dir.name, url[len('/uploads/'):]))
+
+    def test_variant_sizes(self):
+        """Is every variant written at its fixed size?"""
+
+        urls = render_variants(image_bytes(), HEADER, self.dir.name)
+
+        self.assertEqual(self.open(urls['small']).size, (600, 200))
+        self.assertEqual(self.open(urls['large']).size, (1500, 500))
+
+    def test_content_hashed_names(self):
+        """Does the same upload get the same URLs, and a different one different URLs?"""
+
+        first = render_variants(image_bytes(), AVATAR, self.dir.name)
+
+        self.assertEqual(render_variants(image_bytes(), AVATAR, self.dir.name), first)
+        self.assertNotEqual(render_variants(image_bytes((10, 10)), AVATAR, self.dir.name), first)
+        self.assertNotEqual(render_variants(image_bytes(), HEADER, self.dir.name), first)
+
+    def test_names_follow_variant_sizes(self):
+        """Does changing a variant's size give the upload new names?"""
+
+        first = render_variants(image_bytes(), AVATAR, self.dir.name)
+
+        with mock.patch.dict(uploads.VARIANTS, {AVATAR: {'small': (100, 100), 'large': (400, 400)}}):
+            resized = render_variants(image_bytes(), AVATAR, self.dir.name)
+
+        self.assertNotEqual(resized['small'], first['small'])
+        self.assertEqual(self.open(resized['small']).size, (100, 100))
+
+    def test_not_an_image(self):
+        """Are uploads that aren't images rejected?"""
+
+        with self.assertRaises(ImageError):
+            render_variants(b'not an image', AVATAR, self.dir.name)
+
+    def test_decoder_errors(self):
+        """Are decoders failing with errors other than OSError rejected the same way?"""
+
+        for error in (ValueError("bad tile"), SyntaxError("not a PNG file"),
+                      Image.DecompressionBombError("too many pixels")):
+            with mock.patch('uploads.Image.open', side_effect=error):
+                with self.assertRaises(ImageError):
+                    render_variants(image_bytes(), AVATAR, self.dir.name)
+
+
+class ThumbnailFilterTestCase(TestCase):
+    """Test the thumbnail template filter."""
+
+    def test_uploaded_image(self):
+        """Is the variant swapped for uploaded images?"""
+
+        url = '/uploads/ab/' + 'ab' * 16 + '-avatar-large.jpg'
+
+        self.assertEqual(thumbnail(url), '/uploads/ab/' + 'ab' * 16 + '-avatar-small.jpg')
+
+    def test_external_image(self):
+        """Are other URLs left alone?"""
+
+        self.assertEqual(thumbnail('https://example.com/me.jpg'), 'https://example.com/me.jpg')
+        self.assertIsNone(thumbnail(None))
+
+
+class StoreImagesTestCase(TestCase):
+    """Test handing uploads to the pool, with a stand-in pool."""
+
+    def store(self, error):
+        future = mock.Mock()
+        future.result.side_effect = error
+        pool = mock.Mock()
+        pool.submit.return_value = future
+
+        with mock.patch('uploads._pool', pool):
+            with self.assertRaises(ImageError):
+                store_images({AVATAR: b'data'}, '/nowhere')
+            return uploads._pool
+
+    def test_timeout(self):
+        """Is a pool that takes too long reported as an unusable image?"""
+
+        self.assertIsNotNone(self.store(TimeoutError()))
+
+    def test_broken_pool(self):
+        """Is a broken pool reported, and dropped so the next upload starts a new one?"""
+
+        self.assertIsNone(self.store(BrokenProcessPool("a worker died")))
+
+    def test_write_failure(self):
+        """Are failures writing the files reported like unreadable images?"""
+
+        self.assertIsNotNone(self.store(OSError(28, "No space left on device")))
+
+    def test_start_pool(self):
+        """Is the pool started once, from a forkserver rather than forking this process?"""
+
+        with mock.patch('uploads._pool', None):
+            pool = uploads.start_pool(1)
+            try:
+                self.assertIs(uploads.start_pool(1), pool)
+                self.assertEqual(pool._mp_context.get_start_method(), 'forkserver')
+            finally:
+                pool.shutdown()
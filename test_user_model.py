@@ -1,24 +1,8 @@
 """User model tests."""
 
-import os
-from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 from models import db, User, Message, Follows
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-
-# Now we can import app
-from app import app
-
-
-# Create our tables (we do this here, so we only create the tables once for all tests --- in each test, we'll delete the data and create fresh new clean test data
-db.create_all()
-
+from testing import DatabaseTestCase, app
 
 
 # Data to create test users
@@ -36,21 +20,9 @@ USER_2_DATA = dict(
 
 
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Test views for messages."""
 
-    def setUp(self):
-        """Clear any errors, clear tables, create test client"""
-
-        db.session.rollback()
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-
-        self.client = app.test_client()
-
-
-
     def test_user_model(self):
         """Does basic model work?"""
 
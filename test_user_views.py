@@ -1,82 +1,20 @@
 """User views tests."""
 
-import os
-from unittest import TestCase
-from models import db, connect_db, Message, User, Follows, Likes
+from models import db, Message, User, Follows, Likes
+from testing import DatabaseTestCase, app
+from app import CURR_USER_KEY
 
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Import app
-from app import app, CURR_USER_KEY
-
-# Create our tables 
-# db.drop_all()
-db.create_all()
-
-app.config['WTF_CSRF_ENABLED'] = False
-app.config['PRESERVE_CONTEXT_ON_EXCEPTION'] = False
-
-
-
-# Create Test Users
-""" 
-My instinct here is to:
-- add my user data before setup like I did for the user model tests
-- Add one user to the other as following
-- Then add a user to the session as logged in, the way the signup route would have - not sure though how the session works with tests?
-
-Not sure if I should be doing that in the set up though - wouldn't that be extra work for the test to go through each time, when i only need it to happen once for all tests?
-
-"""
-
-# USER_1 = User.signup(
-#     email="test1@test.com",
-#     username="testuser1",
-#     password="HASHED_PASSWORD",
-#     image_url="/static/images/default-pic.png"
-# )
-
-# USER_2 = User.signup(
-#     email="test2@test.com",
-#     username="testuser2",
-#     password="HASHED_PASSWORD",
-#     image_url="/static/images/default-pic.png"
-# )
-
-# USER_1.following = [USER_2]
-# db.session.add_all([USER_1, USER_2])
-# db.session.commit()
-
-# session[CURR_USER_KEY] = USER_1.id
-
-
-
-
-class UserViewsTestCase(TestCase):
+class UserViewsTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
-        """Clear any errors, create test client, add ssample data"""
-
-        db.session.rollback()
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-
-        self.client = app.test_client()
-
-        self.testuser1 = User.signup(username="testuser1",
-                                    email="test1@test.com",
-                                    password="testuser1",
-                                    image_url=None)
+        """Start a test transaction, load the fixture users"""
 
-        self.testuser2 = User.signup(username="testuser2",
-                                    email="test2@test.com",
-                                    password="testuser2",
-                                    image_url=None)
+        super().setUp()
 
-        db.session.commit()
+        self.testuser1 = self.fixture_user("testuser")
+        self.testuser2 = self.fixture_user("otheruser")
 
 
     def test_logged_in_view_home(self):
@@ -92,7 +30,7 @@ class UserViewsTestCase(TestCase):
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("<p>@testuser1</p>", html)
+            self.assertIn("<p>@testuser</p>", html)
             self.assertIn(f'<a href="/users/{self.testuser1.id}/followers">0</a>', html)
             self.assertIn(f'<a href="/users/{self.testuser1.id}">', html)
             self.assertIn(f'<a href="/messages/new">New Message</a>', html)
@@ -112,11 +50,13 @@ class UserViewsTestCase(TestCase):
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("<p>@testuser1</p>", html)
-            self.assertIn(f'<img src="{self.testuser1.image_url}" alt="Image for testuser1" class="card-image">', html)
-            self.assertIn("<p>@testuser2</p>", html)
-            # self.assertIn(f'<img src="{self.testuser2.image_url}" alt="Image for testuser2" class="card-image">', html)
-            # Why doesn't this one work? getting a DetachedInstanceError
+            self.assertIn("<p>@testuser</p>", html)
+            self.assertIn(f'<img src="{self.testuser1.image_url}" alt="Image for testuser" class="card-image">', html)
+            self.assertIn("<p>@otheruser</p>", html)
+            self.assertIn(f'<img src="{self.testuser2.image_url}" alt="Image for otheruser" class="card-image">', html)
+            # testuser follows otheruser (see testing.py), and nobody else.
+            self.assertIn(f'action="/users/stop-following/{self.testuser2.id}"', html)
+            self.assertIn(f'action="/users/follow/{self.testuser1.id}"', html)
             
 
     
@@ -135,4 +75,41 @@ class UserViewsTestCase(TestCase):
 
                 self.assertEqual(resp.status_code, 302)
             
-    
\ No newline at end of file
+    
+    def test_rename_profile(self):
+        """Can a user change their username, confirming with their current one?"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            resp = client.post(f"/users/{self.testuser1.id}/update",
+                               data={"username": "renamed", "email": "testuser@test.com",
+                                     "password": "testuser"})
+
+            self.assertEqual(resp.status_code, 302)
+            user = User.query.get(self.testuser1.id)
+            self.assertEqual(user.username, "renamed")
+            self.assertIsNotNone(user.renamed_at)
+
+    def test_rename_to_taken_username(self):
+        """Is a rename to someone else's username refused?"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            resp = client.post(f"/users/{self.testuser1.id}/update",
+                               data={"username": "otheruser", "email": "testuser@test.com",
+                                     "password": "testuser"})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Username already taken", resp.get_data(as_text=True))
+            self.assertEqual(User.query.get(self.testuser1.id).username, "testuser")
+
+    def test_username_available_api(self):
+        """Does the availability API answer for usernames only?"""
+
+        resp = self.client.get("/api/username-available?username=testuser&email=otheruser@test.com")
+
+        self.assertEqual(resp.get_json(), {"username": "testuser", "available": False})
@@ -0,0 +1,150 @@
+"""Write-behind queue tests."""
+
+import os
+import tempfile
+from collections import namedtuple
+from unittest import TestCase, mock
+
+from testing import app
+from write_behind import FOLLOW, LIKE, Journal, WriteBehindQueue, coalesce, overlay_page
+
+Item = namedtuple('Item', ['id'])
+
+
+class JournalTestCase(TestCase):
+    """Test the on-disk event journal."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.journal = Journal(os.path.join(self.dir.name, 'journal.db'))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_pending_last_event_wins(self):
+        """Does `pending` give each target's latest state, per user and kind?"""
+
+        self.journal.append(LIKE, 1, 10, True)
+        self.journal.append(LIKE, 1, 11, True)
+        self.journal.append(LIKE, 1, 10, False)
+        self.journal.append(FOLLOW, 1, 2, True)
+        self.journal.append(LIKE, 2, 10, True)
+
+        self.assertEqual(self.journal.pending(1, LIKE), {10: False, 11: True})
+        self.assertEqual(self.journal.pending(1, FOLLOW), {2: True})
+        self.assertEqual(self.journal.pending(3, LIKE), {})
+
+    def test_read_discard(self):
+        """Are events read oldest first, and gone once discarded?"""
+
+        for target_id in range(5):
+            self.journal.append(FOLLOW, 1, target_id, True)
+
+        events = self.journal.read(3)
+        self.assertEqual([e.target_id for e in events], [0, 1, 2])
+
+        self.journal.discard(events[-1].seq)
+        self.assertEqual(self.journal.depth(), 2)
+        self.assertEqual([e.target_id for e in self.journal.read(10)], [3, 4])
+
+    def test_durable(self):
+        """Do events survive reopening the journal?"""
+
+        self.journal.append(LIKE, 1, 10, True)
+
+        reopened = Journal(self.journal.path)
+        self.assertEqual(reopened.pending(1, LIKE), {10: True})
+
+    def test_coalesce(self):
+        """Does a batch collapse to the last state per (kind, user, target)?"""
+
+        for active in [True, False, True]:
+            self.journal.append(LIKE, 1, 10, active)
+        self.journal.append(FOLLOW, 1, 10, False)
+
+        self.assertEqual(coalesce(self.journal.read(10)),
+                         {(LIKE, 1, 10): True, (FOLLOW, 1, 10): False})
+
+
+class OverlayPageTestCase(TestCase):
+    """Test laying pending changes over a page of results."""
+
+    def load(self, ids):
+        return [Item(id) for id in ids]
+
+    def ids(self, page):
+        return [item.id for item in page]
+
+    def test_no_pending(self):
+        items = self.load([9, 7])
+
+        self.assertIs(overlay_page(items, {}, self.load, 10), items)
+
+    def test_add_and_remove(self):
+        """Are pending removals dropped and additions merged in order?"""
+
+        page = overlay_page(self.load([9, 7, 5]), {7: False, 8: True, 9: True}, self.load, 10)
+
+        self.assertEqual(self.ids(page), [9, 8, 5])
+
+    def test_additions_stay_in_range(self):
+        """Are additions outside a full page's range, or past `before`, left out?"""
+
+        pending = {1: True, 6: True, 12: True}
+        page = overlay_page(self.load([9, 7, 5]), pending, self.load, 3, before=10)
+
+        self.assertEqual(self.ids(page), [9, 7, 6])
+
+
+class WriteBehindQueueTestCase(TestCase):
+    """Test flushing batches and reading pending events."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.queue = WriteBehindQueue()
+        self.queue.configure(os.path.join(self.dir.name, 'journal.db'))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_poison_event_set_aside(self):
+        """Does a batch that keeps failing get applied around the event that fails?"""
+
+        applied = []
+
+        def apply_changes(changes, app=None):
+            if (LIKE, 1, 666) in changes:
+                raise ValueError("target purged")
+            applied.append(changes)
+
+        self.queue.submit(LIKE, 1, 10, True)
+        self.queue.submit(LIKE, 1, 666, True)
+        self.queue.submit(FOLLOW, 1, 2, True)
+
+        with app.app_context(), mock.patch('write_behind.apply_changes', side_effect=apply_changes):
+            for _ in range(2):
+                with self.assertRaises(ValueError):
+                    self.queue.flush()
+            self.assertEqual(self.queue.journal.depth(), 3)
+
+            self.assertEqual(self.queue.flush(), 3)
+
+        self.assertEqual(applied, [{(LIKE, 1, 10): True}, {(FOLLOW, 1, 2): True}])
+        self.assertEqual(self.queue.journal.depth(), 0)
+        self.assertEqual([(event.target_id, error) for event, error in self.queue.journal.failed()],
+                         [(666, "ValueError('target purged')")])
+        self.assertEqual(self.queue.stats()['failed'], 1)
+
+    def test_pending_read_once_per_request(self):
+        """Is the journal read once per user and kind in a request, and again after a submit?"""
+
+        with app.test_request_context(), \
+                mock.patch.object(self.queue.journal, 'pending', return_value={}) as pending:
+            self.queue.pending(1, FOLLOW)
+            self.queue.pending(1, FOLLOW)
+            self.queue.pending(1, LIKE)
+            self.assertEqual(pending.call_count, 2)
+
+            self.queue.submit(FOLLOW, 1, 2, True)
+            self.queue.pending(1, FOLLOW)
+            self.assertEqual(pending.call_count, 3)
@@ -0,0 +1,177 @@
+"""Database isolation for the tests.
+
+Import `app`, the app the tests share, from here in tests that use the
+database, and subclass `DatabaseTestCase`:
+
+- every test process gets a database of its own: a schema per pytest-xdist
+  worker on Postgres (`test_gw0`, `test_gw1`, ...; `test_main` without
+  xdist), or a file per worker for SQLite. Point TEST_DATABASE_URL at the
+  database to use; the default, a SQLite file in the temp directory, needs
+  nothing beyond requirements.txt.
+- the schema is created, and the shared fixtures (FIXTURE_USERS, and the
+  follows in FIXTURE_FOLLOWS) seeded, once per process
+- each test runs inside a transaction on one connection, which is rolled
+  back afterwards; commits in the code under test only release a SAVEPOINT,
+  so nothing a test writes is seen by the next one
+
+So the tests can run in parallel, across every core:
+
+    python -m pytest -n auto
+
+(Needs SQLAlchemy 1.4, for the SAVEPOINT handling below.)
+"""
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import event
+
+import follow_graph
+import notifications
+from app import create_app
+from firehose import firehose
+from message_cache import message_cache
+from models import db, Follows, User
+from slow_queries import slow_query_log
+from timeline import recent_messages_cache
+
+WORKER = os.environ.get('PYTEST_XDIST_WORKER', 'main')
+# Databases are per worker anyway, but keep message ids distinct too.
+os.environ.setdefault('WARBLER_WORKER_ID', WORKER[2:] if WORKER.startswith('gw') else '0')
+
+BASE_DATABASE_URL = os.environ.get(
+    'TEST_DATABASE_URL', f"sqlite:///{os.path.join(tempfile.gettempdir(), 'warbler_test.db')}")
+
+# Usernames of the users every test starts with; each one's password is
+# their username.
+FIXTURE_USERS = ('testuser', 'otheruser')
+FIXTURE_FOLLOWS = (('testuser', 'otheruser'),)
+
+
+def worker_database_url(base_url=BASE_DATABASE_URL, worker=WORKER):
+    """This worker's database: its own schema on Postgres, its own file on SQLite."""
+
+    if base_url.startswith('sqlite:///'):
+        root, ext = os.path.splitext(base_url)
+        return f"{root}_{worker}{ext or '.db'}"
+
+    separator = '&' if '?' in base_url else '?'
+    return f"{base_url}{separator}options=-csearch_path%3Dtest_{worker}"
+
+
+def _enable_sqlite_savepoints(engine):
+    """Let pysqlite run SAVEPOINTs inside our transactions.
+
+    pysqlite starts transactions itself (and not before SAVEPOINT), so leave
+    that to SQLAlchemy instead.
+    """
+
+    @event.listens_for(engine, 'connect')
+    def no_implicit_begin(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def explicit_begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+
+def setup_database():
+    """Create this worker's tables and seed the fixtures. Returns {username: id}."""
+
+    engine = db.engine
+
+    if engine.dialect.name == 'sqlite':
+        _enable_sqlite_savepoints(engine)
+        db.drop_all()
+    else:
+        with engine.begin() as connection:
+            connection.execute(f"DROP SCHEMA IF EXISTS test_{WORKER} CASCADE")
+            connection.execute(f"CREATE SCHEMA test_{WORKER}")
+
+    db.create_all()
+
+    users = {username: User.signup(username=username, email=f"{username}@test.com",
+                                   password=username, image_url=None)
+             for username in FIXTURE_USERS}
+    db.session.commit()
+
+    db.session.add_all([Follows(user_following_id=users[follower].id,
+                                user_being_followed_id=users[followed].id)
+                        for follower, followed in FIXTURE_FOLLOWS])
+    db.session.commit()
+
+    ids = {username: user.id for username, user in users.items()}
+    db.session.remove()
+    return ids
+
+
+def reset_caches():
+    """Forget what the process-wide caches remember from earlier tests."""
+
+    message_cache.clear()
+    recent_messages_cache.clear()
+    notifications.queue.drain()
+    notifications.unread_counts.clear()
+
+
+def isolate_services():
+    """Undo create_app's set-up of the process-wide services, for the tests.
+
+    Background threads and files shared between processes would escape the
+    per-test transaction: read follows from the database, log nothing, and
+    keep the firehose from starting its refresh thread (it's re-read per test).
+    """
+
+    follow_graph.graph.configure(None)
+    slow_query_log.configure(threshold=None)
+    firehose.configure(refresh_interval=None)
+
+
+app = create_app(dict(SQLALCHEMY_DATABASE_URI=worker_database_url(),
+                      WTF_CSRF_ENABLED=False,
+                      RATELIMIT_ENABLED=False,
+                      PRESERVE_CONTEXT_ON_EXCEPTION=False))
+# Tests use the database outside requests too.
+db.app = app
+isolate_services()
+fixture_ids = setup_database()
+
+
+class DatabaseTestCase(TestCase):
+    """Runs each test in a transaction that's rolled back afterwards."""
+
+    def setUp(self):
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+
+        self._session = db.session
+        db.session = db.create_scoped_session(options=dict(bind=self.connection, binds={}))
+
+        # Requests share the test's session rather than closing it on
+        # teardown, which would detach the objects the test holds.
+        self._remove_session = db.session.remove
+        db.session.remove = lambda: None
+
+        @event.listens_for(db.session, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if not self.savepoint.is_active:
+                self.savepoint = self.connection.begin_nested()
+
+        reset_caches()
+        with app.app_context():
+            firehose.seed(app)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self._remove_session()
+        db.session = self._session
+        self.transaction.rollback()
+        self.connection.close()
+
+    def fixture_user(self, username):
+        """One of the FIXTURE_USERS, loaded in this test's session."""
+
+        return User.query.get(fixture_ids[username])
@@ -0,0 +1,125 @@
+"""Reply threads, stored as materialized paths.
+
+Each message's `path` is the ids from its thread's root down to itself, as
+fixed-width hex `path_segment`s. Everything below a message has a path
+starting with its own, so a whole subtree is one range scan of
+ix_messages_path:
+
+    path > <p> AND path < <p> || 'g'       (hex digits all sort below 'g')
+
+and comes back already in thread order: depth first, each message's
+replies oldest first. `depth` bounds how far down a page goes, and the
+ancestors of a message are just the ids in its path.
+
+`reply_count` (direct replies only) is kept in step by `add_reply` and
+`detach_replies`, in the same transaction as the reply or delete.
+"""
+
+import re
+
+from sqlalchemy.orm import aliased
+
+from models import db, path_segment, Message
+from records import ThreadRecord, thread_query
+from snowflake import next_message_id
+
+SEGMENT_WIDTH = len(path_segment(0))
+THREAD_PAGE_SIZE = 50
+PAGE_DEPTH = 8
+# Replies to a message this deep join its parent's replies instead, which
+# keeps paths (and their index entries) short.
+MAX_DEPTH = 64
+
+PATH_RE = re.compile(rf'^(?:[0-9a-f]{{{SEGMENT_WIDTH}}})+$')
+
+
+def is_path(value):
+    """Is `value` a well-formed path (e.g. a thread page cursor)?"""
+
+    return bool(PATH_RE.match(value or ''))
+
+
+def ancestor_ids(path):
+    """Ids of the messages above the one with `path`, root first."""
+
+    return [int(path[start:start + SEGMENT_WIDTH], 16)
+            for start in range(0, len(path) - SEGMENT_WIDTH, SEGMENT_WIDTH)]
+
+
+def thread_page(message_id, limit=THREAD_PAGE_SIZE, after=None, max_depth=PAGE_DEPTH):
+    """Replies under `message_id`, in thread order, as `ThreadRecord`s.
+
+    At most `max_depth` levels down, and starting after the reply with path
+    `after` (a previous page's last `path`) if given.
+    """
+
+    root = aliased(Message)
+    query = (thread_query()
+             .join(root, root.id == message_id)
+             .filter(Message.path > root.path,
+                     Message.path < root.path + 'g',
+                     Message.depth <= root.depth + max_depth,
+                     # Replies are newer, so older partitions can be skipped.
+                     Message.id > root.id))
+    if after:
+        query = query.filter(Message.path > after)
+
+    return ThreadRecord.from_rows(query.order_by(Message.path).limit(limit))
+
+
+def ancestors(record):
+    """The messages above `record` in its thread (those still there), root first."""
+
+    ids = ancestor_ids(record.path)
+    if not ids:
+        return []
+
+    return ThreadRecord.from_rows(thread_query()
+                                  .filter(Message.id.in_(ids))
+                                  .order_by(Message.path))
+
+
+def add_reply(parent, user_id, text):
+    """Add a reply by `user_id` to `parent` (a `Message` or `ThreadRecord`) to the session.
+
+    Bumps the reply count of the message it ends up under; the caller commits.
+    """
+
+    parent_id, parent_path, depth = parent.id, parent.path, parent.depth + 1
+    if parent.depth >= MAX_DEPTH:
+        # Becomes a sibling of `parent` instead.
+        parent_id, parent_path, depth = parent.parent_id, parent.path[:-SEGMENT_WIDTH], parent.depth
+
+    message_id = next_message_id()
+    reply = Message(id=message_id, text=text, user_id=user_id, parent_id=parent_id,
+                    path=parent_path + path_segment(message_id), depth=depth)
+    db.session.add(reply)
+
+    (Message.query
+     .filter(Message.id == parent_id)
+     .update({'reply_count': Message.reply_count + 1}, synchronize_session=False))
+
+    return reply
+
+
+def detach_replies(message_ids):
+    """Take messages that are about to be deleted off their parents' reply counts.
+
+    Returns the ids of the parents whose counts changed.
+    """
+
+    counts = (db.session
+              .query(Message.parent_id, db.func.count())
+              .filter(Message.id.in_(message_ids), Message.parent_id.isnot(None))
+              .group_by(Message.parent_id)
+              .all())
+    if not counts:
+        return []
+
+    db.session.execute(
+        Message.__table__.update()
+        .where(Message.id == db.bindparam('_parent_id'))
+        .values(reply_count=Message.reply_count - db.bindparam('_replies')),
+        [dict(_parent_id=parent_id, _replies=replies) for parent_id, replies in counts])
+
+    return [parent_id for parent_id, _ in counts]
@@ -0,0 +1,209 @@
+"""Home timeline engines.
+
+Two ways to get the newest messages from a set of authors:
+
+- `in_query_timeline`: one `user_id IN (...) ORDER BY id DESC LIMIT n` query.
+  Cheapest for small follow lists, but for thousands of authors the planner
+  has to gather and sort every one of their messages.
+
+- `merged_timeline`: take each author's newest n messages (from an
+  in-process cache, or one per-author `LIMIT n` query for the misses), then
+  k-way merge those already-sorted lists with a heap and keep the top n.
+  The top n overall must be within each author's own top n, so this is exact.
+
+Both return `records.MessageRecord`s rather than ORM objects, so the cache
+stays small and templates render them directly.
+
+`home_timeline` picks between them by follow count; see
+`benchmarks/timeline_benchmark.py` for where the crossover sits.
+"""
+
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+from operator import attrgetter
+
+from models import db, Message
+from records import MessageRecord, record_query
+
+# Follow counts at or above this use the merge engine.
+DEFAULT_MERGE_THRESHOLD = 500
+
+# Authors whose recent messages are kept per process, and how long they're trusted.
+CACHE_MAX_AUTHORS = 50000
+CACHE_TTL = 30
+
+
+class AuthorTimelineCache:
+    """LRU cache of each author's newest `MessageRecord`s, newest first.
+
+    Entries expire after `ttl` seconds, so messages written by other worker
+    processes show up within that window; writes made in this process update
+    the cache immediately via `add_message` / `remove_author`.
+    """
+
+    def __init__(self, max_authors=CACHE_MAX_AUTHORS, ttl=CACHE_TTL):
+        self.max_authors = max_authors
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, author_ids, limit):
+        """Return {author_id: [records]} for cached authors with at least `limit` messages known."""
+
+        now = time.monotonic()
+        found = {}
+
+        with self._lock:
+            for author_id in author_ids:
+                entry = self._entries.get(author_id)
+                if entry is None:
+                    continue
+
+                expires, complete, records = entry
+                if expires < now:
+                    del self._entries[author_id]
+                elif complete or len(records) >= limit:
+                    self._entries.move_to_end(author_id)
+                    found[author_id] = records[:limit]
+
+        return found
+
+    def set_many(self, recent, limit):
+        """Store {author_id: [records]} as fetched with a per-author `LIMIT limit`."""
+
+        expires = time.monotonic() + self.ttl
+
+        with self._lock:
+            for author_id, records in recent.items():
+                # Fewer than `limit` messages means we have the author's whole history.
+                self._entries[author_id] = (expires, len(records) < limit, records)
+                self._entries.move_to_end(author_id)
+
+            while len(self._entries) > self.max_authors:
+                self._entries.popitem(last=False)
+
+    def add_message(self, record):
+        """Add a newly written message (a `MessageRecord`)."""
+
+        with self._lock:
+            entry = self._entries.get(record.user_id)
+            if entry is not None:
+                expires, complete, records = entry
+                if not complete:
+                    # Keep the list the same length; only the newest messages matter.
+                    records = records[:-1]
+                self._entries[record.user_id] = (expires, complete, [record] + records)
+
+    def remove_author(self, author_id):
+        """Forget an author, e.g. after one of their messages is deleted."""
+
+        with self._lock:
+            self._entries.pop(author_id, None)
+
+    def clear(self):
+        """Forget everything."""
+
+        with self._lock:
+            self._entries.clear()
+
+
+recent_messages_cache = AuthorTimelineCache()
+
+BY_ID = attrgetter('id')
+
+
+def fetch_recent(author_ids, limit, before=None):
+    """Newest `limit` messages per author, as {author_id: [records]} (newest first).
+
+    Runs a single statement: a LATERAL per-author `LIMIT` on Postgres, or a
+    ROW_NUMBER() window elsewhere. Both walk the (user_id, id) index.
+    """
+
+    recent = {author_id: [] for author_id in author_ids}
+    if not recent:
+        return recent
+
+    params = dict(limit=limit, before=before)
+
+    if db.engine.dialect.name == 'postgresql':
+        params['author_ids'] = list(recent)
+        sql = """
+            SELECT m.id, m.text, m.timestamp, u.id, u.username, u.image_url
+            FROM unnest(CAST(:author_ids AS INTEGER[])) AS a(user_id)
+            JOIN users u ON u.id = a.user_id AND u.deleted_at IS NULL
+            CROSS JOIN LATERAL (
+                SELECT id, text, timestamp FROM messages
+                WHERE user_id = a.user_id
+                  AND (CAST(:before AS BIGINT) IS NULL OR id < :before)
+                ORDER BY id DESC
+                LIMIT :limit
+            ) AS m
+        """
+    else:
+        placeholders = ", ".join(f":a{i}" for i in range(len(recent)))
+        params.update({f"a{i}": author_id for i, author_id in enumerate(recent)})
+        sql = f"""
+            SELECT m.id, m.text, m.timestamp, u.id, u.username, u.image_url FROM (
+                SELECT id, text, timestamp, user_id,
+                       ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY id DESC) AS n
+                FROM messages
+                WHERE user_id IN ({placeholders})
+                  AND (:before IS NULL OR id < :before)
+            ) AS m
+            JOIN users u ON u.id = m.user_id
+            WHERE m.n <= :limit AND u.deleted_at IS NULL
+        """
+
+    rows = db.session.execute(db.text(sql).columns(timestamp=db.DateTime), params)
+
+    for record in MessageRecord.from_rows(rows):
+        recent[record.user_id].append(record)
+
+    for records in recent.values():
+        records.sort(key=BY_ID, reverse=True)
+
+    return recent
+
+
+def in_query_timeline(author_ids, limit, before=None):
+    """Newest `limit` messages by `author_ids`, using a single IN query."""
+
+    query = record_query().filter(Message.user_id.in_(author_ids))
+
+    if before:
+        query = query.filter(Message.id < before)
+
+    return MessageRecord.from_rows(query.order_by(Message.id.desc()).limit(limit))
+
+
+def merged_timeline(author_ids, limit, before=None, cache=recent_messages_cache):
+    """Newest `limit` messages by `author_ids`, via a k-way merge of per-author lists.
+
+    The first page is served from `cache` where possible; older pages
+    (`before` set) always go to the database.
+    """
+
+    if before:
+        recent = fetch_recent(author_ids, limit, before)
+    else:
+        recent = cache.get_many(author_ids, limit)
+        missing = [author_id for author_id in author_ids if author_id not in recent]
+
+        if missing:
+            fetched = fetch_recent(missing, limit)
+            cache.set_many(fetched, limit)
+            recent.update(fetched)
+
+    return list(islice(heapq.merge(*recent.values(), key=BY_ID, reverse=True), limit))
+
+
+def home_timeline(author_ids, limit, before=None, merge_threshold=DEFAULT_MERGE_THRESHOLD):
+    """Newest `limit` messages by `author_ids`, using whichever engine suits the follow count."""
+
+    if len(author_ids) >= merge_threshold:
+        return merged_timeline(author_ids, limit, before)
+
+    return in_query_timeline(author_ids, limit, before)
@@ -0,0 +1,150 @@
+"""Locally stored profile images, in fixed-size variants.
+
+An uploaded avatar or header image is decoded, cropped and resized to each
+of its kind's VARIANTS, and saved as JPEG under UPLOAD_DIR. Resizing is CPU
+heavy, so it runs in a pool of worker processes rather than on the request
+thread. gunicorn starts each worker's pool in `post_fork`, before the app
+starts any threads; the pool's processes come from a forkserver, so a pool
+started later (after a worker died, or outside gunicorn) doesn't fork a
+threaded process either.
+
+Files are named after a hash of the uploaded bytes and how they're rendered
+(the kind's VARIANTS sizes and JPEG_QUALITY), plus the kind and variant, so
+a URL always refers to the same content and can be cached forever
+(`Cache-Control: immutable`); changing a size renders new files under new
+names. A user's `image_url` / `header_image_url`
+points at the "large" variant; the `thumbnail` template filter swaps in
+another variant of an uploaded image, and leaves external URLs alone.
+"""
+
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from hashlib import sha256
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+URL_PREFIX = '/uploads/'
+
+AVATAR = 'avatar'
+HEADER = 'header'
+
+# {kind: {variant: (width, height)}}, at twice the size they're shown.
+VARIANTS = {
+    AVATAR: {'small': (144, 144), 'large': (400, 400)},
+    HEADER: {'small': (600, 200), 'large': (1500, 500)},
+}
+
+JPEG_QUALITY = 85
+MAX_PIXELS = 40000000
+PROCESS_TIMEOUT = 30
+
+UPLOAD_NAME_RE = re.compile(r'^(?P<name>/uploads/[0-9a-f]{2}/[0-9a-f]{32}-[a-z]+-)\w+\.jpg$')
+
+_pool = None
+
+
+class ImageError(ValueError):
+    """The upload isn't an image we can use."""
+
+
+def _path(digest, kind, variant):
+    """Where a variant of the image with `digest` is stored, relative to UPLOAD_DIR."""
+
+    return os.path.join(digest[:2], f"{digest}-{kind}-{variant}.jpg")
+
+
+def render_variants(data, kind, upload_dir):
+    """Decode `data`, then write each of `kind`'s variants under `upload_dir`.
+
+    Runs in a pool worker. Returns the URL of every variant, by name.
+    """
+
+    spec = sorted(VARIANTS[kind].items()), JPEG_QUALITY
+    digest = sha256(data + repr(spec).encode('utf-8')).hexdigest()[:32]
+    urls = {}
+
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    try:
+        image = Image.open(BytesIO(data))
+        image.load()
+        if hasattr(ImageOps, 'exif_transpose'):
+            image = ImageOps.exif_transpose(image)
+        image = image.convert('RGB')
+    # Malformed files surface as any of these, depending on the decoder.
+    except (OSError, Image.DecompressionBombError, ValueError, SyntaxError) as error:
+        raise ImageError(f"Can't read that image ({error})")
+
+    for variant, size in VARIANTS[kind].items():
+        path = _path(digest, kind, variant)
+        full_path = os.path.join(upload_dir, path)
+        urls[variant] = URL_PREFIX + path.replace(os.sep, '/')
+
+        if os.path.exists(full_path):
+            continue
+
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        resized = ImageOps.fit(image, size, Image.LANCZOS)
+
+        tmp_path = f"{full_path}.{os.getpid()}.tmp"
+        resized.save(tmp_path, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+        os.replace(tmp_path, full_path)
+
+    return urls
+
+
+def start_pool(processes=None):
+    """Start this process's pool of image workers, unless it's running."""
+
+    global _pool
+
+    if _pool is None:
+        _pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('forkserver'))
+
+    return _pool
+
+
+def store_images(images, upload_dir, processes=None):
+    """Store uploaded images, given as {kind: data}, in parallel.
+
+    Returns {kind: URL of its "large" variant}. Raises `ImageError` if any
+    of them isn't a readable image, or couldn't be processed (the pool
+    timed out or broke, or the files couldn't be written).
+    """
+
+    global _pool
+
+    pool = start_pool(processes)
+    futures = {}
+
+    try:
+        for kind, data in images.items():
+            futures[kind] = pool.submit(render_variants, data, kind, upload_dir)
+        return {kind: future.result(timeout=PROCESS_TIMEOUT)['large']
+                for kind, future in futures.items()}
+    except TimeoutError:
+        raise ImageError("Processing that image took too long")
+    except BrokenProcessPool as error:
+        # A worker died (say, killed for memory); start a new pool next time.
+        if _pool is pool:
+            _pool = None
+        raise ImageError(f"Couldn't process that image ({error})")
+    except OSError as error:
+        raise ImageError(f"Couldn't save that image ({error})")
+    finally:
+        # Don't leave work queued for a request that has given up.
+        for future in futures.values():
+            future.cancel()
+
+
+def thumbnail(url, variant='small'):
+    """Template filter: `variant` of an uploaded image's URL; other URLs unchanged."""
+
+    match = UPLOAD_NAME_RE.match(url or '')
+    if match is None:
+        return url
+
+    return f"{match.group('name')}{variant}.jpg"
@@ -0,0 +1,407 @@
+"""Write-behind queue for likes and follows.
+
+During a viral moment thousands of people like the same message at once,
+and committing each like inside its request makes them queue up on the same
+rows. Instead, `add_like`, `add_follow` and `stop_following` append an event
+to a local journal (a SQLite file in WAL mode, synced on every commit, so an
+acknowledged event survives a crash) and return straight away.
+
+Events record the state wanted ("user 3 likes message 9": yes / no), not a
+toggle, so replaying one is harmless. A flusher thread in each worker
+periodically takes the journal's lock, reads a batch of events, keeps only
+the last one per (kind, user, target) and applies the batch with a few
+set-based statements in one transaction. Only then are the events removed
+from the journal; if a worker dies in between, the next flush replays them.
+
+A batch that fails MAX_ATTEMPTS times in a row (say, an event about a
+user purged since) is applied one key at a time instead; events that still
+fail are moved to the journal's `failed_events` table, and logged, so they
+can't hold up everything queued behind them.
+
+Until an event is flushed, reads see it through `pending`: the views and
+`profiles.py` lay it over what the database says (`overlay_page` does this
+for paged lists). It's read from the journal once per request.
+
+With no journal path configured, events are applied as they're submitted,
+inside the request, by the same code.
+"""
+
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+
+from flask import g, has_request_context
+
+import follow_graph
+import metrics
+from models import db, Follows, Likes, Message, User
+
+LIKE = 'like'
+FOLLOW = 'follow'
+
+FLUSH_INTERVAL = 0.5
+FLUSH_BATCH_SIZE = 1000
+# Failed flushes of the same batch before it's applied event by event.
+MAX_ATTEMPTS = 3
+
+logger = logging.getLogger('warbler.write_behind')
+
+Event = namedtuple('Event', ['seq', 'kind', 'user_id', 'target_id', 'active'])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    target_id INTEGER NOT NULL,
+    active INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_events_user_id ON events (user_id, kind);
+CREATE TABLE IF NOT EXISTS failed_events (
+    seq INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    target_id INTEGER NOT NULL,
+    active INTEGER NOT NULL,
+    error TEXT NOT NULL
+);
+"""
+
+
+class Journal:
+    """Durable, append-only log of events, shared by every process on the host."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """This process's connection (SQLite connections don't survive a fork)."""
+
+        if self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")
+            connection.executescript(_SCHEMA)
+            self._connection = connection
+            self._pid = os.getpid()
+
+        return self._connection
+
+    def append(self, kind, user_id, target_id, active):
+        with self._lock:
+            self._connect().execute(
+                "INSERT INTO events (kind, user_id, target_id, active) VALUES (?, ?, ?, ?)",
+                (kind, user_id, target_id, int(active)))
+
+    def pending(self, user_id, kind):
+        """{target_id: active} for `user_id`'s unflushed events of `kind`; the last one wins."""
+
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT target_id, active FROM events WHERE user_id = ? AND kind = ? ORDER BY seq",
+                (user_id, kind)).fetchall()
+
+        return {target_id: bool(active) for target_id, active in rows}
+
+    def read(self, limit):
+        """The oldest `limit` events."""
+
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT seq, kind, user_id, target_id, active FROM events ORDER BY seq LIMIT ?",
+                (limit,)).fetchall()
+
+        return [Event(seq, kind, user_id, target_id, bool(active))
+                for seq, kind, user_id, target_id, active in rows]
+
+    def discard(self, up_to_seq):
+        """Remove events up to and including `up_to_seq`, once they're applied."""
+
+        with self._lock:
+            self._connect().execute("DELETE FROM events WHERE seq <= ?", (up_to_seq,))
+
+    def depth(self):
+        with self._lock:
+            return self._connect().execute("SELECT count(*) FROM events").fetchone()[0]
+
+    def fail(self, event, error):
+        """Set `event` aside in `failed_events`; it's removed with its batch."""
+
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO failed_events (seq, kind, user_id, target_id, active, error) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (event.seq, event.kind, event.user_id, event.target_id, int(event.active), error))
+
+    def failed(self):
+        """Events set aside by `fail`, oldest first, as (Event, error)."""
+
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT seq, kind, user_id, target_id, active, error FROM failed_events "
+                "ORDER BY seq").fetchall()
+
+        return [(Event(seq, kind, user_id, target_id, bool(active)), error)
+                for seq, kind, user_id, target_id, active, error in rows]
+
+
+def coalesce(events):
+    """{(kind, user_id, target_id): active}, keeping the last of each key's events."""
+
+    return {(e.kind, e.user_id, e.target_id): e.active for e in events}
+
+
+def overlay_page(items, pending, load, limit, before=None, key=lambda item: item.id):
+    """Lay `pending` ({key: active}) over a page of `items`, ordered by `key` descending.
+
+    Items pending removal are dropped; keys pending addition that fall in the
+    page's range are fetched with `load(keys)` and merged in.
+    """
+
+    if not pending:
+        return items
+
+    page = [item for item in items if pending.get(key(item), True)]
+    present = {key(item) for item in page}
+
+    # The page covers keys down to its last item, or all the way if it isn't full.
+    floor = key(items[-1]) if len(items) >= limit else None
+    added = [k for k, active in pending.items()
+             if active and k not in present
+             and (before is None or k < before) and (floor is None or k > floor)]
+    if added:
+        page.extend(load(added))
+
+    page.sort(key=key, reverse=True)
+    return page[:limit]
+
+
+def _active_user_ids(user_ids):
+    if not user_ids:
+        return set()
+
+    return {id for (id,) in (db.session
+                             .query(User.id)
+                             .filter(User.id.in_(user_ids), User.deleted_at.is_(None)))}
+
+
+def _apply(changes, model, user_column, target_column, live_targets):
+    """Make `model`'s rows match `changes` ({(user_id, target_id): active}).
+
+    Returns the (user_id, target_id) pairs actually added and removed.
+    """
+
+    if not changes:
+        return [], []
+
+    user_ids = {user_id for user_id, _ in changes}
+    target_ids = {target_id for _, target_id in changes}
+    existing = {(user_id, target_id) for user_id, target_id in
+                (db.session
+                 .query(user_column, target_column)
+                 .filter(user_column.in_(user_ids), target_column.in_(target_ids)))}
+
+    added = [pair for pair, active in changes.items()
+             if active and pair not in existing and pair[1] in live_targets]
+    removed = [pair for pair, active in changes.items() if not active and pair in existing]
+
+    table = model.__table__
+    user_key, target_key = user_column.key, target_column.key
+
+    if added:
+        db.session.execute(table.insert(),
+                           [{user_key: user_id, target_key: target_id}
+                            for user_id, target_id in added])
+    if removed:
+        db.session.execute(
+            table.delete().where(db.and_(user_column == db.bindparam('_user'),
+                                         target_column == db.bindparam('_target'))),
+            [dict(_user=user_id, _target=target_id) for user_id, target_id in removed])
+
+    return added, removed
+
+
+def apply_changes(changes, app=None):
+    """Apply coalesced changes to likes and follows in one transaction.
+
+    Events from users deleted since, or about messages deleted since, are
+    dropped. Follow changes are passed on to the shared follow graph once
+    committed.
+    """
+
+    likes = {}
+    follows = {}
+    for (kind, user_id, target_id), active in changes.items():
+        (likes if kind == LIKE else follows)[user_id, target_id] = active
+
+    active_users = _active_user_ids({user_id for user_id, _ in likes}
+                                    | {user_id for pair in follows for user_id in pair})
+    likes = {pair: active for pair, active in likes.items() if pair[0] in active_users}
+    follows = {pair: active for pair, active in follows.items() if pair[0] in active_users}
+
+    liked_ids = {message_id for (_, message_id), active in likes.items() if active}
+    live_messages = {id for (id,) in (db.session
+                                      .query(Message.id)
+                                      .filter(Message.id.in_(liked_ids)))} if liked_ids else set()
+
+    _apply(likes, Likes, Likes.user_id, Likes.message_id, live_messages)
+    followed, unfollowed = _apply(follows, Follows, Follows.user_following_id,
+                                  Follows.user_being_followed_id, active_users)
+    db.session.commit()
+
+    if follow_graph.graph.available:
+        compact = follow_graph.graph.record_many(follow_graph.ADD, followed)
+        compact = follow_graph.graph.record_many(follow_graph.REMOVE, unfollowed) or compact
+        if compact and app is not None:
+            follow_graph.compact_in_background(app)
+
+
+class WriteBehindQueue:
+    """Likes and follows, journaled and applied in batches by a background flusher."""
+
+    def __init__(self):
+        self.journal = None
+        self.flush_interval = FLUSH_INTERVAL
+        self.batch_size = FLUSH_BATCH_SIZE
+        self.flushed = 0
+        self.errors = 0
+        self.failed = 0
+        # (first seq, failed attempts) of the batch that last failed.
+        self._failing = (None, 0)
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, path, flush_interval=FLUSH_INTERVAL, batch_size=FLUSH_BATCH_SIZE):
+        """Journal events at `path`; with no path, apply them straight away."""
+
+        self.journal = Journal(path) if path else None
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._failing = (None, 0)
+        self._pid = None
+
+    def submit(self, kind, user_id, target_id, active, app=None):
+        """Record that `user_id` does (or, if not `active`, doesn't) like / follow `target_id`."""
+
+        if self.journal is None:
+            apply_changes({(kind, user_id, target_id): active}, app)
+        else:
+            self.journal.append(kind, user_id, target_id, active)
+            if has_request_context():
+                g.get('write_behind_pending', {}).pop((user_id, kind), None)
+
+    def pending(self, user_id, kind):
+        """{target_id: active} for `user_id`'s events of `kind` that aren't applied yet.
+
+        Read once per request, and kept in `g` for the rest of it.
+        """
+
+        if self.journal is None or user_id is None:
+            return {}
+
+        if not has_request_context():
+            return self.journal.pending(user_id, kind)
+
+        cache = g.setdefault('write_behind_pending', {})
+        if (user_id, kind) not in cache:
+            cache[user_id, kind] = self.journal.pending(user_id, kind)
+        return cache[user_id, kind]
+
+    def flush(self, app=None):
+        """Apply one batch of journaled events (needs an app context).
+
+        Returns how many events were applied; 0 if another process holds the
+        journal's lock.
+        """
+
+        if self.journal is None:
+            return 0
+
+        with open(self.journal.lock_path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+
+            events = self.journal.read(self.batch_size)
+            if not events:
+                return 0
+
+            try:
+                apply_changes(coalesce(events), app)
+            except Exception:
+                db.session.rollback()
+                self.errors += 1
+                first_seq, attempts = self._failing
+                attempts = attempts + 1 if first_seq == events[0].seq else 1
+                self._failing = (events[0].seq, attempts)
+                if attempts < MAX_ATTEMPTS:
+                    raise
+                self._apply_each(events, app)
+
+            self._failing = (None, 0)
+            self.journal.discard(events[-1].seq)
+
+        self.flushed += len(events)
+        return len(events)
+
+    def _apply_each(self, events, app):
+        """Apply a batch that keeps failing one key at a time, setting aside the keys that fail."""
+
+        last = {(e.kind, e.user_id, e.target_id): e for e in events}
+
+        for key, event in last.items():
+            try:
+                apply_changes({key: event.active}, app)
+            except Exception as error:
+                db.session.rollback()
+                self.journal.fail(event, repr(error))
+                self.failed += 1
+                logger.exception(f"Set aside write-behind event {event}")
+
+    def ensure_running(self, app):
+        """Start the flusher thread in this process, if it isn't already running."""
+
+        if self.journal is None or self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+
+        threading.Thread(target=self._flush_forever, args=(app,), name='write-behind-flush',
+                         daemon=True).start()
+
+    def _flush_forever(self, app):
+        stop = threading.Event()
+
+        while not stop.wait(self.flush_interval):
+            with app.app_context():
+                try:
+                    # Keep going while there's a backlog.
+                    while self.flush(app) >= self.batch_size:
+                        pass
+                except Exception:
+                    app.logger.exception("Flushing the write-behind queue failed")
+                finally:
+                    db.session.remove()
+
+    def stats(self):
+        """Counters for monitoring."""
+
+        return dict(depth=self.journal.depth() if self.journal else 0,
+                    flushed=self.flushed, errors=self.errors, failed=self.failed)
+
+
+write_queue = WriteBehindQueue()
+
+metrics.register('write_behind', write_queue.stats)